@@ -0,0 +1,173 @@
+import multiprocessing
+import os
+from collections import namedtuple
+
+try:
+    from binaryninja import BinaryViewType
+except ImportError:
+    BinaryViewType = None
+
+import edgecoverage
+import emilator
+import offline
+
+STOP_RETURN = emilator.STOP_RETURN
+STOP_END = emilator.STOP_END
+STOP_LIMIT = emilator.STOP_LIMIT
+STOP_ERROR = 'error'
+
+# edges are the indexes of the coverage map edges the task hit in a new
+# count class, or None when not collecting coverage
+BatchResult = namedtuple(
+    'BatchResult',
+    ['index', 'registers', 'reason', 'count', 'error', 'edges']
+)
+
+# The (function, view, image) a pool is being started for. Forked workers
+# inherit it, so nothing about the image has to be pickled.
+_template = None
+
+# Per-worker state: the emulator, the snapshot every task starts from,
+# and the instruction budget.
+_worker = None
+
+# The worker's own edgecoverage.Coverage, cleared for every task
+_coverage = None
+
+
+def run_batch(target, states, view=None, initial=None, processes=None,
+              max_instructions=1000000, chunksize=1, coverage=None,
+              image=None):
+    # Emulates target once per state in states, over a process pool, and
+    # yields a BatchResult for each as it completes. A state is a dict
+    # with optional 'map' ([(start, length)]), 'registers'
+    # (name -> value) and 'memory' (address -> bytes) entries; initial is
+    # a state applied once per worker before the snapshot all tasks
+    # start from. With coverage, a map of count classes (a bytearray, as
+    # built by edgecoverage.merge()), each task records its edges in a
+    # map of its worker's own, and the classes it hit are merged into
+    # coverage as its result comes in. With image (a memory.BaseImage),
+    # workers share its pages instead of each reading the view; an
+    # anonymous image needs workers that fork, a file backed one is
+    # reopened.
+    global _template
+
+    function = _resolve_function(target, view)
+
+    _template = (function, view, image)
+
+    coverage_size = None if coverage is None else len(coverage)
+
+    if _forks():
+        initargs = (None, None, initial, max_instructions, None, None,
+                    coverage_size)
+    elif isinstance(function, offline.LowLevelILFunction):
+        # Offline images pickle as their path, and reload in no time
+        initargs = (None, None, initial, max_instructions,
+                    (function, function.view, image), None, coverage_size)
+    else:
+        # Workers that don't fork reopen the view themselves
+        initargs = (
+            view.file.filename, function.source_function.start,
+            initial, max_instructions, None, image, coverage_size
+        )
+
+    pool = multiprocessing.Pool(processes, _init_worker, initargs)
+
+    try:
+        for result in pool.imap_unordered(
+                _run_task, enumerate(states), chunksize):
+            if coverage is not None:
+                result = result._replace(
+                    edges=edgecoverage.merge_hits(coverage, result.edges)
+                )
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+        _template = None
+
+
+def _forks():
+    get_start_method = getattr(multiprocessing, 'get_start_method', None)
+
+    if get_start_method is None:
+        return hasattr(os, 'fork')
+
+    return get_start_method() == 'fork'
+
+
+def _resolve_function(target, view):
+    if isinstance(target, emilator.FUNCTION_TYPES):
+        return target
+
+    if view is None:
+        raise ValueError('view is required when target is an address')
+
+    function = view.get_function_at(target)
+
+    if function is None:
+        raise ValueError('No function at {:x}'.format(target))
+
+    return function.low_level_il
+
+
+def _init_worker(filename, address, initial, max_instructions,
+                 template=None, image=None, coverage_size=None):
+    global _worker, _coverage
+
+    if filename is None:
+        function, view, image = template or _template
+    else:
+        view = BinaryViewType.get_view_of_file(filename)
+        function = view.get_function_at(address).low_level_il
+
+    emulator = emilator.Emilator(function, view, image)
+
+    if initial is not None:
+        _apply_state(emulator, initial)
+
+    if coverage_size is not None:
+        _coverage = edgecoverage.Coverage(coverage_size)
+        emulator.set_coverage(_coverage)
+
+    _worker = (emulator, emulator.snapshot(), max_instructions)
+
+
+def _apply_state(emulator, state):
+    for start, length in state.get('map', ()):
+        emulator.map_memory(start, length)
+
+    for register, value in state.get('registers', {}).items():
+        emulator.set_register_value(register, value)
+
+    for address, data in state.get('memory', {}).items():
+        emulator.write_memory(address, data)
+
+
+def _run_task(task):
+    index, state = task
+    emulator, snapshot, max_instructions = _worker
+
+    emulator.restore(snapshot)
+
+    if _coverage is not None:
+        _coverage.clear()
+
+    count = None
+    error = None
+
+    try:
+        _apply_state(emulator, state)
+        reason, count = emulator.run_until(max_instructions)
+
+    except Exception as e:
+        reason = STOP_ERROR
+        error = repr(e)
+
+    # Sent back sparse; run_batch() turns them into the new edges
+    edges = None if _coverage is None else _coverage.hits()
+
+    return BatchResult(
+        index, emulator.registers, reason, count, error, edges
+    )
@@ -1,11 +1,38 @@
 class BNILVisitor(object):
     def __init__(self, **kw):
         super(BNILVisitor, self).__init__()
+        self._dispatch = self._get_dispatch_table()
+
+    @classmethod
+    def _get_dispatch_table(cls):
+        # One table per class, filled lazily as operations are encountered.
+        # Looking in the class __dict__ keeps subclasses from sharing
+        # (and polluting) their parent's table.
+        table = cls.__dict__.get('_dispatch_table')
+        if table is None:
+            table = {}
+            setattr(cls, '_dispatch_table', table)
+        return table
+
+    def _resolve_visit(self, operation):
+        cls = type(self)
+        method = getattr(cls, 'visit_{}'.format(operation.name), None)
+        if method is None:
+            method = cls.visit_unimplemented
+        # Store the plain function so a dispatch skips the unbound method
+        method = getattr(method, '__func__', method)
+        cls._get_dispatch_table()[operation] = method
+        if self._dispatch is not cls._dispatch_table:
+            self._dispatch[operation] = method
+        return method
 
     def visit(self, expression):
-        method_name = 'visit_{}'.format(expression.operation.name)
-        if hasattr(self, method_name):
-            value = getattr(self, method_name)(expression)
-        else:
-            value = None
-        return value
\ No newline at end of file
+        operation = expression.operation
+        try:
+            method = self._dispatch[operation]
+        except KeyError:
+            method = self._resolve_visit(operation)
+        return method(self, expression)
+
+    def visit_unimplemented(self, expression):
+        return None
@@ -0,0 +1,242 @@
+import bisect
+import json
+import mmap
+import struct
+import zlib
+
+import memory
+
+# Checkpoints of a running emulator. Only pages that differ from what
+# the emulator would see anyway are stored: pages of lazily mapped
+# ranges that still match the emulator's segment loader (its view or
+# base image), and zero pages of other ranges, are left out. The rest
+# are compressed one by one, and read back through an mmap as they are
+# touched.
+#
+# File layout: MAGIC, a (version, header offset) pair, the page data,
+# then a JSON header with the emulator's state, its mapped ranges as
+# (start, length, flags, lazy) and its pages as (page number, offset,
+# length, encoding).
+
+MAGIC = b'EMICKPT\x00'
+VERSION = 1
+
+PREFIX = struct.Struct('<IQ')
+
+COMPRESSION_LEVEL = 1
+
+# Page encodings
+RAW = 0
+ZLIB = 1
+ZERO = 2
+
+
+class Checkpoint(object):
+    # The pages of a checkpoint file, mapped
+    def __init__(self, buffer, pages):
+        self._buffer = buffer
+        self.pages = dict(
+            (page_number, (offset, length, encoding))
+            for page_number, offset, length, encoding in pages
+        )
+        self.page_numbers = sorted(self.pages)
+
+    def data(self, page_number):
+        offset, length, encoding = self.pages[page_number]
+
+        if encoding == ZERO:
+            return bytearray(memory.PAGE_SIZE)
+
+        data = self._buffer[offset:offset + length]
+
+        if encoding == ZLIB:
+            data = zlib.decompress(data)
+
+        # A bytearray, so saving again compares it with the segment data
+        return bytearray(data)
+
+    def blob(self, page_number):
+        # (encoding, stored bytes), to copy into another checkpoint as is
+        offset, length, encoding = self.pages[page_number]
+        return encoding, self._buffer[offset:offset + length]
+
+
+class PageLoader(object):
+    # The loader of a range mapped from a checkpoint. Its pages come
+    # from the checkpoint, or else from base, the segment loader, if
+    # the range was lazily mapped when saved; otherwise they are zero.
+    def __init__(self, checkpoint, base):
+        self.checkpoint = checkpoint
+        self.base = base
+
+    def __call__(self, address, length):
+        if not address & memory.PAGE_MASK and length == memory.PAGE_SIZE:
+            return self._page(address >> memory.PAGE_SHIFT)
+
+        chunks = []
+        end = address + length
+
+        while address < end:
+            offset = address & memory.PAGE_MASK
+            chunk = min(memory.PAGE_SIZE - offset, end - address)
+            data = self._page(address >> memory.PAGE_SHIFT)
+            chunks.append(data[offset:offset + chunk])
+            address += chunk
+
+        return b''.join(chunks)
+
+    def _page(self, page_number):
+        if page_number in self.checkpoint.pages:
+            return self.checkpoint.data(page_number)
+
+        if self.base is None:
+            return memory.ZERO_PAGE
+
+        data = self.base(page_number << memory.PAGE_SHIFT, memory.PAGE_SIZE)
+
+        if len(data) < memory.PAGE_SIZE:
+            data = data + memory.ZERO_PAGE[len(data):]
+
+        return data
+
+
+def save(path, state, address_space, base):
+    # Writes state (anything JSON can hold) and the mapped memory of
+    # address_space (a memory.Memory) to path. base is the segment
+    # loader the ranges mapped lazily use.
+    ranges = []
+    lazy_bounds = []
+
+    for memory_range in address_space:
+        loader = memory_range.loader
+        if isinstance(loader, PageLoader):
+            lazy = loader.base is not None
+        else:
+            lazy = loader is not None
+
+        ranges.append([
+            memory_range.start, memory_range.length, memory_range.flags, lazy
+        ])
+        if lazy:
+            lazy_bounds.append((
+                memory_range.start, memory_range.start + memory_range.length
+            ))
+
+    lazy_starts = [start for start, end in lazy_bounds]
+
+    def lazy_page(page_number):
+        address = page_number << memory.PAGE_SHIFT
+        index = bisect.bisect_right(
+            lazy_starts, address + memory.PAGE_SIZE - 1
+        )
+        while index > 0:
+            index -= 1
+            if lazy_bounds[index][1] > address:
+                return True
+        return False
+
+    blobs = {}
+
+    for page_number, page in address_space._pages.items():
+        data = page.data
+
+        # Everything else is still the loader's data, or the zero page
+        if not isinstance(data, bytearray):
+            continue
+
+        if lazy_page(page_number):
+            expected = base(
+                page_number << memory.PAGE_SHIFT, memory.PAGE_SIZE
+            )
+            # Short at the end of a segment, like the loader's pages
+            if len(expected) < memory.PAGE_SIZE:
+                expected = expected + memory.ZERO_PAGE[len(expected):]
+        else:
+            expected = memory.ZERO_PAGE
+
+        if data == expected[:]:
+            continue
+
+        if data == memory.ZERO_PAGE:
+            blobs[page_number] = (ZERO, b'')
+            continue
+
+        data = bytes(data)
+        compressed = zlib.compress(data, COMPRESSION_LEVEL)
+
+        if len(compressed) < len(data):
+            blobs[page_number] = (ZLIB, compressed)
+        else:
+            blobs[page_number] = (RAW, data)
+
+    # Pages of a checkpoint this emulator was loaded from, and hasn't
+    # written to since, are copied over without decompressing them
+    for memory_range in address_space:
+        loader = memory_range.loader
+        if not isinstance(loader, PageLoader):
+            continue
+
+        checkpoint = loader.checkpoint
+        page_numbers = checkpoint.page_numbers
+        first, last = memory._page_bounds(
+            memory_range.start, memory_range.length
+        )
+        index = bisect.bisect_left(page_numbers, first >> memory.PAGE_SHIFT)
+
+        while (index < len(page_numbers) and
+                page_numbers[index] < last >> memory.PAGE_SHIFT):
+            page_number = page_numbers[index]
+            page = address_space._pages.get(page_number)
+            if page_number not in blobs and (
+                    page is None or not isinstance(page.data, bytearray)):
+                blobs[page_number] = checkpoint.blob(page_number)
+            index += 1
+
+    with open(path, 'wb') as fp:
+        fp.write(MAGIC)
+        fp.write(PREFIX.pack(VERSION, 0))
+
+        pages = []
+        offset = len(MAGIC) + PREFIX.size
+
+        for page_number in sorted(blobs):
+            encoding, blob = blobs[page_number]
+            fp.write(blob)
+            pages.append([page_number, offset, len(blob), encoding])
+            offset += len(blob)
+
+        header = {'state': state, 'ranges': ranges, 'pages': pages}
+        fp.write(json.dumps(header).encode('ascii'))
+
+        fp.seek(len(MAGIC))
+        fp.write(PREFIX.pack(VERSION, offset))
+
+
+def load(path, base):
+    # Returns the state and the memory.MemoryRanges saved to path. The
+    # ranges read their pages from the file when they are touched, and
+    # from base, the segment loader, where they were lazily mapped.
+    with open(path, 'rb') as fp:
+        buffer = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+    if buffer[:len(MAGIC)] != MAGIC:
+        raise ValueError('{} is not a checkpoint'.format(path))
+
+    version, header_offset = PREFIX.unpack_from(buffer, len(MAGIC))
+    if version != VERSION:
+        raise ValueError('Unsupported checkpoint version {}'.format(version))
+
+    header = json.loads(buffer[header_offset:].decode('ascii'))
+    checkpoint = Checkpoint(buffer, header['pages'])
+
+    lazy_loader = PageLoader(checkpoint, base)
+    zero_loader = PageLoader(checkpoint, None)
+
+    ranges = [
+        memory.MemoryRange(
+            start, length, flags, lazy_loader if lazy else zero_loader
+        )
+        for start, length, flags, lazy in header['ranges']
+    ]
+
+    return header['state'], ranges
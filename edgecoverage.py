@@ -0,0 +1,192 @@
+import binascii
+import ctypes
+import mmap
+import re
+
+MAP_SIZE = 1 << 16
+
+# Instructions that can move execution to another block. The emulator
+# records an edge wherever one of them lands.
+EDGES = frozenset([
+    'LLIL_IF', 'LLIL_GOTO', 'LLIL_JUMP', 'LLIL_JUMP_TO', 'LLIL_CALL',
+    'LLIL_TAILCALL', 'LLIL_RET'
+])
+
+# AFL's hit count classes, one bit per class, so classified maps can be
+# merged with a bitwise or
+BUCKETS = bytearray(256)
+for _count in range(256):
+    if _count == 0:
+        BUCKETS[_count] = 0
+    elif _count <= 3:
+        BUCKETS[_count] = (1, 2, 4)[_count - 1]
+    elif _count <= 7:
+        BUCKETS[_count] = 8
+    elif _count <= 15:
+        BUCKETS[_count] = 16
+    elif _count <= 31:
+        BUCKETS[_count] = 32
+    elif _count <= 127:
+        BUCKETS[_count] = 64
+    else:
+        BUCKETS[_count] = 128
+BUCKETS = bytes(BUCKETS)
+del _count
+
+NONZERO = re.compile(b'[^\x00]')
+
+
+class Coverage(object):
+    # An AFL style edge map: bitmap[location ^ previous >> 1] counts the
+    # times execution went from one block to another, where a location
+    # is a hash of the block's (function start, instr_index). The bitmap
+    # can be any writable buffer whose length is a power of two; a
+    # shared one (see shared()) is written to by every forked worker.
+    def __init__(self, size=MAP_SIZE, bitmap=None):
+        if bitmap is None:
+            bitmap = bytearray(size)
+
+        size = len(bitmap)
+        if size & (size - 1):
+            raise ValueError('bitmap size must be a power of two')
+
+        self.bitmap = bitmap
+        self.previous = 0
+
+        # Per-edge counters are read and written as ints; an mmap only
+        # does that through ctypes (on Python 2 its items are strings).
+        if isinstance(bitmap, bytearray):
+            self._counters = bitmap
+        else:
+            self._counters = (ctypes.c_ubyte * size).from_buffer(bitmap)
+
+        self._mask = size - 1
+        self._zero = bytes(bytearray(size))
+        self._starts = {}
+
+    @classmethod
+    def shared(cls, size=MAP_SIZE):
+        # Anonymous memory, shared with processes forked afterwards
+        return cls(bitmap=mmap.mmap(-1, size))
+
+    def __len__(self):
+        return len(self.bitmap)
+
+    def reset(self):
+        # Starts a new run; the next edge comes from nowhere
+        self.previous = 0
+
+    def clear(self):
+        self.bitmap[:] = self._zero
+        self.previous = 0
+
+    def classify(self):
+        # The bitmap with every count replaced by its class bit
+        return self.bitmap[:].translate(BUCKETS)
+
+    def edges(self):
+        # Indexes of the edges hit since the last clear()
+        return [match.start() for match in NONZERO.finditer(self.bitmap[:])]
+
+    def hits(self):
+        # (index, count class) of the edges hit since the last clear(); a
+        # sparse classify(), for merge_hits()
+        classified = bytearray(self.classify())
+        return [(index, classified[index]) for index in self.edges()]
+
+    def diff(self, total):
+        # Indexes of the edges whose count class isn't in total yet, a
+        # map built up with merge()
+        return diff(self.classify(), total)
+
+    def merge(self, total):
+        # Adds this run's count classes into total, in place
+        return merge(total, self.classify())
+
+    def instrument(self, code, emulator, function, function_start):
+        # Wraps the code of an EDGES instruction in function to record
+        # the edge to wherever it leaves the emulator. Locations in the
+        # same function, as for every IF and GOTO, are cached.
+        bitmap = self._counters
+        mask = self._mask
+        starts = self._starts
+        coverage = self
+
+        start = function_start(function)
+        locations = {}
+
+        def instrumented():
+            result = code()
+
+            index = emulator.instr_index
+
+            if emulator._function is function:
+                current = locations.get(index)
+                if current is None:
+                    current = locations[index] = location(start, index) & mask
+
+            else:
+                other = emulator._function
+                other_start = starts.get(other)
+                if other_start is None:
+                    other_start = starts[other] = function_start(other)
+                current = location(other_start, index) & mask
+
+            edge = current ^ coverage.previous
+            # AFL++'s NeverZero: a count that wraps goes to 1, not 0
+            bitmap[edge] = ((bitmap[edge] + 1) & 0xff) or 1
+            coverage.previous = current >> 1
+
+            return result
+
+        return instrumented
+
+
+def location(function_start, index):
+    # Mixes a block's function start and instr_index into 32 bits
+    value = (
+        function_start * 0x9e3779b1 + (index + 1) * 0x85ebca6b
+    ) & 0xffffffff
+    value ^= value >> 15
+    value = (value * 0x2c1b3c6d) & 0xffffffff
+    return value ^ (value >> 12)
+
+
+def merge(total, classified):
+    # total |= classified, bytewise, in place
+    size = len(total)
+    value = _to_int(total[:]) | _to_int(classified)
+    total[:] = _from_int(value, size)
+    return total
+
+
+def merge_hits(total, hits):
+    # Adds hits (from Coverage.hits()) into total, a bytearray, in place,
+    # and returns the indexes of the edges whose class wasn't in it yet
+    new = []
+
+    for index, bucket in hits:
+        known = total[index]
+        if bucket & ~known:
+            total[index] = known | bucket
+            new.append(index)
+
+    return new
+
+
+def diff(classified, total):
+    size = len(classified)
+    new = _to_int(classified) & ~_to_int(total[:])
+
+    if not new:
+        return []
+
+    return [match.start() for match in NONZERO.finditer(_from_int(new, size))]
+
+
+def _to_int(data):
+    return int(binascii.hexlify(data) or b'0', 16)
+
+
+def _from_int(value, size):
+    return binascii.unhexlify('{:0{}x}'.format(value, size * 2))
@@ -1,59 +1,224 @@
+import binascii
 import struct
+import time
+import warnings
+from collections import namedtuple
 
+import checkpoint
+import edgecoverage
 import errors
+import functions
+import hooks
+import lazyflags
+import llilcompiler
 import llilvisitor
 import memory
-from binaryninja import (LLIL_GET_TEMP_REG_INDEX, LLIL_REG_IS_TEMP,
-                         Architecture, BinaryView, Endianness, ILRegister,
-                         ImplicitRegisterExtend, LowLevelILFunction,
-                         SegmentFlag)
+import offline
+import registers
+import translation
+
+try:
+    from binaryninja import (LLIL_REG_IS_TEMP, Architecture, BinaryView,
+                             Endianness, LowLevelILFunction, SegmentFlag)
+except ImportError:
+    from offline import (LLIL_REG_IS_TEMP, Architecture, BinaryView,
+                         Endianness, LowLevelILFunction, SegmentFlag)
+
+FUNCTION_TYPES = (LowLevelILFunction, offline.LowLevelILFunction)
 
 fmt = {1: 'B', 2: 'H', 4: 'L', 8: 'Q'}
 
+_codecs = {}
+
+MAX_CALL_DEPTH = 1024
+
+# Why run_until() stopped
+STOP_RETURN = 'return'
+STOP_END = 'end'
+STOP_LIMIT = 'limit'
+STOP_BREAKPOINT = 'breakpoint'
+STOP_DEADLINE = 'deadline'
+STOP_PREDICATE = 'predicate'
+
+# How many instructions (or, without per-instruction checks, blocks)
+# run_until() runs between looks at the clock
+DEADLINE_INTERVAL = 256
+
+RunResult = namedtuple('RunResult', ['reason', 'count'])
+
+Snapshot = namedtuple(
+    'Snapshot',
+    ['regs', 'temps', 'flags', 'lazy_flags', 'instr_index', 'function',
+     'memory', 'frames']
+)
+
+# A call in progress: where to resume the caller, and the return address
+# its callee should come back to.
+Frame = namedtuple('Frame', ['function', 'instr_index', 'return_address'])
+
 
 def sign_extend(value, bits):
     sign_bit = 1 << (bits - 1)
     return (value & (sign_bit - 1)) - (value & sign_bit)
 
 
+def get_codec(little_endian, size):
+    # (decode, encode) converting between size byte strings and ints
+    codec = _codecs.get((little_endian, size))
+
+    if codec is None:
+        codec = _codecs[(little_endian, size)] = _make_codec(
+            little_endian, size
+        )
+
+    return codec
+
+
+def _make_codec(little_endian, size):
+    mask = (1 << size * 8) - 1
+
+    if size in fmt:
+        packer = struct.Struct(('<' if little_endian else '>') + fmt[size])
+        unpack = packer.unpack
+        pack = packer.pack
+
+        def decode(data):
+            return unpack(data)[0]
+
+        def encode(value):
+            return pack(value & mask)
+
+        return decode, encode
+
+    # Arbitrary widths (x87 and vector registers) go through hex
+    digits = size * 2
+
+    def decode(data):
+        if little_endian:
+            data = data[::-1]
+        return int(binascii.hexlify(data), 16)
+
+    def encode(value):
+        data = binascii.unhexlify('%0*x' % (digits, value & mask))
+        if little_endian:
+            data = data[::-1]
+        return data
+
+    return decode, encode
+
+
+def _function_start(function):
+    source = getattr(function, 'source_function', None)
+    return source.start if source is not None else 0
+
+
+def _breakpoint_indexes(function, addresses, indexes):
+    # The instr_indexes in function to stop at
+    # An address stops at the first IL instruction lifted from it, not at
+    # every one, so a native instruction is only stopped at once
+    stops = set(indexes or ())
+
+    for address in addresses or ():
+        index = function.get_instruction_start(address, function.arch)
+        if index is not None and index < len(function):
+            stops.add(index)
+
+    return stops
+
+
 class Emilator(llilvisitor.LLILVisitor):
-    def __init__(self, function, view=None):
+    def __init__(self, function, view=None, image=None):
         super(Emilator, self).__init__()
 
-        if not isinstance(function, LowLevelILFunction):
+        if not isinstance(function, FUNCTION_TYPES):
             raise TypeError('function must be a LowLevelILFunction')
 
         self._function = function
 
         if view is None:
-            view = BinaryView()
+            if isinstance(function, offline.LowLevelILFunction):
+                view = function.view
+            else:
+                view = BinaryView()
 
         self._view = view
-
-        self._regs = {}
+        self._little_endian = (
+            function.arch.endianness == Endianness.LittleEndian
+        )
+
+        # Full width registers live in slots laid out once per
+        # architecture; temp registers get their own array.
+        self._layout = registers.get_layout(function.arch)
+        self._regs = [None] * len(self._layout)
+        self._temps = []
+        self._reg_readers = {}
+        self._reg_writers = {}
         self._flags = {}
+
+        # Flags written by arithmetic are kept as the last LazyFlags
+        # record and only computed when read; _flags holds the rest.
+        self._lazy_flags = None
+        self._flag_roles = lazyflags.flag_roles(function.arch)
+        self._role_flags = dict(
+            (role, flag) for flag, role in self._flag_roles.items()
+        )
+        self._flags_written = {}
+
         self._memory = memory.Memory(function.arch.address_size)
 
-        for segment in view.segments:
-            self._memory.map(
-                segment.start, segment.length, segment.flags,
-                view.read(segment.start, segment.length)
-            )
+        # Segment pages are read from the view (or shared with every
+        # other emulator on the same memory.BaseImage) the first time
+        # they are touched, and only copied once they are written to.
+        if image is not None:
+            self._segment_loader = image.read
+            self._memory.map_image(image)
+        else:
+            self._segment_loader = view.read
+            for segment in view.segments:
+                self._memory.map(
+                    segment.start, segment.length, segment.flags,
+                    loader=view.read
+                )
 
         self._function_hooks = {}
+        self._code_hooks = hooks.IntervalIndex()
+        self._read_hooks = hooks.IntervalIndex()
+        self._write_hooks = hooks.IntervalIndex()
+        self._tracer = None
+        self._profiler = None
+        self._coverage = None
+        self._optimizer = None
         self.instr_index = 0
 
+        self._frames = []
+        self.max_call_depth = MAX_CALL_DEPTH
+
+        self._callees = functions.FunctionCache(view)
+        self._compiler = llilcompiler.LLILCompiler(self)
+        self._code = {}
+        self._code_watches = {}
+        self._moving_memory = False
+        self._translations = translation.TranslationCache(self)
+
     @property
     def function(self):
         return self._function
 
+    @property
+    def call_stack(self):
+        return list(self._frames)
+
     @property
     def mapped_memory(self):
         return list(self._memory)
 
     @property
     def registers(self):
-        return dict(self._regs)
+        return dict(
+            (name, value)
+            for name, value in zip(self._layout.names, self._regs)
+            if value is not None
+        )
 
     @property
     def function_hooks(self):
@@ -61,241 +226,769 @@ class Emilator(llilvisitor.LLILVisitor):
 
     @property
     def instr_hooks(self):
-        return dict(self._hooks)
+        return dict(
+            (operation, hook)
+            for operation, (hook, replace) in self._hooks.items()
+        )
+
+    @property
+    def code_hooks(self):
+        return list(self._code_hooks)
+
+    @property
+    def memory_read_hooks(self):
+        return list(self._read_hooks)
+
+    @property
+    def memory_write_hooks(self):
+        return list(self._write_hooks)
 
     def map_memory(self,
                    start=None,
                    length=0x1000,
-                   flags=SegmentFlag.SegmentReadable | SegmentFlag.SegmentWritable,
-                   data=None):
-        return self._memory.map(start, length, flags, data)
+                   flags=(SegmentFlag.SegmentReadable |
+                          SegmentFlag.SegmentWritable),
+                   data=None,
+                   alignment=memory.PAGE_SIZE):
+        return self._memory.map(
+            start, length, flags, data, alignment=alignment
+        )
 
     def unmap_memory(self, base, size):
-        raise errors.UnimplementedError('Unmapping memory not implemented')
+        self._move_memory(self._memory.unmap, base, size)
 
     def register_function_hook(self, function, hook):
         self._function_hooks[function] = hook
 
-    def register_instruction_hook(self, operand, hook):
-        # These hooks will be fallen back on if LLIL_UNIMPLEMENTED
-        # is encountered
-        pass
+    def register_instruction_hook(self, operand, hook, replace=False):
+        # hook(emulator, expression) runs whenever an operand operation is
+        # visited. With replace=True its return value is used instead of
+        # the emulator's own implementation, which also covers
+        # LLIL_UNIMPL and friends.
+        self._set_hook(operand, hook, replace)
 
     def unregister_function_hook(self, function, hook):
-        pass
+        if self._function_hooks.get(function) == hook:
+            del self._function_hooks[function]
 
     def unregister_instruction_hook(self, operand, hook):
-        pass
+        if self._hooks.get(operand, (None,))[0] == hook:
+            self._remove_hook(operand)
+
+    def register_code_hook(self, start, end, hook):
+        # hook(emulator, address) runs before every IL instruction lifted
+        # from an address in [start, end)
+        self._code_hooks.add(start, end, hook)
+        self._hooks_changed()
+
+    def unregister_code_hook(self, start, end, hook):
+        self._code_hooks.remove(start, end, hook)
+        self._hooks_changed()
+
+    def register_memory_read_hook(self, start, end, hook):
+        # hook(emulator, address, length) runs before any read
+        # overlapping [start, end)
+        self._read_hooks.add(start, end, hook)
+        self._hooks_changed()
+
+    def unregister_memory_read_hook(self, start, end, hook):
+        self._read_hooks.remove(start, end, hook)
+        self._hooks_changed()
+
+    def register_memory_write_hook(self, start, end, hook):
+        # hook(emulator, address, length, data) runs before any write
+        # overlapping [start, end); data is an int or a byte string
+        self._write_hooks.add(start, end, hook)
+        self._hooks_changed()
+
+    def unregister_memory_write_hook(self, start, end, hook):
+        self._write_hooks.remove(start, end, hook)
+        self._hooks_changed()
+
+    def _hooks_changed(self):
+        # Code is compiled with whatever hooks exist at the time, and the
+        # memory accessors are only swapped for hooked ones while memory
+        # hooks exist, so an emulator without hooks never checks for them.
+        self._flush_code()
+
+        for name in ('read_memory', 'read_block'):
+            if self._read_hooks:
+                setattr(self, name, getattr(self, '_hooked_' + name))
+            else:
+                self.__dict__.pop(name, None)
 
-    def set_register_value(self, register, value):
-        # If it's a temp register, just set the value no matter what.
-        # Maybe this will be an issue eventually, maybe not.
-        if (isinstance(register, (int, long)) and 
-                LLIL_REG_IS_TEMP(register)):
-            self._regs[register] = value
-            return value
-
-        if isinstance(register, ILRegister):
-            if not LLIL_REG_IS_TEMP(register.index):
-                register = register.name
+        for name in ('write_memory', 'write_block'):
+            if self._write_hooks:
+                setattr(self, name, getattr(self, '_hooked_' + name))
             else:
-                self._regs[register.index] = value
-                return value
+                self.__dict__.pop(name, None)
+
+    def set_tracer(self, tracer):
+        # Records every instruction, register write and memory write into
+        # tracer (a tracer.TraceRecorder), or stops recording if None.
+        # Like hooks, recording is compiled in, so it costs nothing while
+        # no tracer is set.
+        self._tracer = tracer
+        self._reg_readers = {}
+        self._reg_writers = {}
+        self._flush_code()
+
+        if tracer is None:
+            self._memory.__dict__.pop('write', None)
+            return
+
+        write = memory.Memory.write.__get__(self._memory)
+        record = tracer.memory
+
+        def traced_write(address, value):
+            write(address, value)
+            record(address, value)
+
+        self._memory.write = traced_write
+
+    def set_profiler(self, profiler):
+        # Counts executions and time per operation, block and function
+        # into profiler (a profiler.Profiler), or stops if None. Code
+        # compiled without a profiler carries no counters at all.
+        self._profiler = profiler
+        self._flush_code()
+
+    def set_coverage(self, coverage):
+        # Records the edges between blocks into coverage (an
+        # edgecoverage.Coverage), or stops if None. Only instructions
+        # that can leave a block are instrumented, and only while set.
+        self._coverage = coverage
+        self._flush_code()
+
+    def set_optimizer(self, optimizer):
+        # Runs the instructions optimizer (an optimizer.Optimizer) makes
+        # of each function instead of the originals, or the originals
+        # again if None. Temps and flags only match the original's at
+        # block boundaries, so any instruction, code or memory hook, which
+        # could look in between, runs everything unoptimized. For the
+        # same reason an emulator stopped in the middle of a block (by
+        # run_until()'s max_instructions, or a fault) may have temps the
+        # rest of the block never wrote: a snapshot or checkpoint taken
+        # there has to be resumed with the same optimizer.
+        self._optimizer = optimizer
+        self._flush_code()
+
+    def _hooked_read_memory(self, addr, length):
+        for hook in self._read_hooks.overlapping(addr, addr + length):
+            hook(self, addr, length)
+        return Emilator.read_memory(self, addr, length)
+
+    def _hooked_read_block(self, addr, length):
+        for hook in self._read_hooks.overlapping(addr, addr + length):
+            hook(self, addr, length)
+        return Emilator.read_block(self, addr, length)
+
+    def _hooked_write_memory(self, addr, data, length=None):
+        if not isinstance(data, (int, long)):
+            length = len(data)
+        for hook in self._write_hooks.overlapping(addr, addr + length):
+            hook(self, addr, length, data)
+        return Emilator.write_memory(self, addr, data, length)
+
+    def _hooked_write_block(self, addr, data):
+        length = len(data)
+        for hook in self._write_hooks.overlapping(addr, addr + length):
+            hook(self, addr, length, data)
+        return Emilator.write_block(self, addr, data)
 
-        arch = self._function.arch
+    def set_register_value(self, register, value):
+        if isinstance(register, registers.REGISTER_TYPES):
+            register = register.index
 
-        reg_info = arch.regs[register]
+        try:
+            write = self._reg_writers[register]
+        except KeyError:
+            write = self._register_writer(register)
+            self._reg_writers[register] = write
 
-        # normalize value to be unsigned
-        if value < 0:
-            value = value + (1 << reg_info.size * 8)
+        return write(value)
 
-        if register == reg_info.full_width_reg:
-            self._regs[register] = value
-            return value
+    def get_register_value(self, register):
+        if isinstance(register, registers.REGISTER_TYPES):
+            register = register.index
 
-        full_width_reg_info = arch.regs[reg_info.full_width_reg]
-        full_width_reg_value = self._regs.get(full_width_reg_info.full_width_reg)
+        try:
+            read = self._reg_readers[register]
+        except KeyError:
+            read = self._register_reader(register)
+            self._reg_readers[register] = read
 
-        if (full_width_reg_value is None and
-                (reg_info.extend == ImplicitRegisterExtend.NoExtend or
-                 reg_info.offset != 0)):
-            raise errors.UndefinedError(
-                'Register {} not defined'.format(
-                    reg_info.full_width_reg
-                )
-            )
+        return read()
 
-        if reg_info.extend == ImplicitRegisterExtend.ZeroExtendToFullWidth:
-            full_width_reg_value = value
+    def _register_reader(self, register):
+        return self._layout.reader(register, self._regs, self._temps)
 
-        elif reg_info.extend == ImplicitRegisterExtend.SignExtendToFullWidth:
-            full_width_reg_value = (
-                (value ^ ((1 << reg_info.size * 8) - 1)) -
-                ((1 << reg_info.size * 8) - 1) +
-                (1 << full_width_reg_info.size * 8)
-            )
+    def _register_writer(self, register):
+        write = self._layout.writer(register, self._regs, self._temps)
 
-        elif reg_info.extend == ImplicitRegisterExtend.NoExtend:
-            # mask off the value that will be replaced
-            mask = (1 << reg_info.size * 8) - 1
-            full_mask = (1 << full_width_reg_info.size * 8) - 1
-            reg_bits = mask << (reg_info.offset * 8)
+        index = getattr(register, 'index', register)
+        if self._tracer is None or (
+                isinstance(index, (int, long)) and LLIL_REG_IS_TEMP(index)):
+            return write
 
-            full_width_reg_value &= full_mask ^ reg_bits
-            full_width_reg_value |= value << reg_info.offset * 8
+        slot = self._layout[register].slot
+        regs = self._regs
+        record = self._tracer.register
 
-        self._regs[full_width_reg_info.full_width_reg] = full_width_reg_value
+        def traced_write(value):
+            result = write(value)
+            record(slot, regs[slot])
+            return result
 
-        return full_width_reg_value
+        return traced_write
 
-    def get_register_value(self, register):
-        if (isinstance(register, int) and
-                LLIL_REG_IS_TEMP(register)):
-            reg_value = self._regs.get(register)
-
-            if reg_value is None:
-                raise errors.UndefinedError(
-                    'Register {} not defined'.format(
-                        LLIL_GET_TEMP_REG_INDEX(register)
-                    )
-                )
+    def set_flag_value(self, flag, value):
+        lazy = self._lazy_flags
+        if lazy is not None and flag in lazy.written:
+            self._settle_flags()
 
-            return reg_value
+        self._flags[flag] = value
+        return value
 
-        if isinstance(register, ILRegister):
-            if not LLIL_REG_IS_TEMP(register.index):
-                register = register.name
-            else:
-                reg_value = self._regs.get(register.index)
-                if reg_value is None:
-                    raise errors.UndefinedError(
-                        'Register {} not defined'.format(
-                            LLIL_GET_TEMP_REG_INDEX(register)
-                        )
-                    )
-                return reg_value
+    def get_flag_value(self, flag):
+        lazy = self._lazy_flags
+        if lazy is not None and flag in lazy.written:
+            return lazy.compute(self._flag_roles.get(flag))
 
-        reg_info = self._function.arch.regs[register]
+        # Assume that any previously unset flag is False
+        value = self._flags.get(flag, False)
+        return value
 
-        full_reg_value = self._regs.get(reg_info.full_width_reg)
+    def _write_flags(self, lazy):
+        # Called by every flag writing operation. Flags the previous
+        # operation wrote and this one doesn't are computed now, since
+        # its record is about to be dropped.
+        previous = self._lazy_flags
 
-        if full_reg_value is None:
-            raise errors.UndefinedError(
-                'Register {} not defined'.format(
-                    register
-                )
-            )
+        if (previous is not None and previous.written is not lazy.written
+                and not previous.written <= lazy.written):
+            roles = self._flag_roles
+            for flag in previous.written - lazy.written:
+                self._flags[flag] = previous.compute(roles.get(flag))
 
-        mask = (1 << reg_info.size * 8) - 1
+        self._lazy_flags = lazy
 
-        if register == reg_info.full_width_reg:
-            return full_reg_value & mask
+    def _settle_flags(self):
+        lazy = self._lazy_flags
 
-        mask = (1 << reg_info.size * 8) - 1
-        reg_bits = mask << (reg_info.offset * 8)
+        if lazy is not None:
+            roles = self._flag_roles
+            for flag in lazy.written:
+                self._flags[flag] = lazy.compute(roles.get(flag))
+            self._lazy_flags = None
 
-        reg_value = (full_reg_value & reg_bits) >> (reg_info.offset * 8)
+    def _flag_values(self):
+        values = dict(self._flags)
 
-        return reg_value
+        lazy = self._lazy_flags
+        if lazy is not None:
+            for flag in lazy.written:
+                values[flag] = lazy.compute(self._flag_roles.get(flag))
 
-    def set_flag_value(self, flag, value):
-        self._flags[flag] = value
-        return value
+        return values
 
-    def get_flag_value(self, flag):
-        # Assume that any previously unset flag is False
-        value = self._flags.get(flag, False)
-        return value
+    def _flags_written_by(self, write_type):
+        # Shared per write type, so _write_flags can compare by identity
+        written = self._flags_written.get(write_type)
 
-    def read_memory(self, addr, length):
-        if length not in fmt:
-            raise ValueError('read length must be in (1,2,4,8)')
-
-        # XXX: Handle sizes > 8 bytes
-        pack_fmt = (
-            # XXX: Endianness string bug
-            '<' if self._function.arch.endianness == Endianness.LittleEndian
-            else ''
-        ) + fmt[length]
-
-        if addr not in self._memory:
-            raise errors.MemoryAccessError(
-                'Address {:x} is not valid.'.format(addr)
+        if written is None:
+            written = self._flags_written[write_type] = (
+                lazyflags.flags_written(self._function.arch, write_type)
             )
 
-        try:
-            return struct.unpack(
-                pack_fmt, self._memory.read(addr, length)
-            )[0]
-        except:
-            raise errors.MemoryAccessError(
-                'Could not read memory at {:x}'.format(addr)
-            )
+        return written
 
-    def write_memory(self, addr, data, length=None):
-        # XXX: This is terribly implemented
-        if addr not in self._memory:
-            raise errors.MemoryAccessError(
-                'Address {:x} is not valid.'.format(addr)
+    def _get_flag_by_role(self, role):
+        flag = self._role_flags.get(role)
+
+        if flag is not None:
+            return self.get_flag_value(flag)
+
+        if role == lazyflags.CARRY:
+            # Carry set on no borrow, as on ARM
+            flag = self._role_flags.get(lazyflags.INVERTED_CARRY)
+            if flag is not None:
+                return not self.get_flag_value(flag)
+
+        raise errors.UnimplementedError(
+            '{} has no flag with role {}'.format(
+                self._function.arch.name, role
             )
+        )
+
+    def read_memory(self, addr, length):
+        decode = get_codec(self._little_endian, length)[0]
+        return decode(self._memory.read(addr, length))
 
+    def write_memory(self, addr, data, length=None):
         if isinstance(data, (int, long)):
-            if length not in (1, 2, 4, 8):
-                raise KeyError('length is not 1, 2, 4, or 8.')
+            encode = get_codec(self._little_endian, length)[1]
+            data = encode(data)
 
-            # XXX: Handle sizes > 8 bytes
-            pack_fmt = (
-                # XXX: Endianness string bug
-                '<' if self._function.arch.endianness == Endianness.LittleEndian
-                else ''
-            ) + fmt[length]
+        self._memory.write(addr, data)
+
+        return True
 
-            data = struct.pack(pack_fmt, data)
+    def read_block(self, addr, length):
+        # Returns a memoryview; it aliases page data when the block lies
+        # within one page, so it must not be held across writes.
+        return self._memory.read_block(addr, length)
 
+    def write_block(self, addr, data):
         self._memory.write(addr, data)
-
         return True
 
+    def _memory_reader(self, length):
+        # Closures used by compiled LLIL_LOAD/LLIL_STORE
+        decode = get_codec(self._little_endian, length)[0]
+        read = self._memory.read
+
+        if self._read_hooks:
+            find = self._read_hooks.overlapping
+
+            def read_memory(addr):
+                for hook in find(addr, addr + length):
+                    hook(self, addr, length)
+                return decode(read(addr, length))
+
+        else:
+            def read_memory(addr):
+                return decode(read(addr, length))
+
+        return read_memory
+
+    def _memory_writer(self, length):
+        encode = get_codec(self._little_endian, length)[1]
+        write = self._memory.write
+
+        if self._write_hooks:
+            find = self._write_hooks.overlapping
+
+            def write_memory(addr, value):
+                for hook in find(addr, addr + length):
+                    hook(self, addr, length, value)
+                write(addr, encode(value))
+                return True
+
+        else:
+            def write_memory(addr, value):
+                write(addr, encode(value))
+                return True
+
+        return write_memory
+
+    def snapshot(self):
+        return Snapshot(
+            list(self._regs), list(self._temps), dict(self._flags),
+            self._lazy_flags, self.instr_index, self._function,
+            self._memory.snapshot(), list(self._frames)
+        )
+
+    def restore(self, snapshot):
+        # Compiled code holds on to the register arrays, so they are
+        # refilled in place rather than replaced.
+        self._regs[:] = snapshot.regs
+        self._temps[:] = snapshot.temps
+        self._flags.clear()
+        self._flags.update(snapshot.flags)
+        self._lazy_flags = snapshot.lazy_flags
+        self.instr_index = snapshot.instr_index
+        self._function = snapshot.function
+        self._frames[:] = snapshot.frames
+        self._move_memory(self._memory.restore, snapshot.memory)
+
+    def save_checkpoint(self, path):
+        # Writes registers, flags, the call stack, the current position
+        # and mapped memory to path (see checkpoint.py), for an emulator
+        # on the same view, or base image, to carry on from.
+        lazy = self._lazy_flags
+
+        if lazy is not None:
+            lazy = [
+                sorted(lazy.written), lazy.operation, lazy.size, lazy.left,
+                lazy.right, lazy.carry, lazy.result
+            ]
+
+        state = {
+            'registers': self._layout.names,
+            'regs': self._regs,
+            'temps': self._temps,
+            'flags': sorted(self._flags.items()),
+            'lazy_flags': lazy,
+            'function': _function_start(self._function),
+            'instr_index': self.instr_index,
+            'frames': [
+                [_function_start(frame.function), frame.instr_index,
+                 frame.return_address]
+                for frame in self._frames
+            ],
+        }
+
+        checkpoint.save(path, state, self._memory, self._segment_loader)
+
+    def load_checkpoint(self, path):
+        # Memory is only read from the checkpoint as it is touched
+        state, ranges = checkpoint.load(path, self._segment_loader)
+
+        if list(state['registers']) != list(self._layout.names):
+            raise ValueError(
+                '{} was saved by an emulator for another '
+                'architecture'.format(path)
+            )
+
+        known = dict(
+            (_function_start(function), function)
+            for function in [self._function] + [
+                frame.function for frame in self._frames
+            ]
+        )
+
+        def resolve(start):
+            function = known.get(start)
+            if function is None:
+                function = known[start] = self._callees.get(start)
+            return function
+
+        self._regs[:] = state['regs']
+        self._temps[:] = state['temps']
+        self._flags.clear()
+        self._flags.update((flag, value) for flag, value in state['flags'])
+
+        lazy = state['lazy_flags']
+        if lazy is not None:
+            lazy = lazyflags.LazyFlags(frozenset(lazy[0]), *lazy[1:])
+        self._lazy_flags = lazy
+
+        self._function = resolve(state['function'])
+        self.instr_index = state['instr_index']
+        self._frames[:] = [
+            Frame(resolve(start), instr_index, return_address)
+            for start, instr_index, return_address in state['frames']
+        ]
+
+        # Replacing memory isn't a write to the code, but nothing compiled
+        # before can be trusted to match what is mapped afterwards
+        self._flush_code()
+        self._memory.replace(ranges)
+
     def execute_instruction(self):
         # Execute the current IL instruction
-        instruction = self._function[self.instr_index]
+        index = self.instr_index
+
+        try:
+            code = self._code[self._function][index]
+        except (KeyError, IndexError):
+            code = None
+
+        if code is None:
+            code = self._compile_instruction(self._function, index)
 
         # increment to next instruction (can be changed by instruction)
-        self.instr_index += 1
+        self.instr_index = index + 1
+
+        code()
+
+    def _hooked(self):
+        # Whether any hook can run in the middle of an instruction
+        return bool(self._hooks or self._code_hooks or self._read_hooks or
+                    self._write_hooks)
+
+    def _compile_instruction(self, function, index):
+        instruction = function[index]
+
+        code = self._code.get(function)
+
+        if code is None:
+            code = self._code[function] = []
+            self._watch_code(function)
+
+        if len(code) <= index:
+            code.extend([None] * (len(function) - len(code)))
+
+        if self._optimizer is not None and not self._hooked():
+            compiled = self._compiler.compile(
+                self._optimizer.optimize(function)[index]
+            )
+        else:
+            compiled = self._compiler.compile(instruction)
+
+        if self._code_hooks:
+            found = self._code_hooks.find(instruction.address)
+            if found:
+                compiled = self._hook_code(
+                    compiled, instruction.address, found
+                )
+
+        if (self._coverage is not None and
+                instruction.operation.name in edgecoverage.EDGES):
+            compiled = self._coverage.instrument(
+                compiled, self, function, _function_start
+            )
+
+        if self._profiler is not None:
+            compiled = self._profiler.instruction(
+                function, _function_start(function), index, compiled
+            )
+
+        if self._tracer is not None:
+            compiled = self._trace_code(
+                compiled, function, index, instruction.address
+            )
+
+        code[index] = compiled
+
+        return compiled
 
-        self.visit(instruction)
+    def _hook_code(self, compiled, address, found):
+        def code():
+            for hook in found:
+                hook(self, address)
+            return compiled()
+
+        return code
+
+    def _trace_code(self, compiled, function, index, address):
+        record = self._tracer.instruction
+        start = _function_start(function)
+
+        def code():
+            record(start, index, address)
+            return compiled()
+
+        return code
+
+    def _rebuild_dispatch(self):
+        super(Emilator, self)._rebuild_dispatch()
+
+        # Compiled code only falls back to visit() for hooked operations
+        # if it was compiled after the hook was installed.
+        self._flush_code()
+
+    def _flush_code(self):
+        for watch in self._code_watches.values():
+            self._memory.unwatch(watch)
+
+        self._code = {}
+        self._code_watches = {}
+        self._translations.flush()
+
+    def _watch_code(self, function):
+        # Drops what was compiled for function when its instructions are
+        # written to, so none of it outlives the code it came from
+        addresses = [function[index].address for index in range(len(function))]
+
+        if not addresses:
+            return
+
+        start = min(addresses)
+        end = max(addresses)
+        end += self._instruction_length(end) or 1
+
+        self._code_watches[function] = self._memory.watch(
+            start, end - start,
+            lambda address, length: self._code_written(function, address)
+        )
+
+    def _move_memory(self, change, *args):
+        # Unmapping or restoring memory under code isn't the program
+        # writing to it: the code is dropped without a warning
+        self._moving_memory = True
+        try:
+            return change(*args)
+        finally:
+            self._moving_memory = False
+
+    def _drop_code(self, function):
+        watch = self._code_watches.pop(function, None)
+        if watch is not None:
+            self._memory.unwatch(watch)
+
+        self._code.pop(function, None)
+        self._translations.invalidate_function(function)
+
+    def _code_written(self, function, address):
+        self._drop_code(function)
+
+        if self._moving_memory:
+            return
+
+        # The IL is the view's, lifted from the original bytes, so it
+        # can't be lifted again from what was written
+        warnings.warn(
+            'Code at {:x} was written to after it was lifted'.format(address),
+            errors.SelfModifyingCodeWarning
+        )
+
+    def _instruction_length(self, address):
+        try:
+            length = self._view.get_instruction_length(
+                address, self._function.arch
+            )
+        except Exception:
+            length = 0
+
+        # 0 if the view can't decode it
+        return length or 0
 
     def run(self):
         while True:
             try:
-                yield self.execute_instruction()
+                self.execute_instruction()
+            except errors.StopEmulation:
+                return
             except IndexError:
-                if self.instr_index >= len(self.function):
-                    raise StopIteration()
-                else:
-                    raise
+                if self.instr_index >= len(self._function):
+                    return
+                raise
+
+            yield None
 
-    def _find_available_segment(self, size=0x1000, align=1):
-        new_segment = None
-        current_address = 0
-        max_address = (1 << (self._function.arch.address_size * 8)) - 1
-        align_mask = (1 << (self._function.arch.address_size * 8)) - align
+    def run_blocks(self):
+        # Like run(), but executes a whole translated basic block per step
+        block = None
 
-        while current_address < (max_address - size):
-            segment = self._view.get_segment_at(current_address)
+        while True:
+            try:
+                block = self._next_block(block)
+                result = block.code()
+            except errors.StopEmulation:
+                return
+            except IndexError:
+                if self.instr_index >= len(self._function):
+                    return
+                raise
+
+            yield result
+
+    def run_until(self, max_instructions=None, addresses=None, indexes=None,
+                  deadline=None, predicate=None):
+        # Runs without yielding until the function returns or runs off its
+        # end, max_instructions have run, the next instruction is at one
+        # of addresses or has one of indexes as its instr_index (in
+        # whichever function is current; not checked before the first
+        # instruction, so a run can resume from a breakpoint), time.time()
+        # passes deadline, or predicate(emulator) is true after an
+        # instruction. Returns a RunResult of why, and how many
+        # instructions ran.
+        count = [0]
+        checked = bool(addresses or indexes or predicate is not None)
+
+        try:
+            if checked:
+                reason = self._run_checked(
+                    count, max_instructions, addresses, indexes, deadline,
+                    predicate
+                )
+            else:
+                reason = self._run_unchecked(count, max_instructions, deadline)
 
-            if segment is not None:
-                current_address = (segment.end + align) & align_mask
-                continue
+        except errors.StopEmulation:
+            reason = STOP_RETURN
 
-            segment_end = current_address + size - 1
+        except IndexError:
+            if self.instr_index < len(self._function):
+                raise
+            if checked:
+                # The last step ran off the end rather than executing
+                count[0] -= 1
+            reason = STOP_END
 
-            if self._view.get_segment_at(segment_end) is None:
-                new_segment = current_address
-                break
+        return RunResult(reason, count[0])
 
-        return new_segment
+    def _run_unchecked(self, count, max_instructions, deadline):
+        # Runs whole blocks, stepping single instructions only when a
+        # block would overrun max_instructions
+        execute = self.execute_instruction
+        next_block = self._next_block
+        block = None
+        interval = 0
+
+        while True:
+            if deadline is not None:
+                interval += 1
+                if interval >= DEADLINE_INTERVAL:
+                    interval = 0
+                    if time.time() >= deadline:
+                        return STOP_DEADLINE
+
+            block = next_block(block)
+            length = block.end - block.start
+
+            if max_instructions is not None:
+                remaining = max_instructions - count[0]
+
+                if remaining < length:
+                    for _ in range(remaining):
+                        count[0] += 1
+                        execute()
+                    return STOP_LIMIT
+
+            count[0] += length
+            block.code()
+
+    def _run_checked(self, count, max_instructions, addresses, indexes,
+                     deadline, predicate):
+        execute = self.execute_instruction
+        function = None
+        stops = indexes or ()
+        breakpoints = {}
+        interval = 0
+
+        while True:
+            if max_instructions is not None and count[0] >= max_instructions:
+                return STOP_LIMIT
+
+            if deadline is not None:
+                interval += 1
+                if interval >= DEADLINE_INTERVAL:
+                    interval = 0
+                    if time.time() >= deadline:
+                        return STOP_DEADLINE
+
+            if addresses and function is not self._function:
+                function = self._function
+                stops = breakpoints.get(function)
+
+                if stops is None:
+                    stops = breakpoints[function] = _breakpoint_indexes(
+                        function, addresses, indexes
+                    )
+
+            if count[0] and self.instr_index in stops:
+                return STOP_BREAKPOINT
+
+            count[0] += 1
+            execute()
+
+            if predicate is not None and predicate(self):
+                return STOP_PREDICATE
+
+    def _next_block(self, block):
+        # The translation to run after block, following (and making) the
+        # links between blocks of the same function
+        function = self._function
+        index = self.instr_index
+
+        next_block = None
+        if block is not None and block.function is function:
+            next_block = block.links.get(index)
+
+        if next_block is None or not next_block.valid:
+            # Raises IndexError past the end of the function
+            next_block = self._translations.lookup(function, index)
+
+            if block is not None and block.function is function:
+                block.links[index] = next_block
+
+        return next_block
+
+    def visit_LLIL_NOP(self, expr):
+        return None
 
     def visit_LLIL_SET_REG(self, expr):
         value = self.visit(expr.src)
@@ -329,10 +1022,10 @@ class Emilator(llilvisitor.LLILVisitor):
 
         sp_value = self.get_register_value(sp)
 
-        self.write_memory(sp_value, value, expr.size)
-
         sp_value -= expr.size
 
+        self.write_memory(sp_value, value, expr.size)
+
         return self.set_register_value(sp, sp_value)
 
     def visit_LLIL_POP(self, expr):
@@ -340,10 +1033,10 @@ class Emilator(llilvisitor.LLILVisitor):
 
         sp_value = self.get_register_value(sp)
 
-        sp_value += expr.size
-
         value = self.read_memory(sp_value, expr.size)
 
+        sp_value += expr.size
+
         self.set_register_value(sp, sp_value)
 
         return value
@@ -392,22 +1085,34 @@ class Emilator(llilvisitor.LLILVisitor):
         return left > right
 
     def visit_LLIL_ADD(self, expr):
+        if expr.flags:
+            return self._visit_arithmetic(expr)
+
         left = self.visit(expr.left)
         right = self.visit(expr.right)
         mask = (1 << expr.size * 8) - 1
         return (left + right) & mask
 
     def visit_LLIL_AND(self, expr):
+        if expr.flags:
+            return self._visit_arithmetic(expr)
+
         left = self.visit(expr.left)
         right = self.visit(expr.right)
         return left & right
 
     def visit_LLIL_OR(self, expr):
+        if expr.flags:
+            return self._visit_arithmetic(expr)
+
         left = self.visit(expr.left)
         right = self.visit(expr.right)
         return left | right
 
     def visit_LLIL_SUB(self, expr):
+        if expr.flags:
+            return self._visit_arithmetic(expr)
+
         left = self.visit(expr.left)
         right = self.visit(expr.right)
         return left - right
@@ -421,10 +1126,17 @@ class Emilator(llilvisitor.LLILVisitor):
         flag = expr.src.index
         return self.get_flag_value(flag)
 
+    def visit_LLIL_FLAG_COND(self, expr):
+        condition = lazyflags.CONDITIONS.get(expr.condition)
+
+        if condition is None:
+            return self.visit_unimplemented(expr)
+
+        return condition(self._get_flag_by_role)
+
     def visit_LLIL_RET(self, expr):
-        # we'll stop for now, but this will need to retrieve the return
-        # address and jump to it.
-        raise StopIteration
+        target = self.visit(expr.dest)
+        return self._return(target)
 
     def visit_LLIL_CALL(self, expr):
         target = self.visit(expr.dest)
@@ -433,18 +1145,160 @@ class Emilator(llilvisitor.LLILVisitor):
             self._function_hooks[target](self)
             return True
 
-        target_function = self._view.get_function_at(target)
+        if len(self._frames) >= self.max_call_depth:
+            raise errors.CallDepthError(
+                'Call to {:x} exceeds the maximum call depth of {}'.format(
+                    target, self.max_call_depth
+                )
+            )
+
+        return_address = self._return_address(expr)
+        self._push_return_address(return_address)
+
+        self._frames.append(
+            Frame(self._function, self.instr_index, return_address)
+        )
+
+        return self._enter(target)
+
+    def visit_LLIL_TAILCALL(self, expr):
+        target = self.visit(expr.dest)
+        return self._tail_call(target)
+
+    def visit_LLIL_JUMP(self, expr):
+        target = self.visit(expr.dest)
+        return self._jump(target)
+
+    def visit_LLIL_JUMP_TO(self, expr):
+        target = self.visit(expr.dest)
+
+        # Newer APIs map target addresses to indexes; older ones only
+        # list the indexes, which _jump() finds anyway.
+        targets = expr.targets
+        if isinstance(targets, dict) and target in targets:
+            self.instr_index = targets[target]
+            return True
+
+        return self._jump(target)
+
+    def _fetch(self, target):
+        # Control flow into mapped memory needs it to be executable. Code
+        # that only the view has, with nothing mapped over it, runs as
+        # lifted.
+        if target in self._memory:
+            self._memory.fetch(target, 1)
 
-        if not target_function:
-            self._view.create_user_function(target)
-            self._view.update_analysis_and_wait()
-            target_function = self._view.get_function_at(target)
+    def _enter(self, target):
+        self._fetch(target)
 
-        self._function = target_function.low_level_il
+        # The other calls this function makes are lifted in the
+        # background while this one runs, as are the callee's.
+        callees = self._callees
+        callees.prefetch(self._function)
+
+        self._function = callees.get(target)
         self.instr_index = 0
 
+        callees.prefetch(self._function)
+
+        if self._profiler is not None:
+            self._profiler.enter(_function_start(self._function))
+
         return True
 
+    def _jump(self, target):
+        self._fetch(target)
+
+        index = self._function.get_instruction_start(
+            target, self._function.arch
+        )
+
+        if index is not None:
+            self.instr_index = index
+            return True
+
+        # Jumping out of the function is a tail call
+        return self._tail_call(target)
+
+    def _tail_call(self, target):
+        if target in self._function_hooks:
+            # The hook stands in for the whole callee, return included
+            self._function_hooks[target](self)
+            return self._return(self._pop_return_address())
+
+        return self._enter(target)
+
+    def _return(self, target):
+        frames = self._frames
+
+        if not frames:
+            raise errors.StopEmulation()
+
+        # Usually the innermost frame; anything else (longjmp and the
+        # like) unwinds to the frame being returned to. A return to no
+        # frame's return address stops, with the stack left as it was:
+        # jumping there could enter a function part way through.
+        for depth in range(len(frames) - 1, -1, -1):
+            if frames[depth].return_address == target:
+                break
+        else:
+            raise errors.StopEmulation(
+                'Return to {:x}, which no frame returns to'.format(target)
+            )
+
+        frame = frames[depth]
+        del frames[depth:]
+
+        self._function = frame.function
+        self.instr_index = frame.instr_index
+
+        return True
+
+    def _return_address(self, expr):
+        # The address after the call: from its length if the view can
+        # decode it, otherwise from the IL lifted after it, which
+        # instr_index already points at.
+        length = self._instruction_length(expr.address)
+
+        if length:
+            return expr.address + length
+
+        function = self._function
+
+        for index in range(self.instr_index, len(function)):
+            address = function[index].address
+            if address != expr.address:
+                return address
+
+        raise errors.UndefinedError(
+            'No return address for the call at {:x}'.format(expr.address)
+        )
+
+    def _push_return_address(self, address):
+        arch = self._function.arch
+
+        if arch.link_reg is not None:
+            self.set_register_value(arch.link_reg, address)
+            return
+
+        sp = arch.stack_pointer
+        sp_value = self.get_register_value(sp) - arch.address_size
+        self.write_memory(sp_value, address, arch.address_size)
+        self.set_register_value(sp, sp_value)
+
+    def _pop_return_address(self):
+        arch = self._function.arch
+
+        if arch.link_reg is not None:
+            return self.get_register_value(arch.link_reg)
+
+        sp = arch.stack_pointer
+        sp_value = self.get_register_value(sp)
+        address = self.read_memory(sp_value, arch.address_size)
+        self.set_register_value(sp, sp_value + arch.address_size)
+
+        return address
+
     def visit_LLIL_SX(self, expr):
         orig_value = self.visit(expr.src)
         sign_bit = 1 << ((expr.size * 8) - 1)
@@ -455,31 +1309,76 @@ class Emilator(llilvisitor.LLILVisitor):
         return self.visit(expr.src)
 
     def visit_LLIL_XOR(self, expr):
+        if expr.flags:
+            return self._visit_arithmetic(expr)
+
         left = self.visit(expr.left)
         right = self.visit(expr.right)
         return left ^ right
 
     def visit_LLIL_LSL(self, expr):
+        if expr.flags:
+            return self._visit_arithmetic(expr)
+
         mask = (1 << expr.size * 8) - 1
         left = self.visit(expr.left)
         right = self.visit(expr.right)
         return (left << right) & mask
 
     def visit_LLIL_LSR(self, expr):
+        if expr.flags:
+            return self._visit_arithmetic(expr)
+
         left = self.visit(expr.left)
         right = self.visit(expr.right)
         return left >> right
 
+    def _visit_arithmetic(self, expr):
+        # Any operation in lazyflags.OPERATIONS, recording its flags
+        name = expr.operation.name
+        bits = expr.size * 8
+        mask = (1 << bits) - 1
+
+        if name in lazyflags.UNARY:
+            left = self.visit(expr.src) & mask
+            right = 0
+        else:
+            left = self.visit(expr.left) & mask
+            right = self.visit(expr.right) & mask
+
+        carry = 0
+        if name in lazyflags.WITH_CARRY:
+            carry = int(self.visit(expr.carry))
+
+        result = lazyflags.OPERATIONS[name](left, right, carry, bits)
+
+        if expr.flags:
+            self._write_flags(lazyflags.LazyFlags(
+                self._flags_written_by(expr.flags), name, expr.size, left,
+                right, carry, result
+            ))
+
+        return result & mask
+
+    visit_LLIL_ADC = _visit_arithmetic
+    visit_LLIL_SBB = _visit_arithmetic
+    visit_LLIL_ASR = _visit_arithmetic
+    visit_LLIL_ROL = _visit_arithmetic
+    visit_LLIL_ROR = _visit_arithmetic
+    visit_LLIL_MUL = _visit_arithmetic
+    visit_LLIL_NEG = _visit_arithmetic
+    visit_LLIL_NOT = _visit_arithmetic
+
 
 if __name__ == '__main__':
     il = LowLevelILFunction(Architecture['x86_64'])
     emi = Emilator(il)
 
     emi.set_register_value('rbx', -1)
-    emi.set_register_value('rsp', 0x1000)
+    emi.set_register_value('rsp', 0x2000)
 
     print '[+] Mapping memory at 0x1000 (size: 0x1000)...'
-    emi.map_memory(0x1000, flags=SegmentFlag.SegmentReadable)
+    emi.map_memory(0x1000)
 
     print '[+] Initial Register State:'
     for r, v in emi.registers.iteritems():
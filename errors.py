@@ -7,4 +7,18 @@ class MemoryAccessError(Exception):
         self.address = kwargs.get('address', None)
 
 class UndefinedError(Exception):
-    pass
\ No newline at end of file
+    pass
+
+class CallDepthError(Exception):
+    pass
+
+class SelfModifyingCodeWarning(UserWarning):
+    # Emulated code wrote to instructions of a function it had run. What
+    # was compiled for the function is dropped, but the IL is unchanged.
+    pass
+
+class StopEmulation(StopIteration):
+    # The outermost function returned, or a return went somewhere no call
+    # frame returns to. A StopIteration, for code that drives
+    # execute_instruction() itself.
+    pass
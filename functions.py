@@ -0,0 +1,166 @@
+import Queue
+import threading
+import time
+
+try:
+    from binaryninja import BinaryDataNotification
+except ImportError:
+    # Offline views come with every function already lifted
+    BinaryDataNotification = object
+
+import errors
+
+CALLS = frozenset(['LLIL_CALL', 'LLIL_TAILCALL'])
+CONSTANTS = frozenset(['LLIL_CONST', 'LLIL_CONST_PTR'])
+
+
+class FunctionCache(object):
+    # Maps call targets to their lifted LowLevelILFunction. Targets of
+    # constant calls in a function can be queued with prefetch(), and are
+    # lifted on a background thread that exits once the queue drains.
+    def __init__(self, view, timeout=30.0):
+        self._view = view
+        self._timeout = timeout
+
+        self._functions = {}
+        self._scanned = set()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._queue = Queue.Queue()
+        self._thread = None
+
+    def __contains__(self, address):
+        return address in self._functions
+
+    def get(self, address, timeout=None):
+        # timeout (seconds, the cache's own by default) bounds the wait for
+        # the view to analyse a function it didn't have yet
+        function = self._functions.get(address)
+
+        if function is not None:
+            return function
+
+        with self._lock:
+            pending = self._pending.get(address)
+
+        if pending is not None:
+            # Being lifted in the background already
+            pending.wait()
+            function = self._functions.get(address)
+            if function is not None:
+                return function
+
+        return self._lift(address, timeout)
+
+    def add(self, address, function):
+        with self._lock:
+            return self._functions.setdefault(address, function)
+
+    def prefetch(self, function):
+        # Queues the constant call targets in function, once per function
+        if function in self._scanned:
+            return
+        self._scanned.add(function)
+
+        targets = set()
+        for instruction in function.instructions:
+            if instruction.operation.name not in CALLS:
+                continue
+
+            dest = instruction.dest
+            if dest.operation.name in CONSTANTS:
+                targets.add(dest.constant)
+
+        with self._lock:
+            for target in targets:
+                if target in self._functions or target in self._pending:
+                    continue
+                self._pending[target] = threading.Event()
+                self._queue.put(target)
+
+            if self._pending and self._thread is None:
+                self._thread = threading.Thread(target=self._work)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _work(self):
+        while True:
+            with self._lock:
+                if self._queue.empty():
+                    self._thread = None
+                    return
+                address = self._queue.get_nowait()
+
+            try:
+                self._lift(address)
+            except Exception:
+                # get() lifts it again, and reports the failure, if the
+                # emulator ever calls it
+                pass
+            finally:
+                with self._lock:
+                    event = self._pending.pop(address)
+                event.set()
+
+    def _lift(self, address, timeout=None):
+        function = self._view.get_function_at(address)
+
+        if function is None:
+            function = self._create_function(address, timeout)
+
+        return self.add(address, function.low_level_il)
+
+    def _create_function(self, address, timeout=None):
+        # Only the new function needs analysing, so it is queued on its
+        # own, and waited for through the view's notifications about it,
+        # rather than updating analysis of the whole view.
+        view = self._view
+
+        if timeout is None:
+            timeout = self._timeout
+        deadline = time.time() + timeout
+
+        analysed = _FunctionAnalysed(address)
+        view.register_notification(analysed)
+
+        try:
+            view.create_user_function(address)
+            function = view.get_function_at(address)
+            if function is not None:
+                function.reanalyze()
+
+            while True:
+                function = view.get_function_at(address)
+                if function is not None and len(function.low_level_il):
+                    return function
+
+                remaining = deadline - time.time()
+                if remaining <= 0 or not analysed.wait(remaining):
+                    raise errors.UndefinedError(
+                        'No function at {:x} after {}s of analysis'.format(
+                            address, timeout
+                        )
+                    )
+
+        finally:
+            view.unregister_notification(analysed)
+
+
+class _FunctionAnalysed(BinaryDataNotification):
+    # Wakes _create_function() whenever the view reports the function at
+    # address added or updated
+    def __init__(self, address):
+        super(_FunctionAnalysed, self).__init__()
+        self._address = address
+        self._event = threading.Event()
+
+    def wait(self, timeout):
+        updated = self._event.wait(timeout)
+        self._event.clear()
+        return updated
+
+    def function_added(self, view, function):
+        if function.start == self._address:
+            self._event.set()
+
+    function_updated = function_added
@@ -0,0 +1,74 @@
+import bisect
+
+
+class IntervalIndex(object):
+    # Maps [start, end) address ranges to hooks. The ranges are cut into
+    # elementary segments, each holding the tuple of hooks covering it,
+    # so a lookup is a single bisect. The segments are rebuilt lazily
+    # after the ranges change.
+    def __init__(self):
+        self._intervals = []
+        self._points = None
+        self._segments = None
+
+    def __len__(self):
+        return len(self._intervals)
+
+    def __iter__(self):
+        return iter(self._intervals)
+
+    def add(self, start, end, hook):
+        self._intervals.append((start, end, hook))
+        self._points = None
+
+    def remove(self, start, end, hook):
+        self._intervals.remove((start, end, hook))
+        self._points = None
+
+    def _build(self):
+        points = set()
+        for start, end, hook in self._intervals:
+            points.add(start)
+            points.add(end)
+        points = sorted(points)
+
+        segments = [[] for _ in points]
+        for start, end, hook in self._intervals:
+            first = bisect.bisect_left(points, start)
+            last = bisect.bisect_left(points, end)
+            for segment in range(first, last):
+                segments[segment].append(hook)
+
+        self._segments = [tuple(segment) for segment in segments]
+        self._points = points
+
+    def find(self, address):
+        # Hooks whose range contains address
+        if self._points is None:
+            self._build()
+
+        segment = bisect.bisect_right(self._points, address) - 1
+
+        if segment < 0:
+            return ()
+
+        return self._segments[segment]
+
+    def overlapping(self, start, end):
+        # Hooks whose range overlaps [start, end)
+        if self._points is None:
+            self._build()
+
+        first = max(bisect.bisect_right(self._points, start) - 1, 0)
+        last = bisect.bisect_left(self._points, end)
+
+        if last - first == 1:
+            return self._segments[first]
+
+        found = []
+        for segment in self._segments[first:last]:
+            for hook in segment:
+                if hook not in found:
+                    found.append(hook)
+
+        return tuple(found)
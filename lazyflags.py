@@ -0,0 +1,205 @@
+try:
+    from binaryninja import FlagRole, LowLevelILFlagCondition
+except ImportError:
+    from offline import FlagRole, LowLevelILFlagCondition
+
+# Lazy flags: an operation that writes flags only records what it was
+# (LazyFlags below); a flag is worked out from that record, by its role,
+# when something reads it. Most flag writes are overwritten unread.
+
+ZERO = FlagRole.ZeroFlagRole
+POSITIVE = FlagRole.PositiveSignFlagRole
+NEGATIVE = FlagRole.NegativeSignFlagRole
+CARRY = FlagRole.CarryFlagRole
+INVERTED_CARRY = FlagRole.CarryFlagWithInvertedSubtractRole
+OVERFLOW = FlagRole.OverflowFlagRole
+HALF_CARRY = FlagRole.HalfCarryFlagRole
+EVEN_PARITY = FlagRole.EvenParityFlagRole
+ODD_PARITY = FlagRole.OddParityFlagRole
+
+
+def _rotate_left(left, right, carry, bits):
+    right %= bits
+    return (left << right) | (left >> (bits - right))
+
+
+def _rotate_right(left, right, carry, bits):
+    right %= bits
+    return (left >> right) | (left << (bits - right))
+
+
+def _arithmetic_shift_right(left, right, carry, bits):
+    sign_bit = 1 << (bits - 1)
+    return ((left & (sign_bit - 1)) - (left & sign_bit)) >> right
+
+
+# name -> (left, right, carry, bits) -> unmasked result, for operations
+# whose flags can be computed. Operands are already masked to size.
+OPERATIONS = {
+    'LLIL_ADD': lambda l, r, c, bits: l + r,
+    'LLIL_ADC': lambda l, r, c, bits: l + r + c,
+    'LLIL_SUB': lambda l, r, c, bits: l - r,
+    'LLIL_SBB': lambda l, r, c, bits: l - r - c,
+    'LLIL_AND': lambda l, r, c, bits: l & r,
+    'LLIL_OR': lambda l, r, c, bits: l | r,
+    'LLIL_XOR': lambda l, r, c, bits: l ^ r,
+    'LLIL_LSL': lambda l, r, c, bits: l << r,
+    'LLIL_LSR': lambda l, r, c, bits: l >> r,
+    'LLIL_ASR': _arithmetic_shift_right,
+    'LLIL_ROL': _rotate_left,
+    'LLIL_ROR': _rotate_right,
+    'LLIL_MUL': lambda l, r, c, bits: l * r,
+    'LLIL_NEG': lambda l, r, c, bits: -l,
+    'LLIL_NOT': lambda l, r, c, bits: ~l,
+}
+
+UNARY = frozenset(['LLIL_NEG', 'LLIL_NOT'])
+WITH_CARRY = frozenset(['LLIL_ADC', 'LLIL_SBB'])
+ADDITIONS = frozenset(['LLIL_ADD', 'LLIL_ADC'])
+SUBTRACTIONS = frozenset(['LLIL_SUB', 'LLIL_SBB', 'LLIL_NEG'])
+
+
+class LazyFlags(object):
+    # The last flag writing operation: which flags it wrote, and enough
+    # of its inputs to work any of them out.
+    __slots__ = ('written', 'operation', 'size', 'left', 'right', 'carry',
+                 'result')
+
+    def __init__(self, written, operation, size, left, right, carry,
+                 result):
+        self.written = written
+        self.operation = operation
+        self.size = size
+        self.left = left
+        self.right = right
+        self.carry = carry
+        self.result = result
+
+    def compute(self, role):
+        operation = self.operation
+        bits = self.size * 8
+        mask = (1 << bits) - 1
+        sign_bit = 1 << (bits - 1)
+        left = self.left
+        right = self.right
+        result = self.result & mask
+
+        if role == ZERO:
+            return result == 0
+
+        if role == NEGATIVE:
+            return bool(result & sign_bit)
+
+        if role == POSITIVE:
+            return not result & sign_bit
+
+        if role == CARRY or role == INVERTED_CARRY:
+            if operation in ADDITIONS:
+                return self.result > mask
+
+            if operation in SUBTRACTIONS:
+                if operation == 'LLIL_NEG':
+                    borrow = left != 0
+                else:
+                    borrow = left < right + self.carry
+                return borrow if role == CARRY else not borrow
+
+            if operation == 'LLIL_LSL':
+                return bool(0 < right <= bits and
+                            (left >> (bits - right)) & 1)
+
+            if operation in ('LLIL_LSR', 'LLIL_ASR'):
+                if right == 0:
+                    return False
+                value = left
+                if operation == 'LLIL_ASR':
+                    value = (left & (sign_bit - 1)) - (left & sign_bit)
+                return bool((value >> (right - 1)) & 1)
+
+            if operation == 'LLIL_ROL':
+                return bool(result & 1)
+
+            if operation == 'LLIL_ROR':
+                return bool(result & sign_bit)
+
+            if operation == 'LLIL_MUL':
+                return self.result > mask
+
+            return False
+
+        if role == OVERFLOW:
+            if operation in ADDITIONS:
+                return bool((left ^ result) & (right ^ result) & sign_bit)
+
+            if operation in SUBTRACTIONS:
+                if operation == 'LLIL_NEG':
+                    return left == sign_bit
+                return bool((left ^ right) & (left ^ result) & sign_bit)
+
+            if operation == 'LLIL_MUL':
+                signed_left = (left & (sign_bit - 1)) - (left & sign_bit)
+                signed_right = (right & (sign_bit - 1)) - (right & sign_bit)
+                product = signed_left * signed_right
+                return not -sign_bit <= product < sign_bit
+
+            return False
+
+        if role == HALF_CARRY:
+            return bool((left ^ right ^ result) & 0x10)
+
+        if role == EVEN_PARITY or role == ODD_PARITY:
+            even = bin(result & 0xff).count('1') % 2 == 0
+            return even if role == EVEN_PARITY else not even
+
+        return False
+
+
+def flag_roles(arch):
+    # flag index -> FlagRole
+    roles = {}
+
+    for name, role in arch.flag_roles.items():
+        roles[arch.get_flag_index(name)] = role
+
+    return roles
+
+
+def flags_written(arch, write_type):
+    # Flag write type name (an expression's .flags) -> frozenset of flag
+    # indexes
+    return frozenset(
+        arch.get_flag_index(flag)
+        for flag in arch.flags_written_by_flag_write_type.get(write_type, ())
+    )
+
+
+# Flag conditions in terms of the flags' roles. Each takes a function
+# reading the flag with a given role.
+CONDITIONS = {
+    LowLevelILFlagCondition.LLFC_E: lambda flag: flag(ZERO),
+    LowLevelILFlagCondition.LLFC_NE: lambda flag: not flag(ZERO),
+    LowLevelILFlagCondition.LLFC_NEG: lambda flag: flag(NEGATIVE),
+    LowLevelILFlagCondition.LLFC_POS: lambda flag: not flag(NEGATIVE),
+    LowLevelILFlagCondition.LLFC_O: lambda flag: flag(OVERFLOW),
+    LowLevelILFlagCondition.LLFC_NO: lambda flag: not flag(OVERFLOW),
+    LowLevelILFlagCondition.LLFC_SLT: (
+        lambda flag: flag(NEGATIVE) != flag(OVERFLOW)
+    ),
+    LowLevelILFlagCondition.LLFC_SGE: (
+        lambda flag: flag(NEGATIVE) == flag(OVERFLOW)
+    ),
+    LowLevelILFlagCondition.LLFC_SLE: (
+        lambda flag: flag(ZERO) or flag(NEGATIVE) != flag(OVERFLOW)
+    ),
+    LowLevelILFlagCondition.LLFC_SGT: (
+        lambda flag: not flag(ZERO) and flag(NEGATIVE) == flag(OVERFLOW)
+    ),
+    LowLevelILFlagCondition.LLFC_ULT: lambda flag: flag(CARRY),
+    LowLevelILFlagCondition.LLFC_UGE: lambda flag: not flag(CARRY),
+    LowLevelILFlagCondition.LLFC_ULE: (
+        lambda flag: flag(CARRY) or flag(ZERO)
+    ),
+    LowLevelILFlagCondition.LLFC_UGT: (
+        lambda flag: not flag(CARRY) and not flag(ZERO)
+    ),
+}
@@ -0,0 +1,299 @@
+import errors
+import memory
+
+try:
+    from binaryninja import SymbolType
+except ImportError:
+    from offline import SymbolType
+
+# Symbols naming code a call can land on; import address (GOT/IAT)
+# entries are data and never called directly.
+CALLABLE_SYMBOLS = frozenset([
+    SymbolType.FunctionSymbol, SymbolType.ImportedFunctionSymbol,
+    SymbolType.ExternalSymbol
+])
+
+HEAP_CHUNK = 0x10000
+HEAP_ALIGNMENT = 16
+MMAP_THRESHOLD = 0x20000
+
+
+def install(emulator, calling_convention=None, heap_base=None):
+    # Binds the models below to every matching function symbol in the
+    # emulator's view and returns the LibC instance doing the work.
+    library = LibC(emulator, calling_convention, heap_base)
+    library.install()
+    return library
+
+
+class Heap(object):
+    # A bump allocator over chunks the emulator maps wherever there is
+    # room, with exact size free lists for reuse. Blocks of at least
+    # MMAP_THRESHOLD bytes get a mapping of their own, which free
+    # unmaps. With a base, the first chunk is mapped there.
+    def __init__(self, emulator, base=None, alignment=HEAP_ALIGNMENT,
+                 chunk=HEAP_CHUNK):
+        self._emulator = emulator
+        self._base = base
+        self._alignment = alignment
+        self._chunk = chunk
+
+        self._next = 0
+        self._end = 0
+        self._free = {}
+        self._allocations = {}
+        self._mapped = set()
+
+    def __contains__(self, address):
+        return address in self._allocations
+
+    def size(self, address):
+        return self._allocations[address]
+
+    def allocate(self, size):
+        alignment = self._alignment
+        size = max(_align(size, alignment), alignment)
+
+        if size >= MMAP_THRESHOLD:
+            address = self._emulator.map_memory(None, size)
+            self._mapped.add(address)
+
+        else:
+            free = self._free.get(size)
+            if free:
+                address = free.pop()
+            else:
+                address = self._extend(size)
+
+        self._allocations[address] = size
+
+        return address
+
+    def release(self, address):
+        size = self._allocations.pop(address, None)
+
+        if size is None:
+            raise errors.MemoryAccessError(
+                'free of {:x}, which is not an allocation'.format(address),
+                address=address
+            )
+
+        if address in self._mapped:
+            self._mapped.remove(address)
+            self._emulator.unmap_memory(address, size)
+        else:
+            self._free.setdefault(size, []).append(address)
+
+    def _extend(self, size):
+        if self._next + size > self._end:
+            length = _align(max(size, self._chunk), memory.PAGE_SIZE)
+            self._next = self._emulator.map_memory(self._base, length)
+            self._end = self._next + length
+            self._base = None
+
+        address = self._next
+        self._next += size
+
+        return address
+
+
+class LibC(object):
+    # Python models of libc routines, run as function hooks. Arguments
+    # and the return value follow the calling convention: integer
+    # argument registers first, then the stack. Since a hooked call
+    # pushes no return address, stack arguments start at the stack
+    # pointer.
+    MODELS = {
+        'memcpy': 3, 'memmove': 3, 'memset': 3, 'memcmp': 3,
+        'strlen': 1, 'strcmp': 2, 'strncmp': 3, 'strcpy': 2,
+        'malloc': 1, 'calloc': 2, 'free': 1, 'realloc': 2,
+    }
+
+    def __init__(self, emulator, calling_convention=None, heap_base=None):
+        self._emulator = emulator
+
+        arch = emulator.function.arch
+        self._address_size = arch.address_size
+        self._mask = (1 << arch.address_size * 8) - 1
+        self._stack_pointer = arch.stack_pointer
+
+        if calling_convention is None:
+            platform = getattr(emulator._view, 'platform', None)
+            if platform is not None:
+                calling_convention = platform.default_calling_convention
+
+        if calling_convention is not None:
+            self._arg_regs = [
+                str(reg) for reg in calling_convention.int_arg_regs
+            ]
+            self._return_reg = str(calling_convention.int_return_reg)
+        else:
+            self._arg_regs = []
+            self._return_reg = None
+
+        self.heap = Heap(emulator, heap_base)
+
+    def install(self):
+        # name -> [addresses] of what was bound
+        view = self._emulator._view
+        bound = {}
+
+        for name, arity in self.MODELS.items():
+            hook = self._hook(getattr(self, name), arity)
+
+            for symbol_name in (name, '_' + name):
+                for symbol in view.get_symbols_by_name(symbol_name):
+                    if symbol.type not in CALLABLE_SYMBOLS:
+                        continue
+
+                    self._emulator.register_function_hook(
+                        symbol.address, hook
+                    )
+                    bound.setdefault(name, []).append(symbol.address)
+
+        return bound
+
+    def _hook(self, model, arity):
+        def hook(emulator):
+            result = model(*[self.argument(i) for i in range(arity)])
+            if result is not None:
+                self.set_return_value(result)
+
+        return hook
+
+    def argument(self, index):
+        emulator = self._emulator
+
+        if index < len(self._arg_regs):
+            return emulator.get_register_value(self._arg_regs[index])
+
+        sp = emulator.get_register_value(self._stack_pointer)
+        index -= len(self._arg_regs)
+
+        return emulator.read_memory(
+            sp + index * self._address_size, self._address_size
+        )
+
+    def set_return_value(self, value):
+        if self._return_reg is None:
+            raise errors.UnimplementedError(
+                'No calling convention to return a value with'
+            )
+
+        self._emulator.set_register_value(
+            self._return_reg, value & self._mask
+        )
+
+    def _string(self, address, limit=None):
+        # The bytes at address up to, not including, the first NUL,
+        # read a page at a time
+        emulator = self._emulator
+        chunks = []
+        length = 0
+
+        while limit is None or length < limit:
+            current = address + length
+            chunk = memory.PAGE_SIZE - (current & memory.PAGE_MASK)
+            if limit is not None:
+                chunk = min(chunk, limit - length)
+
+            data = emulator.read_block(current, chunk).tobytes()
+            end = data.find(b'\x00')
+
+            if end >= 0:
+                chunks.append(data[:end])
+                break
+
+            chunks.append(data)
+            length += chunk
+
+        return b''.join(chunks)
+
+    def memcpy(self, dest, src, n):
+        if n:
+            self._emulator.write_block(
+                dest, self._emulator.read_block(src, n).tobytes()
+            )
+        return dest
+
+    # The source is copied out before anything is written, so overlap
+    # is already handled
+    memmove = memcpy
+
+    def memset(self, dest, c, n):
+        if n:
+            self._emulator.write_block(dest, bytearray([c & 0xff]) * n)
+        return dest
+
+    def memcmp(self, s1, s2, n):
+        if not n:
+            return 0
+        return _compare(
+            self._emulator.read_block(s1, n).tobytes(),
+            self._emulator.read_block(s2, n).tobytes()
+        )
+
+    def strlen(self, s):
+        return len(self._string(s))
+
+    def strcmp(self, s1, s2):
+        return _compare(
+            self._string(s1) + b'\x00', self._string(s2) + b'\x00'
+        )
+
+    def strncmp(self, s1, s2, n):
+        if not n:
+            return 0
+        return _compare(
+            (self._string(s1, n) + b'\x00')[:n],
+            (self._string(s2, n) + b'\x00')[:n]
+        )
+
+    def strcpy(self, dest, src):
+        self._emulator.write_block(dest, self._string(src) + b'\x00')
+        return dest
+
+    def malloc(self, size):
+        return self.heap.allocate(size)
+
+    def calloc(self, count, size):
+        size *= count
+        address = self.heap.allocate(size)
+        if size:
+            # Reused blocks aren't zero
+            self._emulator.write_block(address, bytearray(size))
+        return address
+
+    def free(self, address):
+        if address:
+            self.heap.release(address)
+
+    def realloc(self, address, size):
+        if not address:
+            return self.heap.allocate(size)
+
+        if not size:
+            self.heap.release(address)
+            return 0
+
+        old_size = self.heap.size(address)
+        if size <= old_size:
+            return address
+
+        new_address = self.heap.allocate(size)
+        self.memcpy(new_address, address, old_size)
+        self.heap.release(address)
+
+        return new_address
+
+
+def _compare(s1, s2):
+    # Difference of the first differing bytes, as libc returns it
+    for a, b in zip(bytearray(s1), bytearray(s2)):
+        if a != b:
+            return a - b
+    return 0
+
+
+def _align(value, alignment):
+    return (value + alignment - 1) & ~(alignment - 1)
@@ -0,0 +1,339 @@
+import lazyflags
+from bnilvisitor import BNILVisitor
+
+
+class LLILCompiler(BNILVisitor):
+    # Turns LLIL expression trees into closures over an Emilator. Every
+    # operand is read from the binaryninja objects once, at compile time;
+    # the closures only touch plain Python values and the emulator.
+    def __init__(self, emulator, **kwargs):
+        super(LLILCompiler, self).__init__(**kwargs)
+        self._emulator = emulator
+
+    def compile(self, expression):
+        if expression.operation in self._emulator._hooks:
+            code = None
+        elif (expression.flags and
+                expression.operation.name in lazyflags.OPERATIONS):
+            code = self._compile_arithmetic(expression)
+        else:
+            code = self.visit(expression)
+
+        if code is None:
+            code = self._fallback(expression)
+
+        profiler = self._emulator._profiler
+        if profiler is not None:
+            code = profiler.operation(expression.operation.name, code)
+
+        return code
+
+    def _fallback(self, expression):
+        emulator = self._emulator
+
+        def code():
+            return emulator.visit(expression)
+
+        return code
+
+    def _binary(self, expr):
+        return self.compile(expr.left), self.compile(expr.right)
+
+    def _compile_arithmetic(self, expr):
+        # Any operation in lazyflags.OPERATIONS. Flag writing ones leave a
+        # LazyFlags record behind instead of computing any flags.
+        emulator = self._emulator
+        name = expr.operation.name
+        size = expr.size
+        bits = size * 8
+        mask = (1 << bits) - 1
+        evaluate = lazyflags.OPERATIONS[name]
+
+        if name in lazyflags.UNARY:
+            src = self.compile(expr.src)
+            operands = lambda: (src() & mask, 0, 0)
+        elif name in lazyflags.WITH_CARRY:
+            left, right = self._binary(expr)
+            carry = self.compile(expr.carry)
+            operands = lambda: (left() & mask, right() & mask, int(carry()))
+        else:
+            left, right = self._binary(expr)
+            operands = lambda: (left() & mask, right() & mask, 0)
+
+        if not expr.flags:
+            def code():
+                return evaluate(*(operands() + (bits,))) & mask
+
+            return code
+
+        written = emulator._flags_written_by(expr.flags)
+        write_flags = emulator._write_flags
+        LazyFlags = lazyflags.LazyFlags
+
+        def code():
+            l, r, c = operands()
+            result = evaluate(l, r, c, bits)
+            write_flags(LazyFlags(written, name, size, l, r, c, result))
+            return result & mask
+
+        return code
+
+    def visit_LLIL_NOP(self, expr):
+        def code():
+            return None
+
+        return code
+
+    def visit_LLIL_SET_REG(self, expr):
+        src = self.compile(expr.src)
+        write = self._emulator._register_writer(expr.dest)
+
+        def code():
+            write(src())
+            return True
+
+        return code
+
+    def visit_LLIL_CONST(self, expr):
+        constant = expr.constant
+
+        def code():
+            return constant
+
+        return code
+
+    visit_LLIL_CONST_PTR = visit_LLIL_CONST
+
+    def visit_LLIL_REG(self, expr):
+        return self._emulator._register_reader(expr.src)
+
+    def visit_LLIL_LOAD(self, expr):
+        src = self.compile(expr.src)
+        read_memory = self._emulator._memory_reader(expr.size)
+
+        def code():
+            return read_memory(src())
+
+        return code
+
+    def visit_LLIL_STORE(self, expr):
+        dest = self.compile(expr.dest)
+        src = self.compile(expr.src)
+        write_memory = self._emulator._memory_writer(expr.size)
+
+        def code():
+            addr = dest()
+            return write_memory(addr, src())
+
+        return code
+
+    def visit_LLIL_PUSH(self, expr):
+        emulator = self._emulator
+        sp = emulator.function.arch.stack_pointer
+        src = self.compile(expr.src)
+        size = expr.size
+        read_sp = emulator._register_reader(sp)
+        write_sp = emulator._register_writer(sp)
+        write_memory = emulator._memory_writer(size)
+
+        def code():
+            value = src()
+            sp_value = read_sp() - size
+            write_memory(sp_value, value)
+            return write_sp(sp_value)
+
+        return code
+
+    def visit_LLIL_POP(self, expr):
+        emulator = self._emulator
+        sp = emulator.function.arch.stack_pointer
+        size = expr.size
+        read_sp = emulator._register_reader(sp)
+        write_sp = emulator._register_writer(sp)
+        read_memory = emulator._memory_reader(size)
+
+        def code():
+            sp_value = read_sp()
+            value = read_memory(sp_value)
+            write_sp(sp_value + size)
+            return value
+
+        return code
+
+    def visit_LLIL_GOTO(self, expr):
+        emulator = self._emulator
+        dest = expr.dest
+
+        def code():
+            emulator.instr_index = dest
+            return dest
+
+        return code
+
+    def visit_LLIL_IF(self, expr):
+        emulator = self._emulator
+        condition = self.compile(expr.condition)
+        true = expr.true
+        false = expr.false
+
+        def code():
+            result = condition()
+            if result:
+                emulator.instr_index = true
+            else:
+                emulator.instr_index = false
+            return result
+
+        return code
+
+    def visit_LLIL_CMP_NE(self, expr):
+        left, right = self._binary(expr)
+
+        def code():
+            return left() != right()
+
+        return code
+
+    def visit_LLIL_CMP_E(self, expr):
+        left, right = self._binary(expr)
+
+        def code():
+            return left() == right()
+
+        return code
+
+    def visit_LLIL_CMP_SLT(self, expr):
+        left, right = self._binary(expr)
+        sign_bit = 1 << ((expr.size * 8) - 1)
+        modulus = 1 << (expr.size * 8)
+
+        def code():
+            l = left()
+            r = right()
+            if l & sign_bit:
+                l -= modulus
+            if r & sign_bit:
+                r -= modulus
+            return l < r
+
+        return code
+
+    def visit_LLIL_CMP_UGT(self, expr):
+        left, right = self._binary(expr)
+
+        def code():
+            return left() > right()
+
+        return code
+
+    def visit_LLIL_ADD(self, expr):
+        left, right = self._binary(expr)
+        mask = (1 << expr.size * 8) - 1
+
+        def code():
+            return (left() + right()) & mask
+
+        return code
+
+    def visit_LLIL_AND(self, expr):
+        left, right = self._binary(expr)
+
+        def code():
+            return left() & right()
+
+        return code
+
+    def visit_LLIL_OR(self, expr):
+        left, right = self._binary(expr)
+
+        def code():
+            return left() | right()
+
+        return code
+
+    def visit_LLIL_SUB(self, expr):
+        left, right = self._binary(expr)
+
+        def code():
+            return left() - right()
+
+        return code
+
+    def visit_LLIL_XOR(self, expr):
+        left, right = self._binary(expr)
+
+        def code():
+            return left() ^ right()
+
+        return code
+
+    def visit_LLIL_LSL(self, expr):
+        left, right = self._binary(expr)
+        mask = (1 << expr.size * 8) - 1
+
+        def code():
+            return (left() << right()) & mask
+
+        return code
+
+    def visit_LLIL_LSR(self, expr):
+        left, right = self._binary(expr)
+
+        def code():
+            return left() >> right()
+
+        return code
+
+    visit_LLIL_ADC = _compile_arithmetic
+    visit_LLIL_SBB = _compile_arithmetic
+    visit_LLIL_ASR = _compile_arithmetic
+    visit_LLIL_ROL = _compile_arithmetic
+    visit_LLIL_ROR = _compile_arithmetic
+    visit_LLIL_MUL = _compile_arithmetic
+    visit_LLIL_NEG = _compile_arithmetic
+    visit_LLIL_NOT = _compile_arithmetic
+
+    def visit_LLIL_SET_FLAG(self, expr):
+        flag = expr.dest.index
+        src = self.compile(expr.src)
+        set_flag_value = self._emulator.set_flag_value
+
+        def code():
+            return set_flag_value(flag, src())
+
+        return code
+
+    def visit_LLIL_FLAG(self, expr):
+        flag = expr.src.index
+        get_flag_value = self._emulator.get_flag_value
+
+        def code():
+            return get_flag_value(flag)
+
+        return code
+
+    def visit_LLIL_FLAG_COND(self, expr):
+        condition = lazyflags.CONDITIONS.get(expr.condition)
+
+        if condition is None:
+            return None
+
+        get_flag_by_role = self._emulator._get_flag_by_role
+
+        def code():
+            return condition(get_flag_by_role)
+
+        return code
+
+    def visit_LLIL_SX(self, expr):
+        src = self.compile(expr.src)
+        sign_bit = 1 << ((expr.size * 8) - 1)
+
+        def code():
+            value = src()
+            return (value & (sign_bit - 1)) - (value & sign_bit)
+
+        return code
+
+    def visit_LLIL_ZX(self, expr):
+        return self.compile(expr.src)
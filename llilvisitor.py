@@ -7,19 +7,47 @@ class LLILVisitor(BNILVisitor):
         super(LLILVisitor, self).__init__(**kwargs)
         self._hooks = {}
 
-    def visit(self, expression):
-        hook = self._hooks.get(expression.operation)
+    def _set_hook(self, operation, hook, replace=False):
+        # A replacing hook's return value stands in for the visit;
+        # otherwise the hook runs first and the normal visit follows.
+        self._hooks[operation] = (hook, replace)
+        self._rebuild_dispatch()
 
-        if hook:
-            if hook.type == 1:
+    def _remove_hook(self, operation):
+        self._hooks.pop(operation, None)
+        self._rebuild_dispatch()
+
+    def _rebuild_dispatch(self):
+        # With no hooks installed the instance shares the class table, so
+        # visit() never has to check for them.
+        self._dispatch = self._get_dispatch_table()
+
+        if not self._hooks:
+            return
+
+        dispatch = dict(self._dispatch)
+
+        for operation, (hook, replace) in self._hooks.items():
+            dispatch[operation] = self._hook_visit(operation, hook, replace)
+
+        self._dispatch = dispatch
+
+    def _hook_visit(self, operation, hook, replace):
+        method = self._dispatch.get(operation)
+
+        if method is None:
+            method = self._resolve_visit(operation)
+
+        if replace:
+            def visit(self, expression):
                 return hook(self, expression)
 
-            else:
+        else:
+            def visit(self, expression):
                 hook(self, expression)
+                return method(self, expression)
 
-        result = super(LLILVisitor, self).visit(expression)
-
-        if result is None:
-            raise errors.UnimplementedError(expression.operation)
+        return visit
 
-        return result
+    def visit_unimplemented(self, expression):
+        raise errors.UnimplementedError(expression.operation)
@@ -1,24 +1,54 @@
 import bisect
+import json
+import mmap
+import struct
 from collections import namedtuple
 
-from binaryninja import SegmentFlag
+try:
+    from binaryninja import SegmentFlag
+except ImportError:
+    from offline import SegmentFlag
 
 import errors
 
+PAGE_SHIFT = 12
+PAGE_SIZE = 1 << PAGE_SHIFT
+PAGE_MASK = PAGE_SIZE - 1
+
+ZERO_PAGE = b'\x00' * PAGE_SIZE
+
+# Direct mapped TLBs in front of the page table, indexed by the low bits
+# of the page number
+TLB_SIZE = 64
+TLB_MASK = TLB_SIZE - 1
+TLB_EMPTY = (-1, None)
+
+READABLE = SegmentFlag.SegmentReadable
+WRITABLE = SegmentFlag.SegmentWritable
+EXECUTABLE = SegmentFlag.SegmentExecutable
+
+# BaseImage files: IMAGE_MAGIC, a (version, header offset) pair, the
+# page data from IMAGE_DATA_OFFSET on, then a JSON header listing the
+# (page number, flags) of each page in the data, in order.
+IMAGE_MAGIC = b'EMIIMG\x00\x00'
+IMAGE_VERSION = 1
+IMAGE_PREFIX = struct.Struct('<IQ')
+IMAGE_DATA_OFFSET = PAGE_SIZE
+
 #MemoryRange = namedtuple('MemoryRange', ['start', 'length', 'flags', 'data'])
 
+MemorySnapshot = namedtuple(
+    'MemorySnapshot', ['pages', 'ranges', 'lazy_ranges', 'version']
+)
+
 class MemoryRange(object):
-    def __init__(self, start, length, flags=0, data=None):
+    def __init__(self, start, length, flags=0, loader=None):
         self.start = start
         self.length = length
         self.flags = flags
-
-        if data is None:
-            virtual_data = bytearray('\x00')*length
-        else:
-            virtual_data = bytearray(data) + ('\x00' * (length - len(data)))
-
-        self.data = memoryview(virtual_data)
+        # loader(address, length) -> bytes, for ranges whose pages are
+        # only read in when first touched
+        self.loader = loader
 
     def __cmp__(self, other):
         if isinstance(other, (int, long)):
@@ -34,120 +64,813 @@ class MemoryRange(object):
             self.start, self.length, self.flags
         )
 
+class AddressSpace(object):
+    # The free extents of an address space, as page aligned [start, end)
+    # pairs. They are kept sorted by start, to merge neighbours when
+    # space is released, and by (length, start), so placement is a
+    # bisect for the smallest extent that fits.
+    def __init__(self, floor, top):
+        self._floor = floor
+        self._top = top
+
+        self._starts = []
+        self._ends = {}
+        self._sizes = []
+
+        if floor < top:
+            self._insert(floor, top)
+
+    def __iter__(self):
+        return ((start, self._ends[start]) for start in self._starts)
+
+    def allocate(self, length, alignment=PAGE_SIZE):
+        length = _align(max(length, 1), PAGE_SIZE)
+        sizes = self._sizes
+        index = bisect.bisect_left(sizes, (length,))
+
+        while index < len(sizes):
+            size, start = sizes[index]
+            aligned = _align(start, alignment)
+
+            if aligned + length <= start + size:
+                self.reserve(aligned, aligned + length)
+                return aligned
+
+            index += 1
+
+        raise errors.MemoryAccessError(
+            'No free range of {:x} bytes'.format(length)
+        )
+
+    def reserve(self, start, end):
+        starts = self._starts
+        index = max(bisect.bisect_right(starts, start) - 1, 0)
+
+        overlapping = []
+        while index < len(starts) and starts[index] < end:
+            if self._ends[starts[index]] > start:
+                overlapping.append(starts[index])
+            index += 1
+
+        for free_start in overlapping:
+            free_end = self._delete(free_start)
+
+            if free_start < start:
+                self._insert(free_start, start)
+            if free_end > end:
+                self._insert(end, free_end)
+
+    def release(self, start, end):
+        start = max(start, self._floor)
+        end = min(end, self._top)
+
+        if start >= end:
+            return
+
+        # Whatever part of it is free already is merged in below
+        self.reserve(start, end)
+
+        index = bisect.bisect_left(self._starts, start)
+        if index > 0:
+            previous = self._starts[index - 1]
+            if self._ends[previous] == start:
+                self._delete(previous)
+                start = previous
+
+        if end in self._ends:
+            end = self._delete(end)
+
+        self._insert(start, end)
+
+    def _insert(self, start, end):
+        bisect.insort(self._starts, start)
+        bisect.insort(self._sizes, (end - start, start))
+        self._ends[start] = end
+
+    def _delete(self, start):
+        end = self._ends.pop(start)
+        del self._starts[bisect.bisect_left(self._starts, start)]
+        del self._sizes[bisect.bisect_left(self._sizes, (end - start, start))]
+        return end
+
+class BaseImage(object):
+    # An immutable, paged copy of a view's segments in one mmap. Every
+    # Memory it is mapped into (see Memory.map_image) shares its pages
+    # until it writes to them, so each one only holds what it wrote.
+    # Built without a path the mmap is anonymous, and shared with
+    # processes forked afterwards; with one it is a file that other
+    # processes can open().
+    def __init__(self, pages, buffer, data_offset=0, path=None):
+        # pages: sorted (page number, flags) of each page in buffer
+        self._buffer = buffer
+        self._path = path
+        self._data_offset = data_offset
+        self._index = dict(
+            (page_number, index)
+            for index, (page_number, flags) in enumerate(pages)
+        )
+        self._pages = pages
+        self._views = {}
+
+    def __len__(self):
+        return len(self._pages)
+
+    @classmethod
+    def from_view(cls, view, path=None):
+        flags = {}
+        for segment in view.segments:
+            for page_number in _pages_spanned(segment.start, segment.length):
+                flags[page_number] = flags.get(page_number, 0) | segment.flags
+
+        pages = sorted(flags.items())
+        size = max(len(pages), 1) * PAGE_SIZE
+
+        if path is None:
+            buffer = mmap.mmap(-1, size)
+            data_offset = 0
+        else:
+            data_offset = IMAGE_DATA_OFFSET
+            fp = open(path, 'w+b')
+            fp.truncate(data_offset + size)
+            buffer = mmap.mmap(fp.fileno(), data_offset + size)
+
+        index = dict(
+            (page_number, i) for i, (page_number, _) in enumerate(pages)
+        )
+
+        for segment in view.segments:
+            data = view.read(segment.start, segment.length)
+            position = 0
+
+            while position < len(data):
+                address = segment.start + position
+                offset = address & PAGE_MASK
+                chunk = min(PAGE_SIZE - offset, len(data) - position)
+                start = (
+                    data_offset + index[address >> PAGE_SHIFT] * PAGE_SIZE +
+                    offset
+                )
+                buffer[start:start + chunk] = data[position:position + chunk]
+                position += chunk
+
+        if path is None:
+            return cls(pages, buffer)
+
+        header = json.dumps({'pages': pages}).encode('ascii')
+        buffer[:len(IMAGE_MAGIC)] = IMAGE_MAGIC
+        prefix = IMAGE_PREFIX.pack(IMAGE_VERSION, data_offset + size)
+        buffer[len(IMAGE_MAGIC):len(IMAGE_MAGIC) + len(prefix)] = prefix
+        buffer.close()
+
+        fp.seek(data_offset + size)
+        fp.write(header)
+        fp.close()
+
+        return cls.open(path)
+
+    @classmethod
+    def open(cls, path):
+        with open(path, 'rb') as fp:
+            # A private mapping: pages stay shared through the page cache,
+            # and page views need a writable buffer on Python 2
+            buffer = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_COPY)
+
+        if buffer[:len(IMAGE_MAGIC)] != IMAGE_MAGIC:
+            raise ValueError('{} is not a base image'.format(path))
+
+        version, header_offset = IMAGE_PREFIX.unpack_from(
+            buffer, len(IMAGE_MAGIC)
+        )
+        if version != IMAGE_VERSION:
+            raise ValueError(
+                'Unsupported base image version {}'.format(version)
+            )
+
+        header = json.loads(buffer[header_offset:].decode('ascii'))
+        pages = [tuple(page) for page in header['pages']]
+
+        return cls(pages, buffer, IMAGE_DATA_OFFSET, path)
+
+    def __reduce__(self):
+        # File backed images pickle as their path
+        if self._path is None:
+            raise TypeError(
+                'Anonymous base images are only shared by forking'
+            )
+        return (_open_image, (self._path,))
+
+    @property
+    def ranges(self):
+        # (start, length, flags) of each run of consecutive pages with
+        # the same flags
+        ranges = []
+
+        for page_number, flags in self._pages:
+            start = page_number << PAGE_SHIFT
+
+            if ranges:
+                last_start, last_length, last_flags = ranges[-1]
+                if last_start + last_length == start and last_flags == flags:
+                    ranges[-1] = (last_start, last_length + PAGE_SIZE, flags)
+                    continue
+
+            ranges.append((start, PAGE_SIZE, flags))
+
+        return ranges
+
+    def page(self, page_number):
+        # The shared data of a page, or None if it isn't in the image
+        data = self._views.get(page_number)
+
+        if data is None:
+            index = self._index.get(page_number)
+            if index is None:
+                return None
+
+            offset = self._data_offset + index * PAGE_SIZE
+
+            # Every emulator shares these, so they are handed out
+            # read-only; writes have to go through a private copy.
+            try:
+                data = memoryview(self._buffer)[offset:offset + PAGE_SIZE]
+            except TypeError:
+                # Python 2's mmap has no new style buffer interface, but
+                # its old style buffer objects are read-only views
+                data = buffer(self._buffer, offset, PAGE_SIZE)
+            else:
+                try:
+                    data = data.toreadonly()
+                except AttributeError:
+                    data = data.tobytes()
+
+            self._views[page_number] = data
+
+        return data
+
+    def read(self, address, length):
+        # A loader for Memory: whole pages come back as the shared data
+        if not address & PAGE_MASK and length == PAGE_SIZE:
+            data = self.page(address >> PAGE_SHIFT)
+            if data is not None:
+                return data
+
+        chunks = []
+        end = address + length
+
+        while address < end:
+            offset = address & PAGE_MASK
+            chunk = min(PAGE_SIZE - offset, end - address)
+            data = self.page(address >> PAGE_SHIFT)
+
+            if data is None:
+                chunks.append(ZERO_PAGE[:chunk])
+            else:
+                chunks.append(data[offset:offset + chunk])
+
+            address += chunk
+
+        return b''.join(chunks)
+
+class Page(object):
+    __slots__ = ('data', 'flags', 'private')
+
+    def __init__(self, flags, data=ZERO_PAGE):
+        # Page data is shared (with the loader, the zero page or a
+        # snapshot) until Memory copies it on the first write.
+        self.flags = flags
+        self.data = data
+        self.private = False
+
+    def __repr__(self):
+        return '<Page: flags={}>'.format(self.flags)
+
 class Memory(object):
     def __init__(self, address_size):
         if address_size not in (1, 2, 4, 8):
             raise ValueError('address_size must be 1, 2, 4, or 8.')
         self._address_size = address_size
 
+        # MemoryRanges describe what was mapped; the page table holds the
+        # data and is what every access goes through.
         self._ranges = []
+        self._lazy_ranges = []
+        self._pages = {}
+        self._watches = {}
+
+        # Pages made private since the last snapshot/restore, and a
+        # counter bumped whenever the set of mapped ranges changes
+        self._dirty = set()
+        self._version = 0
+        self._base = None
+
+        # Unmapped address space that map() can place ranges in. The
+        # first page is left out, so nothing is placed at 0.
+        self._free = self._address_space()
+        self._longest = 0
+
+        # (page number, data) of recently used pages: readable ones for
+        # reads, private writable ones for writes. A hit skips the page
+        # table, the permission check and the copy-on-write check.
+        self._read_tlb = [TLB_EMPTY] * TLB_SIZE
+        self._write_tlb = [TLB_EMPTY] * TLB_SIZE
 
     def __contains__(self, address):
-        range_index = bisect.bisect_left(self._ranges, address)
+        page_number = address >> PAGE_SHIFT
+        return (page_number in self._pages or
+                self._fault(page_number) is not None)
 
-        if range_index > len(self._ranges):
-            return False
+    def __iter__(self):
+        return iter(self._ranges)
 
-        try:
-            if self._ranges[range_index].start == address:
-                return True
-        except IndexError:
-            pass
+    def read(self, address, length):
+        offset = address & PAGE_MASK
 
-        if range_index == 0:
-            return False
+        if offset + length > PAGE_SIZE:
+            return self._access(address, length, READABLE).tobytes()
 
-        try:
-            prev_range = self._ranges[range_index - 1]
-        except IndexError:
-            return False
+        page_number = address >> PAGE_SHIFT
+        entry = self._read_tlb[page_number & TLB_MASK]
 
-        if (prev_range.start < address and
-                prev_range.length + prev_range.start > address):
-            return True
+        if entry[0] == page_number:
+            return bytes(entry[1][offset:offset + length])
 
-        return False
+        page = self._pages.get(page_number)
 
-    def __iter__(self):
-        return iter(self._ranges)
+        if page is None:
+            page = self._fault(page_number)
 
-    def read(self, address, length):
-        # XXX: Handle split ranges
-        idx = bisect.bisect_left(self._ranges, address)
-
-        try:
-            if self._ranges[idx].start > address:
-                idx -= 1
-        except IndexError:
-            idx -= 1
-
-        try:
-            range = self._ranges[idx]
-        except IndexError:
-            raise errors.MemoryAccessError(address=address)
-
-        if range.start <= address < range.length:
-            if range.start + length > range.length:
-                raise errors.MemoryAccessError(
-                    '{[{:x},{:x}] is not valid range of memory'.format(
-                        address, address+length
-                    ),
-                    address=address
-                )
-        return range.data[address-range.start:address+length-range.start].tobytes()
+        if page is None or not page.flags & READABLE:
+            raise self._access_error(address, length)
+
+        self._read_tlb[page_number & TLB_MASK] = (page_number, page.data)
+
+        return bytes(page.data[offset:offset + length])
+
+    def read_block(self, address, length):
+        # Like read(), but returns a memoryview, aliasing the page data
+        # when the block lies within a single page.
+        offset = address & PAGE_MASK
+
+        if offset + length > PAGE_SIZE:
+            return self._access(address, length, READABLE)
+
+        page = self._get_page(address >> PAGE_SHIFT)
+
+        if page is None or not page.flags & READABLE:
+            raise self._access_error(address, length)
+
+        return memoryview(page.data)[offset:offset + length]
+
+    def fetch(self, address, length):
+        # read() for instruction bytes: requires execute, not read
+        return self._access(address, length, EXECUTABLE).tobytes()
 
     def write(self, address, value):
         length = len(value)
+        offset = address & PAGE_MASK
+
+        if offset + length > PAGE_SIZE:
+            self._access(address, length, WRITABLE, value)
+
+        else:
+            page_number = address >> PAGE_SHIFT
+            entry = self._write_tlb[page_number & TLB_MASK]
+
+            if entry[0] == page_number:
+                # Watched pages never get in the TLB
+                entry[1][offset:offset + length] = value
+                return
+
+            page = self._pages.get(page_number)
+
+            if page is None:
+                page = self._fault(page_number)
+
+            if page is None or not page.flags & WRITABLE:
+                raise self._access_error(address, length)
+
+            if not page.private:
+                self._make_private(page_number, page)
+
+            page.data[offset:offset + length] = value
 
-        # XXX: Handle split ranges
-        idx = bisect.bisect_left(self._ranges, address)
-        
-        if idx == len(self._ranges) or self._ranges[idx].start > address:
-            idx -= 1
-
-        range = self._ranges[idx]
-
-        if range.start <= address < range.length:
-            if range.start + length > range.length:
-                raise errors.MemoryAccessError(
-                    '{[{:x},{:x}] is not valid range of memory'.format(
-                        address, address+length
-                    ),
-                    address=address
+            if page_number not in self._watches:
+                self._write_tlb[page_number & TLB_MASK] = (
+                    page_number, page.data
                 )
+                return
 
-        range.data[address-range.start:address+length-range.start] = value
+        if self._watches:
+            self._notify_watches(address, length)
+
+    def _access(self, address, length, flag, value=None):
+        # Slow path for accesses that straddle pages. Every page is
+        # checked before any byte is copied, so a faulting write leaves
+        # memory untouched.
+        pages = []
+        end = address + length
+        current = address
+
+        while current < end:
+            page = self._pages.get(current >> PAGE_SHIFT)
+
+            if page is None:
+                page = self._fault(current >> PAGE_SHIFT)
+
+            if page is None or (flag is not None and not page.flags & flag):
+                raise self._access_error(address, length, current)
+
+            pages.append((current >> PAGE_SHIFT, page))
+            current = (current | PAGE_MASK) + 1
+
+        if value is None:
+            data = bytearray(length)
+        else:
+            data = memoryview(value)
+
+        position = 0
+        offset = address & PAGE_MASK
+
+        for page_number, page in pages:
+            chunk = min(PAGE_SIZE - offset, length - position)
+
+            if value is None:
+                data[position:position + chunk] = (
+                    page.data[offset:offset + chunk]
+                )
+            else:
+                if not page.private:
+                    self._make_private(page_number, page)
+                page.data[offset:offset + chunk] = (
+                    data[position:position + chunk]
+                )
+
+            position += chunk
+            offset = 0
+
+        return memoryview(data)
+
+    def _access_error(self, address, length, fault=None):
+        return errors.MemoryAccessError(
+            '[{:x},{:x}] is not valid range of memory'.format(
+                address, address + length
+            ),
+            address=address if fault is None else fault
+        )
+
+    def watch(self, start, length, callback):
+        # callback(address, length) fires once, on the first write that
+        # touches [start, start+length). The returned handle can be passed
+        # to unwatch() to drop the watch before that.
+        handle = (start, start + length, callback)
+        write_tlb = self._write_tlb
+
+        for page in self._watch_pages(start, length):
+            self._watches.setdefault(page, []).append(handle)
+
+            # Writes to the page have to take the slow path now
+            if write_tlb[page & TLB_MASK][0] == page:
+                write_tlb[page & TLB_MASK] = TLB_EMPTY
+
+        return handle
+
+    def unwatch(self, handle):
+        start, end, callback = handle
+
+        for page in self._watch_pages(start, end - start):
+            watches = self._watches.get(page)
+            if watches is None:
+                continue
+
+            try:
+                watches.remove(handle)
+            except ValueError:
+                pass
+
+            if not watches:
+                del self._watches[page]
+
+    def _watch_pages(self, start, length):
+        return _pages_spanned(start, length)
+
+    def _notify_watches(self, address, length):
+        end = address + length
+        fired = []
+
+        for page in self._watch_pages(address, length):
+            for handle in self._watches.get(page, ()):
+                if (handle[0] < end and address < handle[1] and
+                        handle not in fired):
+                    fired.append(handle)
+
+        for handle in fired:
+            self.unwatch(handle)
+            handle[2](address, length)
 
     def map(self,
             start=None,
             length=0x1000,
             flags=SegmentFlag.SegmentReadable | SegmentFlag.SegmentWritable,
-            data=None):
+            data=None,
+            loader=None,
+            alignment=PAGE_SIZE):
+        # Without a start, the range goes wherever there's room, at a
+        # multiple of alignment (a power of two)
         if start is None:
-            start = self._find_available_base(length)
+            start = self._free.allocate(length, alignment)
+        else:
+            self._free.reserve(*_page_bounds(start, length))
 
-        bisect.insort(self._ranges, MemoryRange(start, length, flags, data))
+        memory_range = MemoryRange(start, length, flags, loader)
+        self._longest = max(self._longest, length)
 
-        return start
+        if loader is not None:
+            # Nothing is read until a page in the range is touched
+            for page_number in _pages_spanned(start, length):
+                page = self._pages.get(page_number)
+                if page is not None:
+                    page.flags |= flags
+
+            bisect.insort(self._lazy_ranges, memory_range)
+            bisect.insort(self._ranges, memory_range)
+            self._version += 1
+            self._flush_tlb()
+            return start
+
+        for page_number in _pages_spanned(start, length):
+            page = self._pages.get(page_number)
+
+            if page is None:
+                page = self._fault(page_number)
+
+            if page is None:
+                page = self._pages[page_number] = Page(flags)
+            else:
+                page.flags |= flags
 
-    def _find_available_base(self, length):
-        max_address = (1 << self._address_size * 8) - 1
+        self._version += 1
+        self._flush_tlb()
 
-        if length > max_address:
-            raise OverflowError(
-                'length {} is larger than max address'.format(length)
+        if data:
+            data = memoryview(data)[:length]
+            self._access(start, len(data), None, data)
+
+        bisect.insort(self._ranges, memory_range)
+
+        return start
+
+    def unmap(self, start, length):
+        # Unmaps every page spanned by [start, start+length), trimming
+        # the ranges that cover them.
+        start, end = _page_bounds(start, length)
+
+        self._trim_ranges(self._ranges, start, end)
+        self._trim_ranges(self._lazy_ranges, start, end)
+
+        page_numbers = _pages_spanned(start, end - start)
+        for page_number in page_numbers:
+            self._pages.pop(page_number, None)
+            self._dirty.discard(page_number)
+
+        self._free.release(start, end)
+        self._version += 1
+        self._flush_tlb()
+
+        if self._watches:
+            self._notify_watches(start, end - start)
+
+    def _trim_ranges(self, ranges, start, end):
+        # Drops [start, end) from the sorted ranges, splitting those that
+        # straddle it. Only ranges starting before end, and no more than
+        # the longest length ever mapped before start, can overlap it.
+        first = bisect.bisect_left(ranges, start - self._longest)
+        last = bisect.bisect_left(ranges, end)
+
+        kept = []
+        after = []
+
+        for memory_range in ranges[first:last]:
+            range_end = memory_range.start + memory_range.length
+
+            if range_end <= start:
+                kept.append(memory_range)
+                continue
+
+            if memory_range.start < start:
+                kept.append(MemoryRange(
+                    memory_range.start, start - memory_range.start,
+                    memory_range.flags, memory_range.loader
+                ))
+            if range_end > end:
+                after.append(MemoryRange(
+                    end, range_end - end, memory_range.flags,
+                    memory_range.loader
+                ))
+
+        kept.sort()
+        ranges[first:last] = kept
+
+        for memory_range in after:
+            bisect.insort(ranges, memory_range)
+
+    def _address_space(self):
+        free = AddressSpace(PAGE_SIZE, 1 << self._address_size * 8)
+
+        for memory_range in self._ranges:
+            free.reserve(
+                *_page_bounds(memory_range.start, memory_range.length)
             )
 
-        # return 0 if available
-        if self._ranges[0].start > length:
-            return 0
+        return free
+
+    def map_image(self, image):
+        # Maps a BaseImage. Its ranges are whole pages, so every page
+        # faults in as the image's own data, and is only copied when
+        # written to.
+        for start, length, flags in image.ranges:
+            self.map(start, length, flags, loader=image.read)
+
+    def replace(self, ranges):
+        # Replaces everything mapped with ranges, MemoryRanges that all
+        # have loaders, as when a checkpoint is loaded. Nothing is read
+        # until it is touched.
+        self._ranges = sorted(ranges)
+        self._lazy_ranges = list(self._ranges)
+        self._pages = {}
+        self._dirty = set()
+        self._base = None
+        self._version += 1
+        self._longest = max(
+            [self._longest] +
+            [memory_range.length for memory_range in self._ranges]
+        )
+        self._free = self._address_space()
+        self._flush_tlb()
+
+    def _get_page(self, page_number):
+        page = self._pages.get(page_number)
+
+        if page is None:
+            page = self._fault(page_number)
+
+        return page
+
+    def _make_private(self, page_number, page):
+        page.data = bytearray(page.data)
+        page.private = True
+        self._dirty.add(page_number)
+
+        # Reads must see the copy from now on
+        slot = page_number & TLB_MASK
+        if self._read_tlb[slot][0] == page_number:
+            self._read_tlb[slot] = (page_number, page.data)
+
+    def _flush_tlb(self):
+        self._read_tlb[:] = [TLB_EMPTY] * TLB_SIZE
+        self._write_tlb[:] = [TLB_EMPTY] * TLB_SIZE
+
+    def snapshot(self):
+        # Every page becomes shared with the snapshot, so the first write
+        # to each one afterwards copies it and marks it dirty.
+        pages = {}
+
+        for page_number, page in self._pages.items():
+            page.private = False
+            pages[page_number] = (page.data, page.flags)
+
+        snapshot = MemorySnapshot(
+            pages, list(self._ranges), list(self._lazy_ranges), self._version
+        )
+
+        self._base = snapshot
+        self._dirty = set()
+
+        # Every page is shared again, so the next write to each one has
+        # to take the copy-on-write path
+        self._write_tlb[:] = [TLB_EMPTY] * TLB_SIZE
+
+        return snapshot
+
+    def restore(self, snapshot):
+        # Watches are for writes, so only watched pages that really go
+        # back to other contents are reported as written
+        watched = dict(
+            (page_number, _page_data(self._get_page(page_number)))
+            for page_number in self._watches
+        )
+
+        if snapshot is self._base and snapshot.version == self._version:
+            # Only pages written since the snapshot can differ from it
+            page_numbers = self._dirty
+        else:
+            page_numbers = set(self._pages)
+            page_numbers.update(snapshot.pages)
+            self._ranges = list(snapshot.ranges)
+            self._lazy_ranges = list(snapshot.lazy_ranges)
+            self._free = self._address_space()
+
+        pages = self._pages
+
+        for page_number in page_numbers:
+            saved = snapshot.pages.get(page_number)
+
+            if saved is None:
+                pages.pop(page_number, None)
+                continue
+
+            page = pages.get(page_number)
+
+            if page is None:
+                page = pages[page_number] = Page(saved[1], saved[0])
+            else:
+                page.data, page.flags = saved
+                page.private = False
+
+        self._version = snapshot.version
+        self._base = snapshot
+        self._dirty = set()
+        self._flush_tlb()
+
+        for page_number, data in watched.items():
+            if _page_data(self._get_page(page_number)) != data:
+                self._notify_watches(page_number << PAGE_SHIFT, PAGE_SIZE)
+
+    def _fault(self, page_number):
+        # Called when a page is not in the page table. Builds it from any
+        # lazily mapped ranges covering it, or returns None if unmapped.
+        if not self._lazy_ranges:
+            return None
+
+        page_start = page_number << PAGE_SHIFT
+        page_end = page_start + PAGE_SIZE
+
+        covering = []
+        index = bisect.bisect_left(self._lazy_ranges, page_end)
+
+        while index > 0:
+            index -= 1
+            memory_range = self._lazy_ranges[index]
+
+            if memory_range.start + memory_range.length > page_start:
+                covering.append(memory_range)
+            else:
+                break
+
+        if not covering:
+            return None
+
+        flags = 0
+        for memory_range in covering:
+            flags |= memory_range.flags
+
+        memory_range = covering[0]
+        if (len(covering) == 1 and memory_range.start <= page_start and
+                memory_range.start + memory_range.length >= page_end):
+            data = memory_range.loader(page_start, PAGE_SIZE)
+            if len(data) == 0:
+                data = ZERO_PAGE
+            elif len(data) < PAGE_SIZE:
+                data = data + ZERO_PAGE[len(data):]
+            page = Page(flags, data)
+
+        else:
+            data = bytearray(PAGE_SIZE)
+            for memory_range in reversed(covering):
+                start = max(memory_range.start, page_start)
+                end = min(memory_range.start + memory_range.length, page_end)
+                chunk = memory_range.loader(start, end - start)
+                offset = start - page_start
+                data[offset:offset + len(chunk)] = chunk
+            page = Page(flags, bytes(data))
+
+        self._pages[page_number] = page
+
+        return page
+
+
+def _page_data(page):
+    if page is None:
+        return None
+    return page.data
+
+
+def _pages_spanned(start, length):
+    return range(
+        start >> PAGE_SHIFT,
+        ((start + max(length, 1) - 1) >> PAGE_SHIFT) + 1
+    )
+
+
+def _open_image(path):
+    return BaseImage.open(path)
+
+
+def _page_bounds(start, length):
+    return (
+        start & ~PAGE_MASK,
+        _align(start + max(length, 1), PAGE_SIZE)
+    )
 
-        for i, range in self._ranges:
-            next_start = range.start + range.length + 1
-            next_end = next_start + length
-            start_bisect = bisect.bisect_left(next_start)
-            end_bisect = bisect.bisect_right(next_end)
 
-            # if they are the same value, then this range is available
-            if start_bisect == end_bisect and next_end < max_address:
-                return next_start
\ No newline at end of file
+def _align(value, alignment):
+    return (value + alignment - 1) & ~(alignment - 1)
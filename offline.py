@@ -0,0 +1,840 @@
+import bisect
+import json
+import mmap
+import struct
+
+import errors
+
+# Standalone LLIL images: the LLIL of a set of functions plus the
+# segment data of their view, in a form the emulator can run without
+# binaryninja. The classes here stand in for the binaryninja ones the
+# emulator uses, and are what the rest of the plugin imports when
+# binaryninja is not available.
+#
+# File layout: MAGIC, a (version, header offset) pair, the packed tables
+# and segment data, then a JSON header describing where each one is.
+# Every function has its own fixed width tables:
+#   operations  <H  index into the header's operation names, per expr
+#   sizes       <H  expression size
+#   flags       <H  1 + index into the header's flag write types, or 0
+#   addresses   <Q  expression address
+#   operands    <I  start of each expression's operands in the pool
+#   pool        <q  operand values; exprs are indexes into the tables
+#   instructions <I root expression of each instruction
+#   blocks      <I  basic block (start, end) pairs
+#   lengths     <Q  (address, native instruction length) pairs
+
+MAGIC = b'EMILLIL\x00'
+VERSION = 2
+
+PREFIX = struct.Struct('<IQ')
+
+TABLES = (
+    ('operations', 'H'), ('sizes', 'H'), ('flags', 'H'),
+    ('addresses', 'Q'), ('operands', 'I'), ('pool', 'q'),
+    ('instructions', 'I'), ('blocks', 'I'), ('lengths', 'Q'),
+)
+
+# Operand kinds stored as their .index; 'reg' and 'flag' are rebuilt
+# into ILRegister/ILFlag, the rest are left as ints.
+INDEXED = frozenset([
+    'reg', 'flag', 'reg_stack', 'intrinsic', 'sem_class', 'sem_group'
+])
+
+
+def LLIL_REG_IS_TEMP(n):
+    return (n & 0x80000000) != 0
+
+
+def LLIL_GET_TEMP_REG_INDEX(n):
+    return n & 0x7fffffff
+
+
+class Endianness(object):
+    LittleEndian = 0
+    BigEndian = 1
+
+
+class SegmentFlag(object):
+    SegmentExecutable = 1
+    SegmentWritable = 2
+    SegmentReadable = 4
+    SegmentContainsData = 8
+    SegmentContainsCode = 0x10
+    SegmentDenyWrite = 0x20
+    SegmentDenyExecute = 0x40
+
+
+class SymbolType(object):
+    FunctionSymbol = 0
+    ImportAddressSymbol = 1
+    ImportedFunctionSymbol = 2
+    DataSymbol = 3
+    ImportedDataSymbol = 4
+    ExternalSymbol = 5
+
+
+class ImplicitRegisterExtend(object):
+    NoExtend = 0
+    ZeroExtendToFullWidth = 1
+    SignExtendToFullWidth = 2
+
+
+class FlagRole(object):
+    SpecialFlagRole = 0
+    ZeroFlagRole = 1
+    PositiveSignFlagRole = 2
+    NegativeSignFlagRole = 3
+    CarryFlagRole = 4
+    OverflowFlagRole = 5
+    HalfCarryFlagRole = 6
+    EvenParityFlagRole = 7
+    OddParityFlagRole = 8
+    OrderedFlagRole = 9
+    UnorderedFlagRole = 10
+    CarryFlagWithInvertedSubtractRole = 11
+
+
+class LowLevelILFlagCondition(object):
+    LLFC_E = 0
+    LLFC_NE = 1
+    LLFC_SLT = 2
+    LLFC_ULT = 3
+    LLFC_SLE = 4
+    LLFC_ULE = 5
+    LLFC_SGE = 6
+    LLFC_UGE = 7
+    LLFC_SGT = 8
+    LLFC_UGT = 9
+    LLFC_NEG = 10
+    LLFC_POS = 11
+    LLFC_O = 12
+    LLFC_NO = 13
+
+
+class Operation(object):
+    # Interned by name, so every image shares the same objects and they
+    # can key instruction hooks and dispatch tables.
+    __slots__ = ('name',)
+
+    _interned = {}
+
+    def __new__(cls, name):
+        name = str(name)
+        operation = cls._interned.get(name)
+
+        if operation is None:
+            operation = object.__new__(cls)
+            operation.name = name
+            cls._interned[name] = operation
+
+        return operation
+
+    def __reduce__(self):
+        return Operation, (self.name,)
+
+    def __repr__(self):
+        return '<Operation: {}>'.format(self.name)
+
+
+class _Operations(object):
+    # LowLevelILOperation.LLIL_ADD and friends
+    def __getattr__(self, name):
+        if not name.startswith('LLIL_'):
+            raise AttributeError(name)
+        return Operation(name)
+
+
+LowLevelILOperation = _Operations()
+
+
+class ILRegister(object):
+    __slots__ = ('arch', 'index')
+
+    def __init__(self, arch, index):
+        self.arch = arch
+        self.index = index
+
+    @property
+    def temp(self):
+        return LLIL_REG_IS_TEMP(self.index)
+
+    @property
+    def name(self):
+        if self.temp:
+            return 'temp{}'.format(LLIL_GET_TEMP_REG_INDEX(self.index))
+        return self.arch.get_reg_name(self.index)
+
+    def __str__(self):
+        return self.name
+
+
+class ILFlag(object):
+    __slots__ = ('arch', 'index')
+
+    def __init__(self, arch, index):
+        self.arch = arch
+        self.index = index
+
+    @property
+    def name(self):
+        return self.arch.get_flag_name(self.index)
+
+    def __str__(self):
+        return self.name
+
+
+class RegisterInfo(object):
+    def __init__(self, full_width_reg, size, offset=0, extend=0, index=None):
+        self.full_width_reg = full_width_reg
+        self.size = size
+        self.offset = offset
+        self.extend = extend
+        self.index = index
+
+
+class _ArchitectureRegistry(type):
+    _architectures = {}
+
+    def __getitem__(cls, name):
+        return cls._architectures[name]
+
+
+class Architecture(object):
+    __metaclass__ = _ArchitectureRegistry
+
+    def __init__(self, info):
+        self.name = str(info['name'])
+        self.address_size = info['address_size']
+        self.default_int_size = info['default_int_size']
+        self.endianness = info['endianness']
+        self.stack_pointer = _str(info['stack_pointer'])
+        self.link_reg = _str(info['link_reg'])
+
+        self.regs = {}
+        self._reg_names = {}
+        for name, (full_width_reg, size, offset, extend, index) in (
+                info['regs'].items()):
+            name = str(name)
+            self.regs[name] = RegisterInfo(
+                str(full_width_reg), size, offset, extend, index
+            )
+            self._reg_names[index] = name
+
+        self.full_width_regs = sorted(
+            set(reg.full_width_reg for reg in self.regs.values())
+        )
+
+        self._flag_indexes = dict(
+            (str(name), index) for name, index in info['flags'].items()
+        )
+        self._flag_names = dict(
+            (index, name) for name, index in self._flag_indexes.items()
+        )
+        self.flags = sorted(self._flag_indexes, key=self._flag_indexes.get)
+        self.flag_roles = dict(
+            (str(name), role) for name, role in info['flag_roles'].items()
+        )
+        self.flags_written_by_flag_write_type = dict(
+            (str(write_type), [str(flag) for flag in flags])
+            for write_type, flags in info['flag_write_types'].items()
+        )
+        self.flag_write_types = sorted(self.flags_written_by_flag_write_type)
+
+        _ArchitectureRegistry._architectures.setdefault(self.name, self)
+
+    def get_reg_index(self, name):
+        if isinstance(name, (int, long)):
+            return name
+        return self.regs[name].index
+
+    def get_reg_name(self, index):
+        return self._reg_names[index]
+
+    def get_flag_index(self, name):
+        if isinstance(name, (int, long)):
+            return name
+        return self._flag_indexes[name]
+
+    def get_flag_name(self, index):
+        return self._flag_names[index]
+
+    def __repr__(self):
+        return '<arch: {}>'.format(self.name)
+
+
+class CallingConvention(object):
+    def __init__(self, info):
+        self.name = _str(info.get('name'))
+        self.int_arg_regs = [str(reg) for reg in info['int_arg_regs']]
+        self.int_return_reg = _str(info['int_return_reg'])
+
+
+class Platform(object):
+    def __init__(self, arch, calling_convention):
+        self.arch = arch
+        self.default_calling_convention = calling_convention
+
+
+class Segment(object):
+    def __init__(self, start, length, flags, offset, data_length):
+        self.start = start
+        self.length = length
+        self.end = start + length
+        self.flags = flags
+        self.data_offset = offset
+        self.data_length = data_length
+
+    def __repr__(self):
+        return '<segment: {:#x}-{:#x}>'.format(self.start, self.end)
+
+
+class Symbol(object):
+    def __init__(self, type, address, name):
+        self.type = type
+        self.address = address
+        self.name = name
+        self.full_name = name
+
+    def __repr__(self):
+        return '<symbol: {} @ {:#x}>'.format(self.name, self.address)
+
+
+class LowLevelILInstruction(object):
+    # An expression node. Operands are plain attributes, named as in
+    # binaryninja, so the emulator can't tell the two apart.
+    def __init__(self, function, operation, size, flags, address,
+                 expr_index):
+        self.function = function
+        self.operation = operation
+        self.size = size
+        self.flags = flags
+        self.address = address
+        self.expr_index = expr_index
+        self.instr_index = None
+        self.operands = []
+
+    def __repr__(self):
+        return '<llil: {}>'.format(self.operation.name)
+
+
+class BasicBlock(object):
+    def __init__(self, function, start, end):
+        self.function = function
+        self.start = start
+        self.end = end
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __iter__(self):
+        for index in range(self.start, self.end):
+            yield self.function[index]
+
+    def __repr__(self):
+        return '<block: {}-{}>'.format(self.start, self.end)
+
+
+class LowLevelILFunction(object):
+    # Expressions are only built from the tables the first time the
+    # function is used.
+    def __init__(self, view, source_function, tables):
+        self.view = view
+        self.source_function = source_function
+        self.arch = view.arch
+        self._tables = tables
+        self._instructions = None
+        self._blocks = None
+        self._starts = None
+
+    def __reduce__(self):
+        return _load_function, (self.view.path, self.source_function.start)
+
+    def __len__(self):
+        return len(self._load())
+
+    def __getitem__(self, index):
+        return self._load()[index]
+
+    def __iter__(self):
+        self._load()
+        return iter(self._blocks)
+
+    def __repr__(self):
+        return '<llil func: {:#x}>'.format(self.source_function.start)
+
+    @property
+    def instructions(self):
+        return iter(self._load())
+
+    @property
+    def basic_blocks(self):
+        self._load()
+        return list(self._blocks)
+
+    def get_instruction_start(self, address, arch=None):
+        self._load()
+        return self._starts.get(address)
+
+    def _load(self):
+        if self._instructions is not None:
+            return self._instructions
+
+        view = self.view
+        arch = self.arch
+        read = view._read_table
+        tables = self._tables
+
+        operations = read(tables, 'operations')
+        sizes = read(tables, 'sizes')
+        flags = read(tables, 'flags')
+        write_types = view._flag_write_types
+        addresses = read(tables, 'addresses')
+        operands = read(tables, 'operands')
+        pool = read(tables, 'pool')
+
+        expressions = []
+
+        for index, operation in enumerate(operations):
+            operation, schema = view._operations[operation]
+            write_type = flags[index]
+            expression = LowLevelILInstruction(
+                self, operation, sizes[index],
+                write_types[write_type - 1] if write_type else None,
+                addresses[index], index
+            )
+
+            position = operands[index]
+            for name, kind in schema:
+                if kind == 'expr':
+                    value = expressions[pool[position]]
+                    position += 1
+                elif kind == 'reg':
+                    value = ILRegister(arch, pool[position])
+                    position += 1
+                elif kind == 'flag':
+                    value = ILFlag(arch, pool[position])
+                    position += 1
+                elif kind == 'expr_list':
+                    count = pool[position]
+                    value = [
+                        expressions[item]
+                        for item in pool[position + 1:position + 1 + count]
+                    ]
+                    position += 1 + count
+                elif kind == 'int_list':
+                    count = pool[position]
+                    value = list(pool[position + 1:position + 1 + count])
+                    position += 1 + count
+                elif kind == 'target_map':
+                    count = pool[position]
+                    items = pool[position + 1:position + 1 + count * 2]
+                    value = dict(zip(items[::2], items[1::2]))
+                    position += 1 + count * 2
+                else:
+                    value = pool[position]
+                    position += 1
+
+                setattr(expression, name, value)
+                expression.operands.append(value)
+
+            expressions.append(expression)
+
+        instructions = []
+        starts = {}
+
+        for index, root in enumerate(read(tables, 'instructions')):
+            instruction = expressions[root]
+            instruction.instr_index = index
+            instructions.append(instruction)
+            starts.setdefault(instruction.address, index)
+
+        blocks = read(tables, 'blocks')
+        self._blocks = [
+            BasicBlock(self, start, end)
+            for start, end in zip(blocks[::2], blocks[1::2])
+        ]
+
+        self._starts = starts
+        self._instructions = instructions
+
+        return instructions
+
+
+class Function(object):
+    def __init__(self, view, start, name, tables):
+        self.view = view
+        self.start = start
+        self.name = name
+        self.arch = view.arch
+        self.low_level_il = LowLevelILFunction(view, self, tables)
+
+    def __repr__(self):
+        return '<func: {}@{:#x}>'.format(self.name, self.start)
+
+
+class BinaryView(object):
+    # The view side of an image: segments, functions and symbols, read
+    # straight out of the mapped file. BinaryView() is an empty view.
+    def __init__(self, path=None):
+        self.path = path
+        self.file = None
+        self.arch = None
+        self.platform = None
+        self.segments = []
+        self.symbols = {}
+
+        self._functions = {}
+        self._symbols_by_address = {}
+        self._lengths = None
+        self._operations = []
+        self._flag_write_types = []
+        self._mapped = None
+
+        if path is not None:
+            self._open(path)
+
+    def __reduce__(self):
+        return load, (self.path,)
+
+    def _open(self, path):
+        with open(path, 'rb') as fp:
+            self._mapped = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+        mapped = self._mapped
+
+        if mapped[:len(MAGIC)] != MAGIC:
+            raise ValueError('{} is not an LLIL image'.format(path))
+
+        version, header_offset = PREFIX.unpack_from(mapped, len(MAGIC))
+
+        if version != VERSION:
+            raise ValueError(
+                '{} has unsupported version {}'.format(path, version)
+            )
+
+        header = json.loads(mapped[header_offset:].decode('utf-8'))
+
+        self.arch = Architecture(header['arch'])
+
+        calling_convention = header.get('calling_convention')
+        if calling_convention is not None:
+            self.platform = Platform(
+                self.arch, CallingConvention(calling_convention)
+            )
+
+        self._operations = [
+            (Operation(name), [(str(n), str(kind)) for n, kind in schema])
+            for name, schema in header['operations']
+        ]
+
+        self._flag_write_types = [
+            str(write_type) for write_type in header['flag_write_types']
+        ]
+
+        for start, length, flags, offset, size in header['segments']:
+            self.segments.append(Segment(start, length, flags, offset, size))
+        self.segments.sort(key=lambda segment: segment.start)
+        self._segment_starts = [segment.start for segment in self.segments]
+
+        for info in header['functions']:
+            function = Function(
+                self, info['start'], str(info['name']), info['tables']
+            )
+            self._functions[function.start] = function
+
+        for address, name, type in header['symbols']:
+            symbol = Symbol(type, address, str(name))
+            self.symbols[symbol.name] = symbol
+            self._symbols_by_address[address] = symbol
+
+    def _read_table(self, tables, name):
+        offset, count = tables[name]
+        code = dict(TABLES)[name]
+        return struct.unpack_from(
+            '<{}{}'.format(count, code), self._mapped, offset
+        )
+
+    @property
+    def functions(self):
+        return [self._functions[start] for start in sorted(self._functions)]
+
+    def read(self, address, length):
+        index = bisect.bisect_right(self._segment_starts, address) - 1
+
+        if index < 0:
+            return b''
+
+        segment = self.segments[index]
+        offset = segment.data_offset
+        start = address - segment.start
+
+        if start >= segment.data_length:
+            return b''
+
+        end = min(start + length, segment.data_length)
+        return self._mapped[offset + start:offset + end]
+
+    def get_segment_at(self, address):
+        index = bisect.bisect_right(self._segment_starts, address) - 1
+
+        if index >= 0 and address < self.segments[index].end:
+            return self.segments[index]
+
+        return None
+
+    def get_function_at(self, address, plat=None):
+        return self._functions.get(address)
+
+    def get_symbol_at(self, address):
+        return self._symbols_by_address.get(address)
+
+    def get_symbols_by_name(self, name):
+        symbol = self.symbols.get(name)
+        return [symbol] if symbol is not None else []
+
+    def get_instruction_length(self, address, arch=None):
+        if self._lengths is None:
+            self._lengths = {}
+            for function in self._functions.values():
+                lengths = self._read_table(
+                    function.low_level_il._tables, 'lengths'
+                )
+                self._lengths.update(zip(lengths[::2], lengths[1::2]))
+
+        return self._lengths.get(address, 0)
+
+    def create_user_function(self, address, plat=None):
+        raise errors.UnimplementedError(
+            'No function at {:x} in the image, and no analysis to make '
+            'one'.format(address)
+        )
+
+    def update_analysis(self):
+        pass
+
+    def update_analysis_and_wait(self):
+        pass
+
+
+def load(path):
+    return BinaryView(path)
+
+
+_loaded = {}
+
+
+def _load_function(path, start):
+    # Unpickling functions from one image shares one view
+    view = _loaded.get(path)
+
+    if view is None:
+        view = _loaded[path] = load(path)
+
+    return view.get_function_at(start).low_level_il
+
+
+def export(path, view, functions=None):
+    # Writes the LLIL of functions (Functions or addresses; all of the
+    # view's by default) and the view's segments to an image at path.
+    if functions is None:
+        functions = view.functions
+
+    functions = [
+        view.get_function_at(function)
+        if isinstance(function, (int, long)) else function
+        for function in functions
+    ]
+
+    arch = functions[0].arch if functions else view.arch
+
+    with open(path, 'w+b') as fp:
+        fp.write(MAGIC)
+        fp.write(PREFIX.pack(VERSION, 0))
+
+        operations = {}
+        schemas = []
+        write_types = []
+
+        header = {
+            'arch': _export_arch(arch),
+            'calling_convention': _export_calling_convention(view),
+            'operations': schemas,
+            'flag_write_types': write_types,
+            'segments': [],
+            'functions': [],
+            'symbols': [],
+        }
+
+        for segment in view.segments:
+            data = view.read(segment.start, segment.length)
+            header['segments'].append(
+                [segment.start, segment.length, int(segment.flags),
+                 fp.tell(), len(data)]
+            )
+            fp.write(data)
+
+        for function in functions:
+            tables = _export_function(
+                function.low_level_il, view, operations, schemas, write_types
+            )
+            header['functions'].append({
+                'start': function.start,
+                'name': function.name,
+                'tables': dict(
+                    (name, _write_table(fp, code, tables[name]))
+                    for name, code in TABLES
+                ),
+            })
+
+            symbol = view.get_symbol_at(function.start)
+            if symbol is not None:
+                header['symbols'].append(
+                    [function.start, symbol.name, int(symbol.type)]
+                )
+
+        header_offset = fp.tell()
+        fp.write(json.dumps(header, sort_keys=True).encode('utf-8'))
+
+        fp.seek(len(MAGIC))
+        fp.write(PREFIX.pack(VERSION, header_offset))
+
+
+def _export_function(function, view, operations, schemas, write_types):
+    tables = dict((name, []) for name, code in TABLES)
+    lengths = {}
+
+    def add(expression):
+        operation = expression.operation
+        schema = expression.ILOperations[operation]
+
+        values = []
+        for name, kind in schema:
+            value = getattr(expression, name)
+
+            if kind == 'expr':
+                values.append(add(value))
+            elif kind in INDEXED:
+                values.append(getattr(value, 'index', value))
+            elif kind == 'expr_list':
+                items = [add(item) for item in value]
+                values.append(len(items))
+                values.extend(items)
+            elif kind == 'int_list':
+                values.append(len(value))
+                values.extend(_signed(item) for item in value)
+            elif kind == 'target_map':
+                values.append(len(value))
+                for address, index in sorted(value.items()):
+                    values.extend((_signed(address), index))
+            elif kind in ('int', 'cond'):
+                values.append(_signed(int(value)))
+            else:
+                raise ValueError(
+                    'Cannot export {} operand {} of kind {}'.format(
+                        operation.name, name, kind
+                    )
+                )
+
+        key = operation.name
+        if key not in operations:
+            operations[key] = len(schemas)
+            schemas.append([key, [list(item) for item in schema]])
+
+        tables['operations'].append(operations[key])
+        tables['sizes'].append(expression.size or 0)
+
+        write_type = getattr(expression, 'flags', None)
+        if write_type:
+            if write_type not in write_types:
+                write_types.append(write_type)
+            tables['flags'].append(write_types.index(write_type) + 1)
+        else:
+            tables['flags'].append(0)
+        tables['addresses'].append(expression.address)
+        tables['operands'].append(len(tables['pool']))
+        tables['pool'].extend(values)
+
+        return len(tables['operations']) - 1
+
+    for index in range(len(function)):
+        instruction = function[index]
+        tables['instructions'].append(add(instruction))
+
+        if instruction.address not in lengths:
+            lengths[instruction.address] = view.get_instruction_length(
+                instruction.address, function.arch
+            ) or 0
+
+    for block in function.basic_blocks:
+        tables['blocks'].extend((block.start, block.end))
+
+    for address in sorted(lengths):
+        tables['lengths'].extend((address, lengths[address]))
+
+    return tables
+
+
+def _export_arch(arch):
+    regs = {}
+    for name, info in arch.regs.items():
+        index = getattr(info, 'index', None)
+        if index is None:
+            index = arch.get_reg_index(name)
+        regs[name] = [
+            info.full_width_reg, info.size, info.offset, int(info.extend),
+            index
+        ]
+
+    return {
+        'name': arch.name,
+        'address_size': arch.address_size,
+        'default_int_size': arch.default_int_size,
+        'endianness': int(arch.endianness),
+        'stack_pointer': arch.stack_pointer,
+        'link_reg': arch.link_reg,
+        'regs': regs,
+        'flags': dict(
+            (flag, arch.get_flag_index(flag)) for flag in arch.flags
+        ),
+        'flag_roles': dict(
+            (flag, int(role)) for flag, role in arch.flag_roles.items()
+        ),
+        'flag_write_types': dict(
+            (write_type, list(flags)) for write_type, flags in
+            arch.flags_written_by_flag_write_type.items()
+        ),
+    }
+
+
+def _export_calling_convention(view):
+    platform = getattr(view, 'platform', None)
+    if platform is None:
+        return None
+
+    calling_convention = platform.default_calling_convention
+    if calling_convention is None:
+        return None
+
+    return {
+        'name': getattr(calling_convention, 'name', None),
+        'int_arg_regs': [str(reg) for reg in calling_convention.int_arg_regs],
+        'int_return_reg': calling_convention.int_return_reg,
+    }
+
+
+def _write_table(fp, code, values):
+    offset = fp.tell()
+    fp.write(struct.pack('<{}{}'.format(len(values), code), *values))
+    return [offset, len(values)]
+
+
+def _signed(value):
+    value &= (1 << 64) - 1
+    if value & (1 << 63):
+        value -= 1 << 64
+    return value
+
+
+def _str(value):
+    return str(value) if value is not None else None
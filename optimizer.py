@@ -0,0 +1,632 @@
+import lazyflags
+import offline
+import registers
+import translation
+
+try:
+    from binaryninja import LLIL_GET_TEMP_REG_INDEX, LLIL_REG_IS_TEMP
+except ImportError:
+    from offline import LLIL_GET_TEMP_REG_INDEX, LLIL_REG_IS_TEMP
+
+# A pass over a LowLevelILFunction before it runs: constant subtrees are
+# folded, ZX dropped, temps read once forwarded into their one reader,
+# and temp and flag writes nothing reads removed. The result keeps every
+# instruction at its index, removed ones as LLIL_NOP, so branch targets,
+# call frames, traces and checkpoints all still refer to the original.
+#
+# Values are the same the original computes wherever control can leave
+# a block. In between, a forwarded or dead temp is never written, and a
+# dead flag write is skipped, so code, instruction and memory hooks
+# (which could look) turn the optimized code off in the emulator, and
+# state saved in the middle of a block only resumes with it on. Reading an
+# undefined register is the one failure that can move: a forwarded read
+# fails where its value is used, and a removed one doesn't fail at all.
+
+CONSTANTS = frozenset(['LLIL_CONST', 'LLIL_CONST_PTR'])
+
+# Operations that LLILCompiler computes with their own visit method
+# rather than through lazyflags when they write no flags
+PLAIN = frozenset([
+    'LLIL_ADD', 'LLIL_SUB', 'LLIL_AND', 'LLIL_OR', 'LLIL_XOR', 'LLIL_LSL',
+    'LLIL_LSR'
+])
+
+
+def _mask(size):
+    return (1 << size * 8) - 1
+
+
+def _signed_less(size, left, right):
+    sign_bit = 1 << ((size * 8) - 1)
+    modulus = 1 << (size * 8)
+    if left & sign_bit:
+        left -= modulus
+    if right & sign_bit:
+        right -= modulus
+    return left < right
+
+
+def _sign_extend(size, value):
+    sign_bit = 1 << ((size * 8) - 1)
+    return (value & (sign_bit - 1)) - (value & sign_bit)
+
+
+def _arithmetic(name, evaluate):
+    # A flagless operation compiled by LLILCompiler._compile_arithmetic
+    if name in lazyflags.UNARY:
+        def compute(size, src):
+            mask = _mask(size)
+            return evaluate(src & mask, 0, 0, size * 8) & mask
+
+    elif name in lazyflags.WITH_CARRY:
+        def compute(size, left, right, carry):
+            mask = _mask(size)
+            return evaluate(
+                left & mask, right & mask, int(carry), size * 8
+            ) & mask
+
+    else:
+        def compute(size, left, right):
+            mask = _mask(size)
+            return evaluate(left & mask, right & mask, 0, size * 8) & mask
+
+    return compute
+
+
+# Operations without side effects, computed exactly as LLILCompiler's
+# code for them does when they write no flags, so a folded constant is
+# the very value the original would have produced
+PURE = {
+    'LLIL_ADD': lambda size, left, right: (left + right) & _mask(size),
+    'LLIL_SUB': lambda size, left, right: left - right,
+    'LLIL_AND': lambda size, left, right: left & right,
+    'LLIL_OR': lambda size, left, right: left | right,
+    'LLIL_XOR': lambda size, left, right: left ^ right,
+    'LLIL_LSL': lambda size, left, right: (left << right) & _mask(size),
+    'LLIL_LSR': lambda size, left, right: left >> right,
+    'LLIL_CMP_E': lambda size, left, right: left == right,
+    'LLIL_CMP_NE': lambda size, left, right: left != right,
+    'LLIL_CMP_UGT': lambda size, left, right: left > right,
+    'LLIL_CMP_SLT': _signed_less,
+    'LLIL_SX': _sign_extend,
+    'LLIL_ZX': lambda size, src: src,
+}
+
+for _name, _evaluate in lazyflags.OPERATIONS.items():
+    if _name not in PURE:
+        PURE[_name] = _arithmetic(_name, _evaluate)
+
+# Operand names, in binaryninja's order, of the operations the pass
+# looks into. Any other operation is left as it is, and taken to read
+# and write anything.
+OPERANDS = {
+    'LLIL_NOP': (),
+    'LLIL_SET_REG': ('dest', 'src'),
+    'LLIL_SET_FLAG': ('dest', 'src'),
+    'LLIL_LOAD': ('src',),
+    'LLIL_STORE': ('dest', 'src'),
+    'LLIL_REG': ('src',),
+    'LLIL_FLAG': ('src',),
+    'LLIL_CONST': ('constant',),
+    'LLIL_CONST_PTR': ('constant',),
+    'LLIL_GOTO': ('dest',),
+    'LLIL_IF': ('condition', 'true', 'false'),
+    'LLIL_JUMP': ('dest',),
+}
+
+# ... and which of them are expressions
+EXPRESSIONS = {
+    'LLIL_NOP': (),
+    'LLIL_SET_REG': ('src',),
+    'LLIL_SET_FLAG': ('src',),
+    'LLIL_LOAD': ('src',),
+    'LLIL_STORE': ('dest', 'src'),
+    'LLIL_REG': (),
+    'LLIL_FLAG': (),
+    'LLIL_CONST': (),
+    'LLIL_CONST_PTR': (),
+    'LLIL_GOTO': (),
+    'LLIL_IF': ('condition',),
+    'LLIL_JUMP': ('dest',),
+}
+
+for _name in PURE:
+    if _name in lazyflags.UNARY or _name in ('LLIL_SX', 'LLIL_ZX'):
+        OPERANDS[_name] = EXPRESSIONS[_name] = ('src',)
+    elif _name in lazyflags.WITH_CARRY:
+        OPERANDS[_name] = EXPRESSIONS[_name] = ('left', 'right', 'carry')
+    else:
+        OPERANDS[_name] = EXPRESSIONS[_name] = ('left', 'right')
+
+# Instructions that write nothing but their destination, if anything,
+# and only after reading all their operands
+ROOTS = frozenset([
+    'LLIL_NOP', 'LLIL_SET_REG', 'LLIL_SET_FLAG', 'LLIL_STORE', 'LLIL_GOTO',
+    'LLIL_IF', 'LLIL_JUMP'
+])
+
+
+class Optimizer(object):
+    # Optimized instructions per function, worked out the first time a
+    # function is asked for. One optimizer can serve any number of
+    # emulators; see Emilator.set_optimizer().
+    def __init__(self):
+        self._functions = {}
+
+    def __contains__(self, function):
+        return function in self._functions
+
+    def optimize(self, function):
+        # The list of optimized instructions, by instr_index
+        instructions = self._functions.get(function)
+
+        if instructions is None:
+            instructions = self._functions[function] = _Pass(function).run()
+
+        return instructions
+
+    def clear(self):
+        self._functions = {}
+
+
+def _temp(register):
+    index = getattr(register, 'index', register)
+
+    if isinstance(index, (int, long)) and LLIL_REG_IS_TEMP(index):
+        return LLIL_GET_TEMP_REG_INDEX(index)
+
+    return None
+
+
+class _Pass(object):
+    def __init__(self, function):
+        self._function = function
+        self._arch = function.arch
+        self._layout = registers.get_layout(function.arch)
+        self._flags_written = {}
+
+        # temp index -> how many times it's read and written, and temps
+        # that operations the pass doesn't know touch
+        self._uses = {}
+        self._defs = {}
+        self._opaque = set()
+
+    def run(self):
+        function = self._function
+        originals = [function[index] for index in range(len(function))]
+        instructions = list(originals)
+
+        for instruction in instructions:
+            self._count_temps(instruction)
+
+        blocks = [(block.start, block.end) for block in function.basic_blocks]
+
+        for start, end in blocks:
+            self._forward_temps(instructions, start, end)
+
+        self._drop_dead_temps(instructions)
+
+        for start, end in blocks:
+            self._drop_dead_flags(instructions, start, end)
+
+        for index, instruction in enumerate(instructions):
+            if instruction is not originals[index]:
+                instruction.instr_index = index
+
+        return instructions
+
+    def _count_temps(self, node):
+        name = node.operation.name
+
+        if name == 'LLIL_REG':
+            temp = _temp(node.src)
+            if temp is not None:
+                self._uses[temp] = self._uses.get(temp, 0) + 1
+            return
+
+        if name == 'LLIL_SET_REG':
+            temp = _temp(node.dest)
+            if temp is not None:
+                self._defs[temp] = self._defs.get(temp, 0) + 1
+
+        if name in EXPRESSIONS:
+            for operand in EXPRESSIONS[name]:
+                self._count_temps(getattr(node, operand))
+            return
+
+        self._count_opaque(node.operands)
+
+    def _count_opaque(self, operands):
+        for operand in operands:
+            if hasattr(operand, 'operation'):
+                self._count_temps(operand)
+            elif isinstance(operand, (list, tuple)):
+                self._count_opaque(operand)
+            else:
+                temp = _temp(operand)
+                if temp is not None:
+                    self._opaque.add(temp)
+
+    def _forward_temps(self, instructions, start, end):
+        # temp -> (index of its write, the value written, what that reads)
+        # for temps whose one read may still come later in the block
+        pending = {}
+
+        for index in range(start, end):
+            instruction = instructions[index]
+            name = instruction.operation.name
+
+            if not self._quiet_root(instruction):
+                pending.clear()
+                continue
+
+            if pending:
+                instruction = self._substitute(
+                    instruction, pending, instructions
+                )
+
+            instruction = self._simplify(instruction)
+            instructions[index] = instruction
+
+            if instruction.operation.name == 'LLIL_SET_REG':
+                written = self._key(instruction.dest)
+
+                for temp, (_, _, reads) in list(pending.items()):
+                    if written in reads:
+                        del pending[temp]
+
+                temp = _temp(instruction.dest)
+                if (temp is not None and self._uses.get(temp) == 1 and
+                        self._defs.get(temp) == 1 and
+                        temp not in self._opaque and
+                        self._pure(instruction.src)):
+                    reads = self._reads(instruction.src)
+                    if written not in reads:
+                        pending[temp] = (index, instruction.src, reads)
+
+            if name in translation.BLOCK_EXITS:
+                pending.clear()
+
+    def _substitute(self, node, pending, instructions):
+        name = node.operation.name
+
+        if name == 'LLIL_REG':
+            temp = _temp(node.src)
+            if temp in pending:
+                index, value, _ = pending.pop(temp)
+                instructions[index] = self._nop(instructions[index])
+                return value
+            return node
+
+        changes = {}
+        for operand in EXPRESSIONS.get(name, ()):
+            child = getattr(node, operand)
+            substituted = self._substitute(child, pending, instructions)
+            if substituted is not child:
+                changes[operand] = substituted
+
+        if changes:
+            return self._copy(node, changes)
+
+        return node
+
+    def _simplify(self, node):
+        name = node.operation.name
+        operands = EXPRESSIONS.get(name)
+
+        if operands is None:
+            return node
+
+        changes = {}
+        values = []
+        for operand in operands:
+            child = getattr(node, operand)
+            simplified = self._simplify(child)
+            if simplified is not child:
+                changes[operand] = simplified
+            values.append(simplified)
+
+        # Compiled ZX hands back its operand as it is
+        if name == 'LLIL_ZX':
+            return values[0]
+
+        if (name in PURE and not node.flags and
+                all(value.operation.name in CONSTANTS for value in values)):
+            try:
+                result = PURE[name](
+                    node.size, *[value.constant for value in values]
+                )
+            except (ValueError, ZeroDivisionError):
+                pass
+            else:
+                return self._node(
+                    node, 'LLIL_CONST', node.size, None, {'constant': result}
+                )
+
+        if name == 'LLIL_IF' and values[0].operation.name in CONSTANTS:
+            dest = node.true if values[0].constant else node.false
+            return self._node(node, 'LLIL_GOTO', node.size, None,
+                              {'dest': dest})
+
+        if changes:
+            return self._copy(node, changes)
+
+        return node
+
+    def _drop_dead_temps(self, instructions):
+        for index, instruction in enumerate(instructions):
+            if instruction.operation.name != 'LLIL_SET_REG':
+                continue
+
+            temp = _temp(instruction.dest)
+            if (temp is not None and not self._uses.get(temp) and
+                    temp not in self._opaque and
+                    self._pure(instruction.src)):
+                instructions[index] = self._nop(instruction)
+
+    def _drop_dead_flags(self, instructions, start, end):
+        # Backwards through the block: a flag write is dead if every flag
+        # it writes is written again before anything reads it. Flags are
+        # all live where the block can be left.
+        overwritten = set()
+
+        for index in range(end - 1, start - 1, -1):
+            instruction = instructions[index]
+            name = instruction.operation.name
+
+            if (name in translation.BLOCK_EXITS or
+                    not self._quiet_root(instruction)):
+                overwritten = set()
+                continue
+
+            reads = set()
+            writers = []
+            if not self._flag_effects(instruction, reads, writers):
+                overwritten = set()
+                continue
+
+            if reads:
+                overwritten -= reads
+                continue
+
+            if len(writers) == 1:
+                writer = writers[0]
+                if self._written_by(writer.flags) <= overwritten:
+                    dropped = self._drop_flags(instruction, writer)
+                    if dropped is not None:
+                        instructions[index] = dropped
+
+            for writer in writers:
+                overwritten |= self._written_by(writer.flags)
+
+            if name == 'LLIL_SET_FLAG':
+                overwritten.add(instruction.dest.index)
+
+    def _flag_effects(self, node, reads, writers):
+        # Fills in the flags node reads and its flag writing operations.
+        # False if it reads flags by role, which could be any of them.
+        name = node.operation.name
+
+        if name == 'LLIL_FLAG_COND':
+            return False
+
+        if name == 'LLIL_FLAG':
+            reads.add(node.src.index)
+            return True
+
+        if node.flags and name in lazyflags.OPERATIONS:
+            writers.append(node)
+
+        for operand in EXPRESSIONS.get(name, ()):
+            if not self._flag_effects(getattr(node, operand), reads, writers):
+                return False
+
+        return True
+
+    def _drop_flags(self, instruction, writer):
+        if writer is instruction:
+            # Its value is thrown away, so it needn't keep the masking
+            # it gets from being compiled as a flag write
+            if all(self._pure(getattr(instruction, operand))
+                   for operand in EXPRESSIONS[instruction.operation.name]):
+                return self._nop(instruction)
+            return self._node(
+                instruction, instruction.operation.name, instruction.size,
+                None, dict((operand, getattr(instruction, operand))
+                           for operand in OPERANDS[instruction.operation.name])
+            )
+
+        if not self._same_without_flags(writer):
+            return None
+
+        return self._replace(instruction, writer)
+
+    def _replace(self, node, writer):
+        if node is writer:
+            return self._node(
+                node, node.operation.name, node.size, None,
+                dict((operand, getattr(node, operand))
+                     for operand in OPERANDS[node.operation.name])
+            )
+
+        changes = {}
+        for operand in EXPRESSIONS.get(node.operation.name, ()):
+            child = getattr(node, operand)
+            replaced = self._replace(child, writer)
+            if replaced is not child:
+                changes[operand] = replaced
+
+        if changes:
+            return self._copy(node, changes)
+
+        return node
+
+    def _same_without_flags(self, node):
+        # Whether node, compiled without its flags, gives the same value.
+        # Flag writes mask their operands; most plain versions don't.
+        name = node.operation.name
+
+        if name not in PLAIN or name == 'LLIL_ADD':
+            return True
+
+        size = node.size
+
+        if name == 'LLIL_AND':
+            return (self._in_range(node.left, size) or
+                    self._in_range(node.right, size))
+
+        if name in ('LLIL_OR', 'LLIL_XOR'):
+            return (self._in_range(node.left, size) and
+                    self._in_range(node.right, size))
+
+        if name in ('LLIL_LSL', 'LLIL_LSR'):
+            right = node.right
+            if (right.operation.name not in CONSTANTS or
+                    not 0 <= right.constant <= _mask(size)):
+                return False
+            return name == 'LLIL_LSL' or self._in_range(node.left, size)
+
+        return False
+
+    def _in_range(self, node, size):
+        # Whether node's value is known to be unsigned and fit size bytes
+        name = node.operation.name
+        mask = _mask(size)
+
+        if name in CONSTANTS:
+            return 0 <= node.constant <= mask
+
+        if name == 'LLIL_REG':
+            if _temp(node.src) is not None:
+                return False
+            return self._layout[node.src].mask <= mask
+
+        if name == 'LLIL_LOAD':
+            return node.size <= size
+
+        if name == 'LLIL_ZX':
+            return self._in_range(node.src, size)
+
+        if name.startswith('LLIL_CMP_'):
+            return name in PURE
+
+        if name in lazyflags.OPERATIONS:
+            if node.flags or name not in PLAIN or name in ('LLIL_ADD',
+                                                             'LLIL_LSL'):
+                return node.size <= size
+
+            if name == 'LLIL_AND':
+                return (self._in_range(node.left, size) or
+                        self._in_range(node.right, size))
+
+            if name in ('LLIL_OR', 'LLIL_XOR'):
+                return (self._in_range(node.left, size) and
+                        self._in_range(node.right, size))
+
+            if name == 'LLIL_LSR':
+                return self._in_range(node.left, size)
+
+        return False
+
+    def _quiet_root(self, instruction):
+        # An instruction that writes at most its own destination and
+        # transfers control at most by branching within the function
+        name = instruction.operation.name
+
+        if name not in ROOTS:
+            return self._quiet(instruction)
+
+        return all(
+            self._quiet(getattr(instruction, operand))
+            for operand in EXPRESSIONS[name]
+        )
+
+    def _quiet(self, node):
+        # An expression that writes nothing but, perhaps, flags
+        name = node.operation.name
+
+        if name in CONSTANTS or name in ('LLIL_REG', 'LLIL_FLAG',
+                                         'LLIL_FLAG_COND'):
+            return True
+
+        if name == 'LLIL_LOAD':
+            return self._quiet(node.src)
+
+        if name not in PURE:
+            return False
+
+        if node.flags and name not in lazyflags.OPERATIONS:
+            return False
+
+        return all(
+            self._quiet(getattr(node, operand)) for operand in OPERANDS[name]
+        )
+
+    def _pure(self, node):
+        # An expression that reads registers at most
+        name = node.operation.name
+
+        if name in CONSTANTS or name == 'LLIL_REG':
+            return True
+
+        if name not in PURE or node.flags:
+            return False
+
+        return all(
+            self._pure(getattr(node, operand)) for operand in OPERANDS[name]
+        )
+
+    def _reads(self, node, reads=None):
+        if reads is None:
+            reads = set()
+
+        if node.operation.name == 'LLIL_REG':
+            reads.add(self._key(node.src))
+
+        for operand in EXPRESSIONS.get(node.operation.name, ()):
+            self._reads(getattr(node, operand), reads)
+
+        return reads
+
+    def _key(self, register):
+        # What a register shares storage with: a temp, or a full width
+        # register's slot
+        temp = _temp(register)
+
+        if temp is not None:
+            return ('temp', temp)
+
+        return self._layout[register].slot
+
+    def _written_by(self, write_type):
+        written = self._flags_written.get(write_type)
+
+        if written is None:
+            written = self._flags_written[write_type] = (
+                lazyflags.flags_written(self._arch, write_type)
+            )
+
+        return written
+
+    def _nop(self, instruction):
+        return self._node(instruction, 'LLIL_NOP', 0, None, {})
+
+    def _copy(self, node, changes):
+        name = node.operation.name
+        values = dict(
+            (operand, changes.get(operand, getattr(node, operand)))
+            for operand in OPERANDS[name]
+        )
+        return self._node(node, name, node.size, node.flags, values)
+
+    def _node(self, template, name, size, flags, values):
+        node = offline.LowLevelILInstruction(
+            self._function, offline.Operation(name), size, flags,
+            template.address, template.expr_index
+        )
+
+        for operand in OPERANDS[name]:
+            setattr(node, operand, values[operand])
+        node.operands = [values[operand] for operand in OPERANDS[name]]
+
+        return node
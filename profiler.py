@@ -0,0 +1,167 @@
+import bisect
+import json
+import timeit
+
+COUNT = 0
+TOTAL = 1
+SELF = 2
+
+
+class Profiler(object):
+    # Counters are [count, total time, self time] lists, keyed by
+    # operation name, by (function start, block start index) and by
+    # function start. The emulator wraps its compiled code with the
+    # closures made here, so none of this runs unless a profiler is set.
+    def __init__(self, clock=timeit.default_timer):
+        self.operations = {}
+        self.blocks = {}
+        self.functions = {}
+
+        self._clock = clock
+        self._nested = 0.0
+        self._block_starts = {}
+
+    def clear(self):
+        for counters in (self.operations, self.blocks, self.functions):
+            for stats in counters.values():
+                stats[:] = [0, 0.0, 0.0]
+
+    def _stats(self, counters, key):
+        stats = counters.get(key)
+
+        if stats is None:
+            stats = counters[key] = [0, 0.0, 0.0]
+
+        return stats
+
+    def operation(self, name, code):
+        # Time spent in an expression counts towards its own operation's
+        # self time, less whatever its operands took.
+        stats = self._stats(self.operations, name)
+        clock = self._clock
+        profiler = self
+
+        def profiled():
+            nested = profiler._nested
+            profiler._nested = 0.0
+            start = clock()
+            try:
+                return code()
+            finally:
+                elapsed = clock() - start
+                stats[COUNT] += 1
+                stats[TOTAL] += elapsed
+                stats[SELF] += elapsed - profiler._nested
+                profiler._nested = nested + elapsed
+
+        return profiled
+
+    def instruction(self, function, function_start, index, code):
+        block_start = self._block_start(function, index)
+        block = self._stats(self.blocks, (function_start, block_start))
+        current = self._stats(self.functions, function_start)
+        clock = self._clock
+
+        if index == block_start:
+            def profiled():
+                block[COUNT] += 1
+                start = clock()
+                try:
+                    return code()
+                finally:
+                    elapsed = clock() - start
+                    block[TOTAL] += elapsed
+                    current[TOTAL] += elapsed
+
+        else:
+            def profiled():
+                start = clock()
+                try:
+                    return code()
+                finally:
+                    elapsed = clock() - start
+                    block[TOTAL] += elapsed
+                    current[TOTAL] += elapsed
+
+        return profiled
+
+    def enter(self, function_start):
+        # Counts a call into a function
+        self._stats(self.functions, function_start)[COUNT] += 1
+
+    def _block_start(self, function, index):
+        starts = self._block_starts.get(function)
+
+        if starts is None:
+            try:
+                starts = sorted(block.start for block in function.basic_blocks)
+            except Exception:
+                starts = [0]
+            self._block_starts[function] = starts
+
+        position = bisect.bisect_right(starts, index) - 1
+
+        return starts[position] if position >= 0 else 0
+
+    def hot_spots(self, counters, key=SELF):
+        # (key, stats) pairs, hottest first. Blocks and functions only
+        # track total time, which is also their self time.
+        if counters is not self.operations and key == SELF:
+            key = TOTAL
+
+        return sorted(
+            counters.items(), key=lambda item: item[1][key], reverse=True
+        )
+
+    def report(self, limit=20):
+        lines = []
+
+        lines.append('{:<24} {:>12} {:>12} {:>12}'.format(
+            'operation', 'count', 'self (s)', 'total (s)'
+        ))
+        for name, stats in self.hot_spots(self.operations)[:limit]:
+            lines.append('{:<24} {:>12} {:>12.6f} {:>12.6f}'.format(
+                name, stats[COUNT], stats[SELF], stats[TOTAL]
+            ))
+
+        lines.append('')
+        lines.append('{:<24} {:>12} {:>12}'.format(
+            'block', 'entries', 'time (s)'
+        ))
+        for (start, index), stats in self.hot_spots(self.blocks)[:limit]:
+            lines.append('{:<24} {:>12} {:>12.6f}'.format(
+                '{:x}:{}'.format(start, index), stats[COUNT], stats[TOTAL]
+            ))
+
+        lines.append('')
+        lines.append('{:<24} {:>12} {:>12}'.format(
+            'function', 'calls', 'time (s)'
+        ))
+        for start, stats in self.hot_spots(self.functions)[:limit]:
+            lines.append('{:<24} {:>12} {:>12.6f}'.format(
+                '{:x}'.format(start), stats[COUNT], stats[TOTAL]
+            ))
+
+        return '\n'.join(lines)
+
+    def to_dict(self):
+        return {
+            'operations': [
+                {'operation': name, 'count': stats[COUNT],
+                 'self': stats[SELF], 'total': stats[TOTAL]}
+                for name, stats in self.hot_spots(self.operations)
+            ],
+            'blocks': [
+                {'function': start, 'start': index, 'entries': stats[COUNT],
+                 'time': stats[TOTAL]}
+                for (start, index), stats in self.hot_spots(self.blocks)
+            ],
+            'functions': [
+                {'function': start, 'calls': stats[COUNT],
+                 'time': stats[TOTAL]}
+                for start, stats in self.hot_spots(self.functions)
+            ],
+        }
+
+    def dump(self, fp):
+        json.dump(self.to_dict(), fp, indent=2, sort_keys=True)
@@ -0,0 +1,200 @@
+try:
+    from binaryninja import (
+        LLIL_GET_TEMP_REG_INDEX, LLIL_REG_IS_TEMP, ILRegister,
+        ImplicitRegisterExtend
+    )
+except ImportError:
+    from offline import (
+        LLIL_GET_TEMP_REG_INDEX, LLIL_REG_IS_TEMP, ILRegister,
+        ImplicitRegisterExtend
+    )
+
+import errors
+import offline
+
+NO_EXTEND = 0
+ZERO_EXTEND = 1
+SIGN_EXTEND = 2
+
+_extend_modes = {
+    ImplicitRegisterExtend.NoExtend: NO_EXTEND,
+    ImplicitRegisterExtend.ZeroExtendToFullWidth: ZERO_EXTEND,
+    ImplicitRegisterExtend.SignExtendToFullWidth: SIGN_EXTEND,
+}
+
+# Register operands come from binaryninja or from an offline image
+REGISTER_TYPES = (ILRegister, offline.ILRegister)
+
+_layouts = {}
+
+
+class RegisterSlot(object):
+    __slots__ = ('name', 'slot', 'size', 'offset', 'shift', 'mask',
+                 'full_mask', 'clear_mask', 'sign_bit', 'extend',
+                 'full_width')
+
+    def __init__(self, name, slot, size, offset, full_size, extend):
+        self.name = name
+        self.slot = slot
+        self.size = size
+        self.offset = offset
+        self.shift = offset * 8
+        self.mask = (1 << size * 8) - 1
+        self.full_mask = (1 << full_size * 8) - 1
+        self.clear_mask = self.full_mask ^ (self.mask << self.shift)
+        self.sign_bit = 1 << (size * 8 - 1)
+        self.extend = extend
+        self.full_width = offset == 0 and size == full_size
+
+    def __repr__(self):
+        return '<RegisterSlot: {} slot={} size={} offset={}>'.format(
+            self.name, self.slot, self.size, self.offset
+        )
+
+
+class RegisterLayout(object):
+    def __init__(self, arch):
+        self.arch_name = arch.name
+        self.names = []
+        self._info = {}
+
+        regs = arch.regs
+        slots = {}
+
+        for name in sorted(regs):
+            full_width_reg = regs[name].full_width_reg
+            if full_width_reg not in slots:
+                slots[full_width_reg] = len(self.names)
+                self.names.append(full_width_reg)
+
+        for name in regs:
+            reg_info = regs[name]
+            full_size = regs[reg_info.full_width_reg].size
+
+            info = RegisterSlot(
+                name, slots[reg_info.full_width_reg], reg_info.size,
+                reg_info.offset, full_size,
+                _extend_modes.get(reg_info.extend, NO_EXTEND)
+            )
+
+            self._info[name] = info
+
+            index = getattr(reg_info, 'index', None)
+            if index is None:
+                index = arch.get_reg_index(name)
+            self._info[index] = info
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, register):
+        if isinstance(register, REGISTER_TYPES):
+            register = register.index
+        return self._info[register]
+
+    def reader(self, register, regs, temps):
+        # Returns a closure reading register out of the regs/temps arrays
+        index = getattr(register, 'index', register)
+
+        if isinstance(index, (int, long)) and LLIL_REG_IS_TEMP(index):
+            return _temp_reader(LLIL_GET_TEMP_REG_INDEX(index), temps)
+
+        info = self[register]
+        slot = info.slot
+        mask = info.mask
+        shift = info.shift
+        name = info.name
+
+        def read():
+            value = regs[slot]
+            if value is None:
+                raise errors.UndefinedError(
+                    'Register {} not defined'.format(name)
+                )
+            return (value >> shift) & mask
+
+        return read
+
+    def writer(self, register, regs, temps):
+        # Returns a closure storing a value into register, merging it into
+        # its full width register the way the architecture defines
+        index = getattr(register, 'index', register)
+
+        if isinstance(index, (int, long)) and LLIL_REG_IS_TEMP(index):
+            return _temp_writer(LLIL_GET_TEMP_REG_INDEX(index), temps)
+
+        info = self[register]
+        slot = info.slot
+        mask = info.mask
+        shift = info.shift
+        full_mask = info.full_mask
+        clear_mask = info.clear_mask
+        sign_bit = info.sign_bit
+
+        if info.full_width or info.extend == ZERO_EXTEND:
+            def write(value):
+                value &= mask
+                regs[slot] = value
+                return value
+
+        elif info.extend == SIGN_EXTEND:
+            def write(value):
+                value &= mask
+                value = ((value & (sign_bit - 1)) - (value & sign_bit))
+                value &= full_mask
+                regs[slot] = value
+                return value
+
+        else:
+            names = self.names
+
+            def write(value):
+                full_value = regs[slot]
+                if full_value is None:
+                    raise errors.UndefinedError(
+                        'Register {} not defined'.format(names[slot])
+                    )
+                full_value &= clear_mask
+                full_value |= (value & mask) << shift
+                regs[slot] = full_value
+                return full_value
+
+        return write
+
+
+def _temp_reader(index, temps):
+    def read():
+        try:
+            value = temps[index]
+        except IndexError:
+            value = None
+
+        if value is None:
+            raise errors.UndefinedError(
+                'Register {} not defined'.format(index)
+            )
+
+        return value
+
+    return read
+
+
+def _temp_writer(index, temps):
+    def write(value):
+        try:
+            temps[index] = value
+        except IndexError:
+            temps.extend([None] * (index + 1 - len(temps)))
+            temps[index] = value
+        return value
+
+    return write
+
+
+def get_layout(arch):
+    layout = _layouts.get(arch.name)
+
+    if layout is None:
+        layout = _layouts[arch.name] = RegisterLayout(arch)
+
+    return layout
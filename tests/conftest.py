@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The plugin's modules import each other as top level modules
+sys.path.insert(
+    0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+)
@@ -0,0 +1,420 @@
+import atexit
+import os
+import shutil
+import tempfile
+
+import emilator
+import offline
+
+# Builds small LLIL functions without binaryninja. The Function and
+# BinaryView here are shaped like binaryninja's, just enough for
+# offline.export(); image() writes them out and loads them back, so
+# tests run on the same stand-ins a headless worker does.
+
+TEMP = 0x80000000
+
+READ_WRITE = (offline.SegmentFlag.SegmentReadable |
+              offline.SegmentFlag.SegmentWritable)
+
+LENGTH = 4
+
+FLAGS = ['c', 'p', 'a', 'z', 's', 'o']
+
+# An operation's operands, as (name, kind) pairs; the rest take two
+# expressions, left and right
+OPERANDS = {
+    'LLIL_NOP': [],
+    'LLIL_SET_REG': [('dest', 'reg'), ('src', 'expr')],
+    'LLIL_SET_REG_SPLIT': [('hi', 'reg'), ('lo', 'reg'), ('src', 'expr')],
+    'LLIL_SET_FLAG': [('dest', 'flag'), ('src', 'expr')],
+    'LLIL_LOAD': [('src', 'expr')],
+    'LLIL_STORE': [('dest', 'expr'), ('src', 'expr')],
+    'LLIL_PUSH': [('src', 'expr')],
+    'LLIL_POP': [],
+    'LLIL_REG': [('src', 'reg')],
+    'LLIL_CONST': [('constant', 'int')],
+    'LLIL_CONST_PTR': [('constant', 'int')],
+    'LLIL_FLAG': [('src', 'flag')],
+    'LLIL_FLAG_COND': [('condition', 'cond')],
+    'LLIL_JUMP': [('dest', 'expr')],
+    'LLIL_JUMP_TO': [('dest', 'expr'), ('targets', 'target_map')],
+    'LLIL_CALL': [('dest', 'expr')],
+    'LLIL_TAILCALL': [('dest', 'expr')],
+    'LLIL_RET': [('dest', 'expr')],
+    'LLIL_NORET': [],
+    'LLIL_IF': [('condition', 'expr'), ('true', 'int'), ('false', 'int')],
+    'LLIL_GOTO': [('dest', 'int')],
+    'LLIL_SX': [('src', 'expr')],
+    'LLIL_ZX': [('src', 'expr')],
+    'LLIL_LOW_PART': [('src', 'expr')],
+    'LLIL_NEG': [('src', 'expr')],
+    'LLIL_NOT': [('src', 'expr')],
+    'LLIL_BOOL_TO_INT': [('src', 'expr')],
+    'LLIL_SYSCALL': [],
+    'LLIL_BP': [],
+    'LLIL_TRAP': [('vector', 'int')],
+    'LLIL_UNDEF': [],
+    'LLIL_UNIMPL': [],
+    'LLIL_ADC': [('left', 'expr'), ('right', 'expr'), ('carry', 'expr')],
+    'LLIL_SBB': [('left', 'expr'), ('right', 'expr'), ('carry', 'expr')],
+    'LLIL_RLC': [('left', 'expr'), ('right', 'expr'), ('carry', 'expr')],
+    'LLIL_RRC': [('left', 'expr'), ('right', 'expr'), ('carry', 'expr')],
+}
+
+BRANCHES = frozenset([
+    'LLIL_RET', 'LLIL_JUMP', 'LLIL_JUMP_TO', 'LLIL_NORET', 'LLIL_TAILCALL'
+])
+
+
+class _Schemas(dict):
+    def __missing__(self, operation):
+        return OPERANDS.get(
+            operation.name, [('left', 'expr'), ('right', 'expr')]
+        )
+
+
+class Architecture(object):
+    # A little endian x86_64 subset
+    def __init__(self):
+        self.name = 'x86_64'
+        self.address_size = 8
+        self.default_int_size = 8
+        self.endianness = offline.Endianness.LittleEndian
+        self.stack_pointer = 'rsp'
+        self.link_reg = None
+
+        self.regs = {}
+
+        def add(name, full_width_reg, size, offset=0,
+                extend=offline.ImplicitRegisterExtend.NoExtend):
+            self.regs[name] = offline.RegisterInfo(
+                full_width_reg, size, offset, extend, len(self.regs)
+            )
+
+        zero_extend = offline.ImplicitRegisterExtend.ZeroExtendToFullWidth
+
+        for letter in 'abcd':
+            full = 'r{}x'.format(letter)
+            add(full, full, 8)
+            add('e{}x'.format(letter), full, 4, 0, zero_extend)
+            add('{}x'.format(letter), full, 2)
+            add('{}l'.format(letter), full, 1)
+            add('{}h'.format(letter), full, 1, 1)
+
+        for full in ('rsp', 'rbp', 'rsi', 'rdi', 'rip'):
+            add(full, full, 8)
+            add('e' + full[1:], full, 4, 0, zero_extend)
+
+        for number in range(8, 16):
+            full = 'r{}'.format(number)
+            add(full, full, 8)
+            add(full + 'd', full, 4, 0, zero_extend)
+
+        self.flags = list(FLAGS)
+        roles = offline.FlagRole
+        self.flag_roles = {
+            'c': roles.CarryFlagRole, 'p': roles.EvenParityFlagRole,
+            'a': roles.HalfCarryFlagRole, 'z': roles.ZeroFlagRole,
+            's': roles.NegativeSignFlagRole, 'o': roles.OverflowFlagRole,
+        }
+        self.flags_written_by_flag_write_type = {
+            '*': list(FLAGS), 'czs': ['c', 'z', 's'],
+        }
+
+    def get_reg_index(self, name):
+        if isinstance(name, (int, long)):
+            return name
+        return self.regs[name].index
+
+    def get_flag_index(self, name):
+        if isinstance(name, (int, long)):
+            return name
+        return FLAGS.index(name)
+
+
+ARCH = Architecture()
+
+
+class Expression(object):
+    ILOperations = _Schemas()
+
+    def __init__(self, name, size, operands, flags=None):
+        self.operation = offline.Operation(name)
+        self.size = size
+        self.flags = flags
+        self.address = 0
+
+        for (operand, kind), value in zip(
+                self.ILOperations[self.operation], operands):
+            setattr(self, operand, value)
+
+    def _place(self, address):
+        self.address = address
+        for operand, kind in self.ILOperations[self.operation]:
+            if kind == 'expr':
+                getattr(self, operand)._place(address)
+
+
+class _Block(object):
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+
+
+class Function(object):
+    # Both the source function and its low_level_il. Instructions are
+    # placed LENGTH bytes apart from start, unless given an address.
+    def __init__(self, start=0x1000, name=None):
+        self.start = start
+        self.name = name or 'sub_{:x}'.format(start)
+        self.arch = ARCH
+        self._instructions = []
+
+    @property
+    def low_level_il(self):
+        return self
+
+    def __len__(self):
+        return len(self._instructions)
+
+    def __getitem__(self, index):
+        return self._instructions[index]
+
+    def append(self, expression, address=None):
+        if address is None:
+            address = self.start + len(self._instructions) * LENGTH
+        expression._place(address)
+        self._instructions.append(expression)
+        return len(self._instructions) - 1
+
+    def extend(self, expressions):
+        for expression in expressions:
+            self.append(expression)
+
+    @property
+    def basic_blocks(self):
+        leaders = set([0])
+
+        for index, instruction in enumerate(self._instructions):
+            name = instruction.operation.name
+            if name == 'LLIL_GOTO':
+                leaders.update((instruction.dest, index + 1))
+            elif name == 'LLIL_IF':
+                leaders.update(
+                    (instruction.true, instruction.false, index + 1)
+                )
+            elif name in BRANCHES:
+                leaders.add(index + 1)
+
+        leaders = sorted(
+            leader for leader in leaders if leader < len(self)
+        )
+        return [
+            _Block(start, end)
+            for start, end in zip(leaders, leaders[1:] + [len(self)])
+        ]
+
+    # Expressions, named as in binaryninja's LowLevelILFunction
+
+    def expr(self, name, size, *operands, **kwargs):
+        return Expression(name, size, operands, kwargs.get('flags'))
+
+    def op(self, name, size, *operands, **kwargs):
+        return self.expr('LLIL_' + name, size, *operands, **kwargs)
+
+    def reg(self, size, register):
+        return self.expr('LLIL_REG', size, _register(register))
+
+    def set_reg(self, size, register, value, flags=None):
+        return self.expr(
+            'LLIL_SET_REG', size, _register(register), value, flags=flags
+        )
+
+    def const(self, size, value):
+        return self.expr('LLIL_CONST', size, value)
+
+    def const_pointer(self, size, value):
+        return self.expr('LLIL_CONST_PTR', size, value)
+
+    def load(self, size, address):
+        return self.expr('LLIL_LOAD', size, address)
+
+    def store(self, size, address, value):
+        return self.expr('LLIL_STORE', size, address, value)
+
+    def push(self, size, value):
+        return self.expr('LLIL_PUSH', size, value)
+
+    def pop(self, size):
+        return self.expr('LLIL_POP', size)
+
+    def flag(self, name):
+        return self.expr('LLIL_FLAG', 0, FLAGS.index(name))
+
+    def set_flag(self, name, value):
+        return self.expr('LLIL_SET_FLAG', 0, FLAGS.index(name), value)
+
+    def flag_condition(self, condition):
+        return self.expr('LLIL_FLAG_COND', 0, condition)
+
+    def if_expr(self, condition, true, false):
+        return self.expr('LLIL_IF', 0, condition, true, false)
+
+    def goto(self, dest):
+        return self.expr('LLIL_GOTO', 0, dest)
+
+    def call(self, dest):
+        return self.expr('LLIL_CALL', 0, dest)
+
+    def tailcall(self, dest):
+        return self.expr('LLIL_TAILCALL', 0, dest)
+
+    def jump(self, dest):
+        return self.expr('LLIL_JUMP', 0, dest)
+
+    def jump_to(self, dest, targets):
+        return self.expr('LLIL_JUMP_TO', 0, dest, targets)
+
+    def ret(self, dest):
+        return self.expr('LLIL_RET', 0, dest)
+
+    def nop(self):
+        return self.expr('LLIL_NOP', 0)
+
+
+def _register(register):
+    if isinstance(register, (int, long)):
+        return register
+    return ARCH.regs[register].index
+
+
+def temp(number):
+    return TEMP | number
+
+
+class _CallingConvention(object):
+    name = 'sysv'
+    int_arg_regs = ['rdi', 'rsi', 'rdx', 'rcx', 'r8', 'r9']
+    int_return_reg = 'rax'
+
+
+class _Platform(object):
+    default_calling_convention = _CallingConvention()
+
+
+class Segment(object):
+    def __init__(self, start, data, flags):
+        self.start = start
+        self.length = len(data)
+        self.end = start + self.length
+        self.flags = flags
+        self.data = data
+
+
+class BinaryView(object):
+    def __init__(self, functions, segments=()):
+        self.arch = ARCH
+        self.platform = _Platform()
+        self.functions = list(functions)
+        self.segments = list(segments)
+
+    def get_function_at(self, address):
+        for function in self.functions:
+            if function.start == address:
+                return function
+        return None
+
+    def read(self, address, length):
+        for segment in self.segments:
+            if segment.start <= address < segment.end:
+                offset = address - segment.start
+                return segment.data[offset:offset + length]
+        return b''
+
+    def get_instruction_length(self, address, arch=None):
+        for function in self.functions:
+            for instruction in function._instructions:
+                if instruction.address == address:
+                    return LENGTH
+        return 0
+
+    def get_symbol_at(self, address):
+        return None
+
+
+_directory = tempfile.mkdtemp(prefix='emilator-tests-')
+atexit.register(shutil.rmtree, _directory, True)
+
+
+def image(functions, segments=()):
+    # The offline view of functions and segments ((start, data, flags))
+    handle, path = tempfile.mkstemp(suffix='.llil', dir=_directory)
+    os.close(handle)
+
+    view = BinaryView(functions, [
+        Segment(start, data, flags) for start, data, flags in segments
+    ])
+    offline.export(path, view, functions)
+
+    return offline.load(path)
+
+
+def load(function, segments=()):
+    # function's offline LowLevelILFunction
+    view = image([function], segments)
+    return view.get_function_at(function.start).low_level_il
+
+
+def visiting(emulator):
+    # Makes emulator run every instruction through visit(), the way it
+    # did before code was compiled; the reference the compiled code is
+    # checked against
+    emulator._compile_instruction = (
+        lambda function, index, visit=emulator.visit:
+        lambda: visit(function[index])
+    )
+    return emulator
+
+
+def state(emulator, ranges=()):
+    # Registers, flags and the data of ranges ((start, length)), for
+    # comparing two runs
+    flags = dict(
+        (name, bool(value))
+        for name, value in emulator._flag_values().items()
+    )
+    memory = [
+        emulator.read_block(start, length).tobytes()
+        for start, length in ranges
+    ]
+    return emulator.registers, flags, memory
+
+
+def run(function, registers=None, mapped=(), visit=False, **kwargs):
+    # An emulator that ran function to its end, after mapping mapped
+    # ((start, length)) and setting registers
+    emulator = emilator.Emilator(function, **kwargs)
+
+    if visit:
+        visiting(emulator)
+
+    for start, length in mapped:
+        emulator.map_memory(start, length)
+
+    for name, value in (registers or {}).items():
+        emulator.set_register_value(name, value)
+
+    emulator.run_until()
+
+    return emulator
+
+
+def check(function, registers=None, mapped=(), **kwargs):
+    # Runs function compiled and visited, and asserts both end the same;
+    # returns the compiled run
+    compiled = run(function, registers, mapped, **kwargs)
+    visited = run(function, registers, mapped, visit=True, **kwargs)
+
+    assert state(compiled, mapped) == state(visited, mapped)
+
+    return compiled
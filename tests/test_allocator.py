@@ -0,0 +1,66 @@
+import pytest
+
+import emilator
+import errors
+import llil
+import memory
+from llil import Function
+from memory import PAGE_SIZE
+
+
+def test_smallest_extent_that_fits():
+    space = memory.AddressSpace(0x1000, 0x100000)
+    space.reserve(0x3000, 0x4000)
+    space.reserve(0x6000, 0x100000)
+
+    assert list(space) == [(0x1000, 0x3000), (0x4000, 0x6000)]
+
+    # Both extents are two pages; the lower one wins the tie
+    assert space.allocate(1) == 0x1000
+    assert space.allocate(PAGE_SIZE + 1) == 0x4000
+    assert space.allocate(1) == 0x2000
+    assert list(space) == []
+
+    with pytest.raises(errors.MemoryAccessError):
+        space.allocate(1)
+
+
+def test_release_merges():
+    space = memory.AddressSpace(0x1000, 0x10000)
+    for start in range(0x1000, 0x10000, 0x1000):
+        space.reserve(start, start + 0x1000)
+
+    space.release(0x3000, 0x4000)
+    space.release(0x5000, 0x6000)
+    space.release(0x4000, 0x5000)
+    space.release(0x0, 0x2000)
+
+    assert list(space) == [(0x1000, 0x2000), (0x3000, 0x6000)]
+    assert space.allocate(0x3000) == 0x3000
+
+
+def test_alignment():
+    space = memory.AddressSpace(0x1000, 0x100000)
+
+    assert space.allocate(1, 0x10000) == 0x10000
+    assert list(space) == [(0x1000, 0x10000), (0x11000, 0x100000)]
+    assert space.allocate(0x10000, 0x10000) == 0x20000
+    assert space.allocate(0x8000) == 0x1000
+
+
+def test_map_and_unmap():
+    f = Function()
+    f.append(f.nop())
+    e = emilator.Emilator(llil.load(f))
+
+    first = e.map_memory(None, 0x1800)
+    second = e.map_memory(None, 0x1000, alignment=0x100000)
+    assert first % PAGE_SIZE == 0
+    assert second % 0x100000 == 0
+    assert first + 0x2000 <= second or second + 0x1000 <= first
+
+    e.unmap_memory(first, 0x2000)
+    assert e.map_memory(None, 0x2000) == first
+
+    with pytest.raises(errors.MemoryAccessError):
+        e.map_memory(None, 1 << 65)
@@ -0,0 +1,72 @@
+import warnings
+
+import batch
+import llil
+from llil import Function
+
+# Outside the function's own code at 0x1000
+DATA = 0x20000
+
+
+def _sum():
+    # rax = sum(1..rcx), stored at DATA
+    f = Function()
+    f.append(f.set_reg(8, 'rax', f.op(
+        'ADD', 8, f.reg(8, 'rax'), f.reg(8, 'rcx')
+    )))
+    f.append(f.set_reg(8, 'rcx', f.op(
+        'SUB', 8, f.reg(8, 'rcx'), f.const(8, 1)
+    )))
+    f.append(f.if_expr(f.op('CMP_E', 8, f.reg(8, 'rcx'), f.const(8, 0)),
+                       3, 0))
+    f.append(f.store(8, f.const(8, DATA), f.reg(8, 'rax')))
+    return llil.load(f)
+
+
+def _run(function, states, **kwargs):
+    # Forked workers inherit the filter, so a warning in a task fails it
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        results = list(batch.run_batch(
+            function, states, initial={
+                'registers': {'rax': 0}, 'map': [(DATA, 0x1000)],
+            }, processes=2, **kwargs
+        ))
+
+    for result in results:
+        assert 'SelfModifyingCodeWarning' not in (result.error or '')
+
+    return sorted(results, key=lambda result: result.index)
+
+
+def test_results():
+    states = [{'registers': {'rcx': n}} for n in range(1, 9)]
+    results = _run(_sum(), states)
+
+    assert [result.index for result in results] == list(range(8))
+    assert [result.registers['rax'] for result in results] == [
+        n * (n + 1) // 2 for n in range(1, 9)
+    ]
+    assert all(result.reason == batch.STOP_END for result in results)
+    assert all(result.error is None for result in results)
+    assert all(result.edges is None for result in results)
+
+
+def test_every_task_starts_from_the_snapshot():
+    states = [{'registers': {'rcx': 3}}] * 4
+    results = _run(_sum(), states)
+
+    assert set(result.registers['rax'] for result in results) == set([6])
+
+
+def test_limits_and_errors():
+    states = [
+        {'registers': {'rcx': 1000}},
+        {'registers': {'rcx': 2}, 'memory': {0x5000: b'x'}},
+    ]
+    limited, failed = _run(_sum(), states, max_instructions=10)
+
+    assert limited.reason == batch.STOP_LIMIT
+    assert limited.count == 10
+    assert failed.reason == batch.STOP_ERROR
+    assert 'MemoryAccessError' in failed.error
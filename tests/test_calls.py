@@ -0,0 +1,138 @@
+import pytest
+
+import emilator
+import errors
+import llil
+from llil import Function
+
+STACK = (0x7000, 0x1000)
+
+
+def _emulator(functions):
+    view = llil.image(functions)
+    e = emilator.Emilator(view.get_function_at(functions[0].start)
+                          .low_level_il)
+    e.map_memory(*STACK)
+    e.set_register_value('rsp', STACK[0] + STACK[1] - 8)
+    e.set_register_value('rax', 0)
+    return e
+
+
+def _recursive():
+    # rax = rcx, by calling itself rcx times
+    f = Function(0x1000)
+    f.append(f.set_reg(8, 'rcx', f.op(
+        'SUB', 8, f.reg(8, 'rcx'), f.const(8, 1)
+    )))
+    f.append(f.if_expr(f.op('CMP_E', 8, f.reg(8, 'rcx'), f.const(8, 0)),
+                       3, 2))
+    f.append(f.call(f.const_pointer(8, 0x1000)))
+    f.append(f.set_reg(8, 'rax', f.op(
+        'ADD', 8, f.reg(8, 'rax'), f.const(8, 1)
+    )))
+    f.append(f.ret(f.pop(8)))
+    return f
+
+
+def test_recursion():
+    e = _emulator([_recursive()])
+    e.set_register_value('rcx', 5)
+    depths = []
+
+    for _ in e.run():
+        depths.append(len(e._frames))
+
+    assert e.get_register_value('rax') == 5
+    assert max(depths) == 4
+    assert e._frames == []
+    assert e.get_register_value('rsp') == STACK[0] + STACK[1]
+    assert e.read_memory(STACK[0] + STACK[1] - 16, 8) == 0x100c
+
+
+def test_call_depth():
+    e = _emulator([_recursive()])
+    e.set_register_value('rcx', 5)
+    e.max_call_depth = 2
+
+    with pytest.raises(errors.CallDepthError):
+        e.run_until()
+    assert len(e._frames) == 2
+
+
+def test_jumps_and_unwinding():
+    # main calls a, which jumps out to b; b returns to main past a's
+    # frame, as longjmp would
+    main = Function(0x1000)
+    main.append(main.call(main.const_pointer(8, 0x2000)))
+    main.append(main.set_reg(8, 'rbx', main.const(8, 1)))
+    main.append(main.call(main.const_pointer(8, 0x2000)))
+    main.append(main.set_reg(8, 'rdx', main.const(8, 1)))
+
+    a = Function(0x2000)
+    a.append(a.call(a.const_pointer(8, 0x3000)))
+    a.append(a.jump(a.const_pointer(8, 0x3000)))
+
+    b = Function(0x3000)
+    b.append(b.set_reg(8, 'rax', b.op(
+        'ADD', 8, b.reg(8, 'rax'), b.const(8, 1)
+    )))
+    b.append(b.if_expr(b.op('CMP_E', 8, b.reg(8, 'rax'), b.const(8, 1)),
+                       2, 3))
+    b.append(b.ret(b.const_pointer(8, 0x1004)))
+    b.append(b.ret(b.pop(8)))
+
+    e = _emulator([main, a, b])
+    e.run_until()
+
+    assert e.get_register_value('rax') == 3
+    assert e.get_register_value('rbx') == 1
+    assert e.get_register_value('rdx') == 1
+    assert e._frames == []
+
+
+def test_return_to_no_frame_stops():
+    main = Function(0x1000)
+    main.append(main.call(main.const_pointer(8, 0x2000)))
+    main.append(main.set_reg(8, 'rbx', main.const(8, 1)))
+    main.append(main.set_reg(8, 'rdx', main.const(8, 1)))
+
+    callee = Function(0x2000)
+    callee.append(callee.ret(callee.const_pointer(8, 0x1008)))
+
+    e = _emulator([main, callee])
+    assert e.run_until().reason == emilator.STOP_RETURN
+    assert len(e._frames) == 1
+    assert e.function.source_function.start == 0x2000
+    assert 'rbx' not in e.registers
+
+
+def test_return_address_from_il(monkeypatch):
+    # Without instruction lengths from the view, a call returns to the
+    # first address lifted after it that isn't the call's own
+    monkeypatch.setattr(
+        llil.BinaryView, 'get_instruction_length',
+        lambda self, address, arch=None: 0
+    )
+
+    main = Function(0x1000)
+    main.append(main.call(main.const_pointer(8, 0x2000)))
+    main.append(main.set_reg(8, 'rbx', main.const(8, 1)), 0x1000)
+    main.append(main.set_reg(8, 'rdx', main.const(8, 1)), 0x1010)
+
+    callee = Function(0x2000)
+    callee.append(callee.ret(callee.pop(8)))
+
+    e = _emulator([main, callee])
+    e.run_until()
+
+    assert e.read_memory(STACK[0] + STACK[1] - 16, 8) == 0x1010
+    assert e.get_register_value('rbx') == 1
+    assert e.get_register_value('rdx') == 1
+
+    # A call with nothing lifted after it has nowhere to return to
+    last = Function(0x1000)
+    last.append(last.call(last.const_pointer(8, 0x2000)))
+    e = _emulator([last, callee])
+
+    with pytest.raises(errors.UndefinedError):
+        e.run_until()
@@ -0,0 +1,133 @@
+import warnings
+
+import pytest
+
+import checkpoint
+import emilator
+import llil
+from llil import Function
+from memory import PAGE_SIZE
+from offline import LowLevelILFlagCondition
+
+DATA = (0x10000, 0x3000)
+SEGMENT = 0x400000
+
+# A page and a half, so the last page is short in the view
+SEGMENT_DATA = b'\x5a' * (PAGE_SIZE + PAGE_SIZE // 2)
+
+
+def _function():
+    # rcx counts down, writing rcx to [0x10000 + rcx * 8] each round,
+    # and rdx to the first page of the segment
+    f = Function()
+    f.append(f.store(8, f.op(
+        'ADD', 8, f.const(8, DATA[0]),
+        f.op('LSL', 8, f.reg(8, 'rcx'), f.const(1, 3))
+    ), f.reg(8, 'rcx')))
+    f.append(f.store(8, f.const(8, SEGMENT), f.reg(8, 'rdx')))
+    f.append(f.set_reg(8, 'rcx', f.op(
+        'SUB', 8, f.reg(8, 'rcx'), f.const(8, 1), flags='*'
+    )))
+    f.append(f.if_expr(
+        f.flag_condition(LowLevelILFlagCondition.LLFC_NE), 0, 4
+    ))
+    f.append(f.set_reg(8, 'rax', f.const(8, 1)))
+    return llil.load(f, [(SEGMENT, SEGMENT_DATA, llil.READ_WRITE)])
+
+
+def _emulator(function):
+    e = emilator.Emilator(function)
+    e.map_memory(*DATA)
+    e.set_register_value('rcx', 1000)
+    e.set_register_value('rdx', 0)
+    return e
+
+
+def _saved(path):
+    # The pages stored in the checkpoint at path
+    ranges = checkpoint.load(path, None)[1]
+    return ranges[0].loader.checkpoint
+
+
+def _state(e):
+    return llil.state(e, [DATA, (SEGMENT, 2 * PAGE_SIZE)])
+
+
+def test_resume_from_a_checkpoint(tmpdir):
+    path = str(tmpdir.join('checkpoint'))
+    function = _function()
+
+    e = _emulator(function)
+    e.run_until(1500)
+    e.save_checkpoint(path)
+    e.run_until()
+    finished = _state(e)
+
+    resumed = _emulator(function)
+    resumed.load_checkpoint(path)
+    assert resumed.get_register_value('rcx') == 625
+    assert resumed._memory._pages == {}
+
+    resumed.run_until()
+    assert _state(resumed) == finished
+
+    # Saving again copies the pages it never touched as they are
+    again = str(tmpdir.join('again'))
+    loaded = _emulator(function)
+    loaded.load_checkpoint(path)
+    loaded.save_checkpoint(again)
+    first = _saved(path)
+    second = _saved(again)
+    assert first.page_numbers == second.page_numbers
+    assert [first.blob(page) for page in first.page_numbers] == [
+        second.blob(page) for page in second.page_numbers
+    ]
+
+
+def test_loading_drops_compiled_code_quietly(tmpdir):
+    path = str(tmpdir.join('checkpoint'))
+    e = _emulator(_function())
+    e.run_until(1500)
+    e.save_checkpoint(path)
+    e.run_until(10)
+    assert e._code and e._memory._watches
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        e.load_checkpoint(path)
+
+    assert e._code == {}
+    assert e._code_watches == {}
+    assert e._memory._watches == {}
+    assert e.get_register_value('rcx') == 625
+
+
+def test_only_changed_pages_are_stored(tmpdir):
+    path = str(tmpdir.join('checkpoint'))
+    e = _emulator(_function())
+
+    # Written with what was there already, or with zeros where
+    # nothing was
+    e.write_block(SEGMENT + PAGE_SIZE, SEGMENT_DATA[PAGE_SIZE:])
+    e.write_memory(DATA[0] + PAGE_SIZE, 0, 8)
+    # Zeroed where the segment wasn't zero
+    e.write_block(SEGMENT, b'\x00' * PAGE_SIZE)
+    # Changed
+    e.write_memory(DATA[0] + 2 * PAGE_SIZE, 1, 8)
+
+    e.save_checkpoint(path)
+    assert dict(
+        (page_number, encoding) for page_number, (offset, length, encoding)
+        in _saved(path).pages.items()
+    ) == {
+        SEGMENT >> 12: checkpoint.ZERO,
+        (DATA[0] >> 12) + 2: checkpoint.ZLIB,
+    }
+
+
+def test_bad_checkpoints(tmpdir):
+    path = tmpdir.join('checkpoint')
+    path.write(b'x' * 64)
+
+    with pytest.raises(ValueError):
+        _emulator(_function()).load_checkpoint(str(path))
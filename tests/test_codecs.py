@@ -0,0 +1,49 @@
+import struct
+
+import pytest
+
+import emilator
+import llil
+from llil import Function
+
+
+@pytest.mark.parametrize('little_endian', [True, False])
+@pytest.mark.parametrize('size', [1, 2, 3, 4, 8, 10, 16, 32])
+def test_round_trip(little_endian, size):
+    decode, encode = emilator.get_codec(little_endian, size)
+    assert emilator.get_codec(little_endian, size) == (decode, encode)
+
+    for value in (0, 1, 0x80, (1 << size * 8) - 1, 0x0123456789abcdef):
+        data = encode(value)
+        assert len(data) == size
+        assert decode(data) == value & ((1 << size * 8) - 1)
+
+
+def test_byte_order():
+    assert emilator.get_codec(True, 4)[1](0x11223344) == (
+        struct.pack('<L', 0x11223344)
+    )
+    assert emilator.get_codec(False, 10)[1](0x0102) == (
+        b'\x00' * 8 + b'\x01\x02'
+    )
+    assert emilator.get_codec(True, 10)[0](b'\x02\x01' + b'\x00' * 8) == (
+        0x0102
+    )
+
+
+def test_wide_and_bulk_memory():
+    f = Function()
+    f.append(f.store(16, f.const(8, 0x2000), f.reg(8, 'rax')))
+    f.append(f.set_reg(8, 'rbx', f.load(8, f.const(8, 0x2000))))
+    e = llil.check(
+        llil.load(f), {'rax': 0x1122334455667788}, [(0x2000, 0x2000)]
+    )
+
+    assert e.read_memory(0x2000, 16) == 0x1122334455667788
+    assert e.get_register_value('rbx') == 0x1122334455667788
+
+    e.write_memory(0x2ff8, (1 << 128) - 2, 16)
+    assert e.read_memory(0x2ff8, 16) == (1 << 128) - 2
+
+    e.write_block(0x2100, b'abcdef')
+    assert e.read_block(0x2100, 6).tobytes() == b'abcdef'
@@ -0,0 +1,120 @@
+import pytest
+
+import llil
+from llil import Function, temp
+from offline import LowLevelILFlagCondition
+
+DATA = (0x10000, 0x1000)
+
+BINARY = [
+    'ADD', 'SUB', 'AND', 'OR', 'XOR', 'LSL', 'LSR', 'ASR', 'ROL', 'ROR',
+    'MUL', 'CMP_E', 'CMP_NE', 'CMP_SLT', 'CMP_UGT',
+]
+
+SHIFTED = frozenset(['LSL', 'LSR', 'ASR', 'ROL', 'ROR'])
+
+SHIFTS = [0, 1, 3, 0x1f]
+
+VALUES = [0, 1, 7, 0x80, 0xff, 0x7fffffff, 0x80000000, 0xffffffff,
+          0x8000000000000000, 0xffffffffffffffff, 0x123456789abcdef0]
+
+
+def _binary(name, size, left, right, flags=None):
+    f = Function()
+    f.append(f.set_reg(8, 'rax', f.const(8, left)))
+    f.append(f.set_reg(8, 'rbx', f.const(8, right)))
+    f.append(f.set_reg(
+        size, 'rcx' if size == 8 else 'ecx',
+        f.op(name, size, f.reg(size, 'rax' if size == 8 else 'eax'),
+             f.reg(size, 'rbx' if size == 8 else 'ebx'), flags=flags)
+    ))
+    return llil.load(f)
+
+
+@pytest.mark.parametrize('name', BINARY)
+@pytest.mark.parametrize('size', [4, 8])
+def test_binary_operations(name, size):
+    for left in VALUES:
+        for right in (SHIFTS if name in SHIFTED else VALUES):
+            flags = None if name.startswith('CMP') else '*'
+            llil.check(
+                _binary(name, size, left, right, flags),
+                {'rcx': 0x5555555555555555}
+            )
+
+
+@pytest.mark.parametrize('name', ['NEG', 'NOT', 'SX', 'ZX'])
+def test_unary_operations(name):
+    for value in VALUES:
+        f = Function()
+        f.append(f.set_reg(8, 'rax', f.op(name, 8, f.reg(4, 'eax'))))
+        f.append(f.set_reg(2, 'bx', f.op(name, 2, f.reg(1, 'al'))))
+        llil.check(llil.load(f), {'rax': value, 'rbx': ~value & (2**64 - 1)})
+
+
+def test_partial_registers():
+    f = Function()
+    f.append(f.set_reg(1, 'ah', f.const(1, 0x12)))
+    f.append(f.set_reg(1, 'bl', f.reg(1, 'ah')))
+    f.append(f.set_reg(4, 'ecx', f.reg(4, 'ebx')))
+    f.append(f.set_reg(2, 'dx', f.const(2, 0xbeef)))
+    e = llil.check(llil.load(f), dict(
+        (name, 0xffffffffffffffff) for name in ('rax', 'rbx', 'rcx', 'rdx')
+    ))
+
+    assert e.get_register_value('rax') == 0xffffffffffff12ff
+    assert e.get_register_value('rcx') == 0x00000000ffffff12
+    assert e.get_register_value('rdx') == 0xffffffffffffbeef
+
+
+def test_memory_and_stack():
+    f = Function()
+    f.append(f.store(8, f.const(8, 0x10010), f.reg(8, 'rax')))
+    f.append(f.store(2, f.const(8, 0x10ffe), f.const(2, 0x4142)))
+    f.append(f.set_reg(8, 'rbx', f.load(4, f.const(8, 0x10014))))
+    f.append(f.push(8, f.reg(8, 'rax')))
+    f.append(f.push(2, f.const(2, 7)))
+    f.append(f.set_reg(8, 'rcx', f.pop(2)))
+    f.append(f.set_reg(8, 'rdx', f.pop(8)))
+    e = llil.check(
+        llil.load(f), {'rax': 0x1122334455667788, 'rsp': 0x10800},
+        [DATA]
+    )
+
+    assert e.get_register_value('rbx') == 0x11223344
+    assert e.get_register_value('rdx') == 0x1122334455667788
+    assert e.read_memory(0x10ffe, 2) == 0x4142
+
+
+def test_loop_with_flags_and_temps():
+    f = Function()
+    f.append(f.set_reg(8, 'rax', f.const(8, 0)))
+    f.append(f.set_reg(8, temp(0), f.op(
+        'ADD', 8, f.reg(8, 'rax'), f.reg(8, 'rcx'), flags='*'
+    )))
+    f.append(f.set_reg(8, 'rax', f.op(
+        'ADC', 8, f.reg(8, temp(0)), f.const(8, 0), f.flag('c'), flags='*'
+    )))
+    f.append(f.set_reg(8, 'rcx', f.op(
+        'SUB', 8, f.reg(8, 'rcx'), f.const(8, 1), flags='czs'
+    )))
+    f.append(f.if_expr(
+        f.flag_condition(LowLevelILFlagCondition.LLFC_NE), 1, 5
+    ))
+    f.append(f.set_flag('o', f.op('CMP_SLT', 8, f.reg(8, 'rax'),
+                                  f.const(8, 0))))
+    e = llil.check(llil.load(f), {'rcx': 100})
+
+    assert e.get_register_value('rax') == 5050
+
+
+def test_compiled_code_is_cached():
+    f = _binary('ADD', 8, 1, 2)
+    e = llil.run(f)
+
+    code = e._code[f]
+    assert all(compiled is not None for compiled in code)
+
+    e.instr_index = 0
+    e.run_until()
+    assert e._code[f] is code
@@ -0,0 +1,114 @@
+import pytest
+
+import batch
+import edgecoverage
+import emilator
+import llil
+from edgecoverage import Coverage
+from llil import Function
+
+
+def _loop():
+    # Loops rcx times; with rdx set, through one more block each time
+    f = Function()
+    f.append(f.set_reg(8, 'rcx', f.op(
+        'SUB', 8, f.reg(8, 'rcx'), f.const(8, 1)
+    )))
+    f.append(f.if_expr(f.op('CMP_E', 8, f.reg(8, 'rdx'), f.const(8, 0)),
+                       3, 2))
+    f.append(f.set_reg(8, 'rax', f.reg(8, 'rcx')))
+    f.append(f.if_expr(f.op('CMP_E', 8, f.reg(8, 'rcx'), f.const(8, 0)),
+                       4, 0))
+    f.append(f.nop())
+    return llil.load(f)
+
+
+def _hits(function, rcx, rdx=0, coverage=None):
+    coverage = coverage or Coverage(1 << 12)
+    e = emilator.Emilator(function)
+    e.set_coverage(coverage)
+    e.set_register_value('rcx', rcx)
+    e.set_register_value('rdx', rdx)
+    e.run_until()
+    return coverage
+
+
+def test_bitmap():
+    with pytest.raises(ValueError):
+        Coverage(100)
+
+    coverage = Coverage(16)
+    coverage.bitmap[1] = 1
+    coverage.bitmap[2] = 5
+    coverage.bitmap[3] = 200
+
+    assert coverage.edges() == [1, 2, 3]
+    assert coverage.hits() == [(1, 1), (2, 8), (3, 128)]
+    assert bytearray(coverage.classify())[:4] == bytearray([0, 1, 8, 128])
+
+    total = bytearray(16)
+    assert coverage.diff(total) == [1, 2, 3]
+    coverage.merge(total)
+    assert coverage.diff(total) == []
+
+    coverage.bitmap[2] = 4
+    assert coverage.diff(total) == []
+    coverage.bitmap[2] = 8
+    assert coverage.diff(total) == [2]
+
+    coverage.clear()
+    assert coverage.edges() == []
+
+
+def test_merge_hits():
+    total = bytearray(16)
+
+    assert edgecoverage.merge_hits(total, [(1, 1), (5, 8)]) == [1, 5]
+    assert edgecoverage.merge_hits(total, [(1, 1), (5, 2)]) == [5]
+    assert total[1] == 1 and total[5] == 10
+
+
+def test_emulator_edges():
+    function = _loop()
+    short = _hits(function, 2)
+    long = _hits(function, 20)
+
+    # The same edges, hit more often
+    assert short.edges() == long.edges()
+    assert short.classify() != long.classify()
+    assert max(bytearray(long.bitmap)) == 19
+
+    # Another path hits more edges
+    other = _hits(function, 2, rdx=1)
+    assert set(other.edges()) - set(short.edges())
+
+    # Counts wrap to 1 rather than 0
+    wrapped = _hits(function, 257)
+    assert 0 not in [wrapped.bitmap[index] for index in wrapped.edges()]
+
+    shared = _hits(function, 2, coverage=Coverage.shared(1 << 12))
+    assert shared.edges() == short.edges()
+
+
+def test_batch_coverage():
+    function = _loop()
+    total = bytearray(1 << 12)
+    states = [
+        {'registers': {'rcx': 2, 'rdx': 0}},
+        {'registers': {'rcx': 2, 'rdx': 0}},
+        {'registers': {'rcx': 2, 'rdx': 1}},
+    ]
+
+    # One worker, so the tasks run in order
+    results = list(batch.run_batch(
+        function, states, processes=1, coverage=total
+    ))
+
+    assert sorted(results[0].edges) == sorted(_hits(function, 2).edges())
+    assert results[1].edges == []
+    assert results[2].edges
+
+    expected = bytearray(1 << 12)
+    for rdx in (0, 1):
+        _hits(function, 2, rdx).merge(expected)
+    assert total == expected
@@ -0,0 +1,83 @@
+import pytest
+
+import emilator
+import errors
+import llil
+from bnilvisitor import BNILVisitor
+from llil import Function
+from offline import Operation
+
+
+class Counter(BNILVisitor):
+    def visit_LLIL_CONST(self, expression):
+        return expression.constant
+
+
+class Doubler(Counter):
+    def visit_LLIL_CONST(self, expression):
+        return expression.constant * 2
+
+
+def _program():
+    f = Function()
+    f.append(f.set_reg(8, 'rax', f.op(
+        'ADD', 8, f.const(8, 40), f.const(8, 2)
+    )))
+    f.append(f.set_reg(8, 'rbx', f.reg(8, 'rax')))
+    return llil.load(f)
+
+
+def test_tables_are_per_class():
+    constant = Function().const(8, 21)
+
+    assert Counter().visit(constant) == 21
+    assert Doubler().visit(constant) == 42
+    assert Counter().visit(constant) == 21
+
+    operation = Operation('LLIL_CONST')
+    assert Counter._dispatch_table[operation] is not (
+        Doubler._dispatch_table[operation]
+    )
+
+
+def test_unimplemented_operation():
+    assert Counter().visit(Function().nop()) is None
+
+    f = Function()
+    f.append(f.expr('LLIL_UNIMPL', 0))
+    with pytest.raises(errors.UnimplementedError):
+        llil.run(llil.load(f))
+
+
+def test_instruction_hooks():
+    seen = []
+    e = emilator.Emilator(_program())
+    e.register_instruction_hook(
+        Operation('LLIL_CONST'),
+        lambda emulator, expression: seen.append(expression.constant)
+    )
+    e.run_until()
+
+    assert sorted(seen) == [2, 40]
+    assert e.get_register_value('rbx') == 42
+
+    e = emilator.Emilator(_program())
+    e.register_instruction_hook(
+        Operation('LLIL_ADD'), lambda emulator, expression: 7, replace=True
+    )
+    e.run_until()
+    assert e.get_register_value('rbx') == 7
+
+
+def test_hooks_leave_the_class_table_alone():
+    e = emilator.Emilator(_program())
+    hook = lambda emulator, expression: 0
+    e.register_instruction_hook(Operation('LLIL_CONST'), hook, replace=True)
+
+    assert e._dispatch is not emilator.Emilator._dispatch_table
+
+    e.unregister_instruction_hook(Operation('LLIL_CONST'), hook)
+    assert e._dispatch is emilator.Emilator._dispatch_table
+
+    e.run_until()
+    assert e.get_register_value('rbx') == 42
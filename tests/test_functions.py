@@ -0,0 +1,128 @@
+import threading
+import time
+
+import pytest
+
+import errors
+import functions
+from llil import Function
+
+
+class _Function(object):
+    def __init__(self, view, start):
+        self.start = start
+        self.low_level_il = Function(start)
+        self.low_level_il.append(self.low_level_il.nop())
+        self._view = view
+
+    def reanalyze(self):
+        self._view.log.append(('reanalyze', self.start))
+
+
+class _View(object):
+    # Functions exist at known addresses, once created, and after delay
+    # seconds of analysis
+    def __init__(self, known=(), existing=(), delay=0):
+        self.log = []
+        self._known = set(known)
+        self._delay = delay
+        self._notifications = []
+        self._functions = dict(
+            (start, _Function(self, start)) for start in existing
+        )
+
+    def get_function_at(self, address):
+        self.log.append(('get', address))
+        return self._functions.get(address)
+
+    def create_user_function(self, address):
+        self.log.append(('create', address))
+        if address not in self._known:
+            return
+
+        def analyse():
+            function = self._functions[address] = _Function(self, address)
+            for notification in list(self._notifications):
+                notification.function_added(self, function)
+
+        if self._delay:
+            threading.Timer(self._delay, analyse).start()
+        else:
+            analyse()
+
+    def register_notification(self, notification):
+        self._notifications.append(notification)
+
+    def unregister_notification(self, notification):
+        self._notifications.remove(notification)
+
+    def update_analysis_and_wait(self):
+        self.log.append(('update',))
+
+
+def test_get_lifts_once():
+    view = _View(known=[0x2000], existing=[0x1000])
+    cache = functions.FunctionCache(view)
+
+    assert cache.get(0x1000) is view._functions[0x1000].low_level_il
+    assert cache.get(0x2000) is view._functions[0x2000].low_level_il
+    assert ('reanalyze', 0x2000) in view.log
+    assert ('update',) not in view.log
+    assert 0x2000 in cache
+
+    del view.log[:]
+    cache.get(0x1000)
+    cache.get(0x2000)
+    assert view.log == []
+
+
+def test_waits_for_analysis():
+    view = _View(known=[0x2000], delay=0.05)
+    cache = functions.FunctionCache(view)
+
+    assert cache.get(0x2000) is view._functions[0x2000].low_level_il
+    assert ('update',) not in view.log
+    assert view._notifications == []
+
+    # Far fewer looks than polling would take
+    assert view.log.count(('get', 0x2000)) <= 4
+
+
+def test_missing_function():
+    view = _View()
+    cache = functions.FunctionCache(view)
+
+    start = time.time()
+    with pytest.raises(errors.UndefinedError):
+        cache.get(0x3000, timeout=0.05)
+    assert 0.05 <= time.time() - start < 5
+
+    assert ('update',) not in view.log
+    assert view._notifications == []
+
+
+def test_prefetch():
+    view = _View(known=[0x2000, 0x3000], existing=[0x1000])
+    cache = functions.FunctionCache(view)
+
+    f = Function(0x1000)
+    f.append(f.call(f.const_pointer(8, 0x2000)))
+    f.append(f.call(f.reg(8, 'rax')))
+    f.append(f.tailcall(f.const(8, 0x3000)))
+    f.instructions = list(f)
+
+    cache.prefetch(f)
+    for _ in range(1000):
+        if cache._thread is None:
+            break
+        time.sleep(0.01)
+
+    assert 0x2000 in cache and 0x3000 in cache
+    assert cache._pending == {}
+
+    # A function is only scanned once
+    del view.log[:]
+    cache._functions.clear()
+    cache.prefetch(f)
+    assert cache._thread is None
+    assert view.log == []
@@ -0,0 +1,132 @@
+import emilator
+import hooks
+import llil
+from llil import Function
+
+STACK = (0x7000, 0x1000)
+DATA = (0x3000, 0x1000)
+
+
+def _emulator(functions):
+    view = llil.image(functions)
+    e = emilator.Emilator(view.get_function_at(functions[0].start)
+                          .low_level_il)
+    e.map_memory(*STACK)
+    e.map_memory(*DATA)
+    e.set_register_value('rsp', STACK[0] + STACK[1])
+    return e
+
+
+def _copy():
+    # [0x3008] = [0x3000] + 1
+    f = Function(0x1000)
+    f.append(f.set_reg(8, 'rax', f.load(8, f.const(8, 0x3000))))
+    f.append(f.store(8, f.const(8, 0x3008), f.op(
+        'ADD', 8, f.reg(8, 'rax'), f.const(8, 1)
+    )))
+    return f
+
+
+def test_interval_index():
+    index = hooks.IntervalIndex()
+    index.add(0x10, 0x20, 'a')
+    index.add(0x18, 0x30, 'b')
+
+    assert index.find(0x0f) == ()
+    assert index.find(0x10) == ('a',)
+    assert index.find(0x1f) == ('a', 'b')
+    assert index.find(0x30) == ()
+    assert index.overlapping(0x00, 0x11) == ('a',)
+    assert index.overlapping(0x0c, 0x40) == ('a', 'b')
+
+    index.remove(0x10, 0x20, 'a')
+    assert index.find(0x1f) == ('b',)
+    assert len(index) == 1
+
+
+def test_code_hooks():
+    e = _emulator([_copy()])
+    seen = []
+    hook = lambda emulator, address: seen.append(address)
+
+    e.register_code_hook(0x1004, 0x1008, hook)
+    e.run_until()
+    assert seen == [0x1004]
+    assert e.code_hooks == [(0x1004, 0x1008, hook)]
+
+    # Compiled code without the hook runs without it
+    e.unregister_code_hook(0x1004, 0x1008, hook)
+    e.instr_index = 0
+    e.run_until()
+    assert seen == [0x1004]
+
+
+def test_memory_hooks():
+    e = _emulator([_copy()])
+    reads = []
+    writes = []
+
+    e.register_memory_read_hook(
+        0x3000, 0x3001,
+        lambda emulator, address, length: reads.append((address, length))
+    )
+    e.register_memory_write_hook(
+        0x3004, 0x3010,
+        lambda emulator, address, length, data:
+        writes.append((address, length, data))
+    )
+
+    e.write_memory(0x3000, 41, 8)
+    e.run_until()
+    e.read_block(0x3000, 0x101)
+    e.write_block(0x3100, b'x')
+
+    assert reads == [(0x3000, 8), (0x3000, 0x101)]
+    assert writes == [(0x3000, 8, 41), (0x3008, 8, 42)]
+    assert 'read_memory' in e.__dict__
+
+    e.unregister_memory_read_hook(*e.memory_read_hooks[0])
+    e.unregister_memory_write_hook(*e.memory_write_hooks[0])
+    assert 'read_memory' not in e.__dict__
+    assert 'write_memory' not in e.__dict__
+
+
+def test_function_hooks():
+    # main calls 0x2000, stores rax and calls the hooked 0x2100 at
+    # 0x2000 by a tail call, then by a jump out of the function
+    main = Function(0x1000)
+    main.append(main.call(main.const_pointer(8, 0x2000)))
+    main.append(main.store(8, main.const(8, 0x3000), main.reg(8, 'rax')))
+    main.append(main.call(main.const_pointer(8, 0x2100)))
+    main.append(main.store(8, main.const(8, 0x3008), main.reg(8, 'rax')))
+    main.append(main.call(main.const_pointer(8, 0x2000)))
+    main.append(main.store(8, main.const(8, 0x3010), main.reg(8, 'rax')))
+
+    callee = Function(0x2000)
+    callee.append(callee.set_reg(8, 'rbx', callee.op(
+        'ADD', 8, callee.reg(8, 'rbx'), callee.const(8, 1)
+    )))
+    callee.append(callee.if_expr(callee.op(
+        'CMP_E', 8, callee.reg(8, 'rbx'), callee.const(8, 1)
+    ), 2, 3))
+    callee.append(callee.tailcall(callee.const_pointer(8, 0x2100)))
+    callee.append(callee.jump(callee.const_pointer(8, 0x2100)))
+
+    def hook(emulator):
+        emulator.set_register_value(
+            'rax', emulator.get_register_value('rax') + 10
+        )
+
+    e = _emulator([main, callee])
+    e.set_register_value('rax', 0)
+    e.set_register_value('rbx', 0)
+    e.register_function_hook(0x2100, hook)
+    assert e.function_hooks == {0x2100: hook}
+    e.run_until()
+
+    assert [e.read_memory(0x3000 + offset, 8) for offset in (0, 8, 16)] == [
+        10, 20, 30
+    ]
+    assert e.get_register_value('rbx') == 2
+    assert e.get_register_value('rsp') == STACK[0] + STACK[1]
+    assert e._frames == []
@@ -0,0 +1,84 @@
+import pickle
+
+import pytest
+
+import emilator
+import llil
+import memory
+from llil import Function
+from memory import PAGE_SIZE, READABLE
+
+DATA = bytes(bytearray(range(256))) * 48
+
+
+def _function():
+    # Copies the first quadword of the read-only page to the writable one
+    f = Function(0x1000)
+    f.append(f.set_reg(8, 'rax', f.load(8, f.const(8, 0x400008))))
+    f.append(f.store(8, f.const(8, 0x401000), f.reg(8, 'rax')))
+    return llil.load(f, [
+        (0x400000, DATA[:PAGE_SIZE], READABLE),
+        (0x401000, DATA[PAGE_SIZE:], llil.READ_WRITE),
+    ])
+
+
+@pytest.fixture(params=['anonymous', 'file'])
+def image(request, tmpdir):
+    view = _function().view
+    if request.param == 'anonymous':
+        return memory.BaseImage.from_view(view)
+    return memory.BaseImage.from_view(view, str(tmpdir.join('image')))
+
+
+def test_contents(image):
+    assert len(image) == 3
+    assert image.ranges == [
+        (0x400000, PAGE_SIZE, READABLE),
+        (0x401000, 2 * PAGE_SIZE, llil.READ_WRITE),
+    ]
+    assert bytes(image.page(0x401)[:4]) == DATA[PAGE_SIZE:PAGE_SIZE + 4]
+    assert image.page(0x403) is None
+
+    # Past the segment data, and outside the image, is zeros
+    assert bytes(image.read(0x402800, 0x1000)) == (
+        DATA[0x2800:] + b'\x00' * 0x800
+    )
+
+
+def test_pages_are_shared_and_read_only(image):
+    function = _function()
+    first = emilator.Emilator(function, image=image)
+    second = emilator.Emilator(function, image=image)
+
+    block = first.read_block(0x401000, 8)
+    with pytest.raises(TypeError):
+        block[0] = b'x'
+    assert second._memory._pages == {}
+
+    first.run_until()
+    assert first.read_block(0x401000, 8).tobytes() == DATA[8:16]
+
+    # Only the page written to was copied
+    assert first._memory._pages[0x401].private
+    assert first._memory._pages[0x400].data is image.page(0x400)
+    assert second.read_block(0x401000, 8).tobytes() == (
+        DATA[PAGE_SIZE:PAGE_SIZE + 8]
+    )
+    assert bytes(image.page(0x401)[:8]) == DATA[PAGE_SIZE:PAGE_SIZE + 8]
+
+
+def test_pickle(tmpdir):
+    view = _function().view
+
+    with pytest.raises(TypeError):
+        pickle.dumps(memory.BaseImage.from_view(view), 2)
+
+    image = memory.BaseImage.from_view(view, str(tmpdir.join('image')))
+    copy = pickle.loads(pickle.dumps(image, 2))
+    assert copy.ranges == image.ranges
+    assert bytes(copy.page(0x400)) == bytes(image.page(0x400))
+
+    path = tmpdir.join('other')
+    path.write(b'x' * 64)
+    with pytest.raises(ValueError):
+        memory.BaseImage.open(str(path))
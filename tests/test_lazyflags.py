@@ -0,0 +1,111 @@
+import pytest
+
+import emilator
+import lazyflags
+import llil
+from lazyflags import (
+    CARRY, EVEN_PARITY, HALF_CARRY, INVERTED_CARRY, NEGATIVE, OVERFLOW,
+    ZERO
+)
+from llil import FLAGS, Function
+from offline import LowLevelILFlagCondition
+
+ROLES = [CARRY, ZERO, NEGATIVE, OVERFLOW]
+
+
+def _flags(name, size, left, right=0, carry=0):
+    operation = 'LLIL_' + name
+    result = lazyflags.OPERATIONS[operation](left, right, carry, size * 8)
+    lazy = lazyflags.LazyFlags(
+        None, operation, size, left, right, carry, result
+    )
+    return [lazy.compute(role) for role in ROLES]
+
+
+@pytest.mark.parametrize('name, left, right, carry, expected', [
+    # carry, zero, negative, overflow
+    ('ADD', 0x7f, 0x01, 0, [False, False, True, True]),
+    ('ADD', 0xff, 0x01, 0, [True, True, False, False]),
+    ('ADC', 0xff, 0x00, 1, [True, True, False, False]),
+    ('SUB', 0x00, 0x01, 0, [True, False, True, False]),
+    ('SUB', 0x80, 0x01, 0, [False, False, False, True]),
+    ('SBB', 0x05, 0x04, 1, [False, True, False, False]),
+    ('NEG', 0x80, 0x00, 0, [True, False, True, True]),
+    ('NEG', 0x00, 0x00, 0, [False, True, False, False]),
+    ('LSL', 0x81, 0x01, 0, [True, False, False, False]),
+    ('LSR', 0x81, 0x01, 0, [True, False, False, False]),
+    ('ASR', 0x80, 0x01, 0, [False, False, True, False]),
+    ('ASR', 0x81, 0x08, 0, [True, False, True, False]),
+    ('ROL', 0x81, 0x01, 0, [True, False, False, False]),
+    ('ROR', 0x01, 0x01, 0, [True, False, True, False]),
+    ('ROR', 0x02, 0x09, 0, [False, False, False, False]),
+    ('MUL', 0x10, 0x10, 0, [True, True, False, True]),
+    ('MUL', 0xff, 0xff, 0, [True, False, False, False]),
+    ('AND', 0xf0, 0x0f, 0, [False, True, False, False]),
+])
+def test_compute(name, left, right, carry, expected):
+    assert _flags(name, 1, left, right, carry) == expected
+
+
+def test_other_roles():
+    lazy = lazyflags.LazyFlags(None, 'LLIL_SUB', 4, 0x10, 0x11, 0, -1)
+
+    assert lazy.compute(INVERTED_CARRY) is False
+    assert lazy.compute(HALF_CARRY) is True
+    assert lazy.compute(EVEN_PARITY) is True
+    assert lazy.compute(lazyflags.ODD_PARITY) is False
+    assert lazy.compute(None) is False
+
+
+def test_flags_are_computed_when_read():
+    f = Function()
+    f.append(f.set_reg(1, 'al', f.op(
+        'ADD', 1, f.reg(1, 'al'), f.const(1, 1), flags='*'
+    )))
+    f.append(f.set_reg(1, 'bl', f.op(
+        'SUB', 1, f.reg(1, 'bl'), f.const(1, 1), flags='czs'
+    )))
+    e = emilator.Emilator(llil.load(f))
+    e.set_register_value('rax', 0x7f)
+    e.set_register_value('rbx', 0)
+
+    e.execute_instruction()
+    assert e._flags == {}
+    assert e._lazy_flags.operation == 'LLIL_ADD'
+
+    # Flags only the first operation wrote are kept when the second
+    # replaces its record
+    e.execute_instruction()
+    assert sorted(FLAGS[flag] for flag in e._flags) == ['a', 'o', 'p']
+
+    values = dict((FLAGS[flag], value)
+                  for flag, value in e._flag_values().items())
+    assert values == {
+        'c': True, 'z': False, 's': True, 'o': True, 'a': True,
+        'p': False,
+    }
+
+    e.set_flag_value(FLAGS.index('z'), True)
+    assert e._lazy_flags is None
+    assert e.get_flag_value(FLAGS.index('s')) is True
+    assert e.get_flag_value(FLAGS.index('z')) is True
+
+
+@pytest.mark.parametrize('condition', [
+    name for name in dir(LowLevelILFlagCondition)
+    if name.startswith('LLFC_') and
+    getattr(LowLevelILFlagCondition, name) in lazyflags.CONDITIONS
+])
+def test_conditions(condition):
+    condition = getattr(LowLevelILFlagCondition, condition)
+
+    for name in ('SUB', 'ADD', 'ROL', 'ASR'):
+        for left, right in [(0, 0), (1, 2), (2, 1), (0x80, 1), (0x7f, 0xff)]:
+            f = Function()
+            f.append(f.set_reg(1, 'cl', f.op(
+                name, 1, f.reg(1, 'al'), f.reg(1, 'bl'), flags='*'
+            )))
+            f.append(f.set_reg(1, 'dl', f.flag_condition(condition)))
+            llil.check(llil.load(f), {
+                'rax': left, 'rbx': right, 'rcx': 0, 'rdx': 0
+            })
@@ -0,0 +1,146 @@
+import pytest
+
+import emilator
+import errors
+import libc
+import llil
+from llil import Function
+from offline import Symbol, SymbolType
+
+STACK = (0x7000, 0x1000)
+DATA = (0x10000, 0x1000)
+
+STRLEN = 0x5000
+MALLOC = 0x5010
+STRCPY = 0x5020
+
+
+def _symbols(monkeypatch):
+    names = {STRLEN: 'strlen', MALLOC: '_malloc', STRCPY: 'strcpy'}
+    monkeypatch.setattr(
+        llil.BinaryView, 'get_symbol_at',
+        lambda self, address: Symbol(
+            SymbolType.FunctionSymbol, address, names[address]
+        ) if address in names else None
+    )
+
+
+def _stub(address):
+    f = Function(address)
+    f.append(f.ret(f.pop(8)))
+    return f
+
+
+def _emulator(main):
+    view = llil.image([main, _stub(STRLEN), _stub(MALLOC), _stub(STRCPY)])
+    e = emilator.Emilator(view.get_function_at(main.start).low_level_il)
+    e.map_memory(*STACK)
+    e.map_memory(*DATA)
+    e.set_register_value('rsp', STACK[0] + STACK[1] - 8)
+    return e
+
+
+def test_calls_are_modelled(monkeypatch):
+    _symbols(monkeypatch)
+
+    # rbx = strlen(s); strcpy(malloc(rbx + 1), s)
+    f = Function(0x1000)
+    f.append(f.set_reg(8, 'rdi', f.const(8, DATA[0])))
+    f.append(f.call(f.const_pointer(8, STRLEN)))
+    f.append(f.set_reg(8, 'rbx', f.reg(8, 'rax')))
+    f.append(f.set_reg(8, 'rdi', f.op(
+        'ADD', 8, f.reg(8, 'rax'), f.const(8, 1)
+    )))
+    f.append(f.call(f.const_pointer(8, MALLOC)))
+    f.append(f.set_reg(8, 'rdi', f.reg(8, 'rax')))
+    f.append(f.set_reg(8, 'rsi', f.const(8, DATA[0])))
+    f.append(f.call(f.const_pointer(8, STRCPY)))
+
+    e = _emulator(f)
+    e.write_block(DATA[0], b'hello\x00')
+    library = libc.install(e)
+
+    assert sorted(library.install()) == ['malloc', 'strcpy', 'strlen']
+    e.run_until()
+
+    copy = e.get_register_value('rax')
+    assert e.get_register_value('rbx') == 5
+    assert copy in library.heap
+    assert copy % libc.HEAP_ALIGNMENT == 0
+    assert e.read_block(copy, 6).tobytes() == b'hello\x00'
+    assert e.get_register_value('rsp') == STACK[0] + STACK[1] - 8
+
+
+def _library():
+    f = Function(0x1000)
+    f.append(f.nop())
+    return libc.LibC(_emulator(f))
+
+
+def test_memory_routines():
+    library = _library()
+    e = library._emulator
+    base = DATA[0]
+
+    e.write_block(base, b'abcdefgh')
+    assert library.memmove(base + 2, base, 6) == base + 2
+    assert e.read_block(base, 8).tobytes() == b'ababcdef'
+
+    library.memset(base, 0x1ff, 3)
+    assert e.read_block(base, 4).tobytes() == b'\xff\xff\xffb'
+
+    e.write_block(base + 0x100, b'abc\x00abd\x00')
+    assert library.memcmp(base + 0x100, base + 0x104, 2) == 0
+    assert library.memcmp(base + 0x100, base + 0x104, 3) == -1
+    assert library.strcmp(base + 0x104, base + 0x100) == 1
+    assert library.strncmp(base + 0x100, base + 0x104, 2) == 0
+    assert library.strlen(base + 0x100) == 3
+
+    # Strings running across pages
+    e.write_block(base + 0xffe, b'xy')
+    e.map_memory(base + 0x1000, 0x1000)
+    assert library.strlen(base + 0xffe) == 2
+
+
+def test_heap():
+    library = _library()
+    e = library._emulator
+
+    first = library.malloc(1)
+    second = library.malloc(17)
+    assert second - first == libc.HEAP_ALIGNMENT
+    assert library.heap.size(second) == 32
+
+    e.write_block(second, b'x' * 32)
+    library.free(second)
+    assert library.calloc(4, 8) == second
+    assert e.read_block(second, 32).tobytes() == b'\x00' * 32
+
+    e.write_block(first, b'abc')
+    moved = library.realloc(first, 64)
+    assert e.read_block(moved, 3).tobytes() == b'abc'
+    assert first not in library.heap
+    assert library.realloc(moved, 0) == 0
+
+    large = library.malloc(libc.MMAP_THRESHOLD)
+    assert large in e._memory
+    library.free(large)
+    assert large not in e._memory
+
+    with pytest.raises(errors.MemoryAccessError):
+        library.free(large)
+    library.free(0)
+
+
+def test_arguments():
+    library = _library()
+    e = library._emulator
+
+    for index, name in enumerate(['rdi', 'rsi', 'rdx', 'rcx', 'r8', 'r9']):
+        e.set_register_value(name, index)
+    e.write_memory(STACK[0] + STACK[1] - 8, 6, 8)
+
+    assert [library.argument(index) for index in range(7)] == range(7)
+
+    library.set_return_value(-1)
+    assert e.get_register_value('rax') == (1 << 64) - 1
@@ -0,0 +1,120 @@
+import pytest
+
+import emilator
+import errors
+import llil
+import memory
+from llil import Function
+from memory import PAGE_SIZE, READABLE, WRITABLE, EXECUTABLE
+
+RW = READABLE | WRITABLE
+
+
+def test_read_write_across_pages():
+    m = memory.Memory(8)
+    m.map(0x10000, 3 * PAGE_SIZE, RW)
+
+    data = bytes(bytearray(range(256))) * 20
+    m.write(0x10000 + PAGE_SIZE - 100, data)
+
+    assert m.read(0x10000 + PAGE_SIZE - 100, len(data)) == data
+    assert m.read_block(0x10000 + PAGE_SIZE - 1, 2).tobytes() == (
+        data[99:101]
+    )
+    assert m.read(0x10000, 4) == b'\x00' * 4
+
+
+def test_unmapped_and_protected_access():
+    m = memory.Memory(8)
+    m.map(0x10000, PAGE_SIZE, READABLE)
+    m.map(0x11000, PAGE_SIZE, RW)
+
+    with pytest.raises(errors.MemoryAccessError) as raised:
+        m.read(0x12000, 1)
+    assert raised.value.address == 0x12000
+
+    with pytest.raises(errors.MemoryAccessError):
+        m.write(0x10000, b'x')
+
+    # A straddling write that faults leaves memory untouched
+    with pytest.raises(errors.MemoryAccessError):
+        m.write(0x11ffe, b'abcd')
+    assert m.read(0x11ffe, 2) == b'\x00\x00'
+
+    with pytest.raises(errors.MemoryAccessError):
+        m.fetch(0x10000, 1)
+    m.map(0x13000, PAGE_SIZE, READABLE | EXECUTABLE, data=b'\x90')
+    assert m.fetch(0x13000, 1) == b'\x90'
+
+
+def test_map_data_and_unmap():
+    m = memory.Memory(8)
+    m.map(0x10000, 2 * PAGE_SIZE, RW, data=b'abc')
+
+    assert 0x10000 in m
+    assert m.read(0x10000, 4) == b'abc\x00'
+
+    m.unmap(0x10000, PAGE_SIZE)
+    assert 0x10000 not in m
+    assert 0x11000 in m
+    assert [(r.start, r.length) for r in m] == [(0x11000, PAGE_SIZE)]
+
+    with pytest.raises(errors.MemoryAccessError):
+        m.read(0x10fff, 2)
+
+
+def test_watches():
+    m = memory.Memory(8)
+    m.map(0x10000, 2 * PAGE_SIZE, RW)
+    fired = []
+
+    m.watch(0x10100, 0x10, lambda address, length: fired.append(address))
+    m.write(0x10000, b'x' * 0x100)
+    assert fired == []
+
+    m.write(0x1010f, b'x')
+    m.write(0x1010f, b'y')
+    assert fired == [0x1010f]
+
+    handle = m.watch(0x11000, 1, lambda address, length: fired.append(0))
+    m.unwatch(handle)
+    m.write(0x11000, b'z')
+    assert fired == [0x1010f]
+
+
+def test_address_size():
+    with pytest.raises(ValueError):
+        memory.Memory(3)
+
+    m = memory.Memory(4)
+    with pytest.raises(errors.MemoryAccessError):
+        m.map(None, 1 << 33)
+
+
+def _jumper():
+    # Jumps from 0x1000 over two instructions, to 0x100c
+    f = Function(0x1000)
+    f.append(f.jump(f.const_pointer(8, 0x100c)))
+    f.append(f.set_reg(8, 'rax', f.const(8, 1)))
+    f.append(f.set_reg(8, 'rax', f.const(8, 2)))
+    f.append(f.set_reg(8, 'rbx', f.const(8, 3)))
+    return emilator.Emilator(llil.load(f))
+
+
+def test_control_flow_needs_execute():
+    # Code only the view has runs as lifted
+    e = _jumper()
+    e.run_until()
+    assert e.get_register_value('rbx') == 3
+
+    e = _jumper()
+    e.map_memory(0x1000, PAGE_SIZE, READABLE | EXECUTABLE)
+    e.run_until()
+    assert e.get_register_value('rbx') == 3
+
+    e = _jumper()
+    e.map_memory(0x1000, PAGE_SIZE, RW)
+    with pytest.raises(errors.MemoryAccessError) as raised:
+        e.run_until()
+    assert raised.value.address == 0x100c
+    assert e.instr_index == 1
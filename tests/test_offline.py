@@ -0,0 +1,124 @@
+import pickle
+
+import pytest
+
+import emilator
+import errors
+import llil
+import offline
+from llil import Function, temp
+from offline import LowLevelILFlagCondition
+
+
+def _functions():
+    main = Function(0x1000, 'main')
+    main.append(main.set_reg(8, 'rax', main.op(
+        'ADD', 8, main.reg(8, 'rax'), main.const(8, -1), flags='*'
+    )))
+    main.append(main.set_reg(4, temp(1), main.load(4, main.const_pointer(
+        8, 0x400008
+    ))))
+    main.append(main.if_expr(
+        main.flag_condition(LowLevelILFlagCondition.LLFC_NE), 0, 3
+    ))
+    main.append(main.jump_to(main.reg(8, 'rbx'), {0x1000: 0, 0x1010: 4}))
+    main.append(main.call(main.const_pointer(8, 0x2000)))
+
+    callee = Function(0x2000)
+    callee.append(callee.ret(callee.pop(8)))
+
+    return main, callee
+
+
+def _image():
+    return llil.image(_functions(), [
+        (0x400000, b'0123456789abcdef', llil.READ_WRITE),
+    ])
+
+
+def test_round_trip():
+    main, callee = _functions()
+    view = _image()
+    function = view.get_function_at(0x1000)
+
+    assert [f.start for f in view.functions] == [0x1000, 0x2000]
+    assert function.name == 'main'
+    assert view.get_function_at(0x3000) is None
+
+    il = function.low_level_il
+    assert len(il) == len(main)
+    assert [i.operation.name for i in il.instructions] == [
+        i.operation.name for i in main
+    ]
+    assert [i.address for i in il.instructions] == [
+        0x1000, 0x1004, 0x1008, 0x100c, 0x1010
+    ]
+    assert [i.instr_index for i in il.instructions] == range(5)
+
+    add = il[0].src
+    assert (add.operation.name, add.size, add.flags) == ('LLIL_ADD', 8, '*')
+    assert add.right.constant == -1
+    assert il[0].dest.name == 'rax'
+    assert il[1].dest.temp
+    assert il[1].src.src.constant == 0x400008
+    assert (il[2].true, il[2].false) == (0, 3)
+    assert il[2].condition.condition == LowLevelILFlagCondition.LLFC_NE
+    assert il[3].targets == {0x1000: 0, 0x1010: 4}
+
+    assert [(b.start, b.end) for b in il.basic_blocks] == [
+        (b.start, b.end) for b in main.basic_blocks
+    ]
+    assert il.get_instruction_start(0x100c) == 3
+    assert view.get_instruction_length(0x1010) == llil.LENGTH
+    assert view.get_instruction_length(0x1011) == 0
+
+
+def test_segments():
+    view = _image()
+
+    assert view.read(0x400004, 4) == b'4567'
+    assert view.read(0x40000e, 4) == b'ef'
+    assert view.read(0x3fffff, 1) == b''
+    assert view.get_segment_at(0x40000f).start == 0x400000
+    assert view.get_segment_at(0x400010) is None
+
+
+def test_pickle():
+    view = _image()
+    il = view.get_function_at(0x1000).low_level_il
+
+    copy = pickle.loads(pickle.dumps(il, 2))
+    assert copy.source_function.start == 0x1000
+    assert len(copy) == len(il)
+
+    # Functions from one image share a view when unpickled
+    other = pickle.loads(pickle.dumps(
+        view.get_function_at(0x2000).low_level_il, 2
+    ))
+    assert other.view is copy.view
+
+    assert pickle.loads(pickle.dumps(view, 2)).path == view.path
+
+
+def test_runs_offline():
+    view = _image()
+    e = emilator.Emilator(view.get_function_at(0x1000).low_level_il)
+    e.map_memory(0x7000, 0x1000)
+    e.set_register_value('rsp', 0x7ff8)
+    e.set_register_value('rax', 2)
+    e.set_register_value('rbx', 0x1010)
+    e.run_until()
+
+    assert e.get_register_value('rax') == 0
+    assert e.get_register_value(temp(1)) == 0x62613938
+
+
+def test_bad_images(tmpdir):
+    path = tmpdir.join('image')
+    path.write(b'x' * 64)
+    with pytest.raises(ValueError):
+        offline.load(str(path))
+
+    view = _image()
+    with pytest.raises(errors.UnimplementedError):
+        view.create_user_function(0x3000)
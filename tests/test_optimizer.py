@@ -0,0 +1,227 @@
+import random
+
+import pytest
+
+import emilator
+import llil
+import optimizer
+from llil import Function, temp
+from offline import LowLevelILFlagCondition, Operation
+
+TEMPS = [temp(number) for number in range(4)]
+REGISTERS = ['rax', 'rbx', 'rcx', 'rdx', 'rsi']
+CONDITIONS = [
+    LowLevelILFlagCondition.LLFC_E, LowLevelILFlagCondition.LLFC_ULT,
+    LowLevelILFlagCondition.LLFC_SLT
+]
+BINARY = [
+    'ADD', 'SUB', 'AND', 'OR', 'XOR', 'LSL', 'LSR', 'MUL', 'CMP_E',
+    'CMP_SLT', 'CMP_UGT', 'ASR', 'ADC'
+]
+DATA = 0x10000
+
+PROGRAMS = 1500
+CHUNK = 100
+
+
+def _program(rnd):
+    # A random function: a prologue, a loop counting rbp down and an
+    # epilogue, of statements over registers, temps, flags and memory
+    f = Function()
+
+    def address(depth):
+        return f.op('ADD', 8, f.const(8, DATA), f.op(
+            'AND', 8, expression(depth), f.const(8, 0xff)
+        ))
+
+    def expression(depth):
+        kind = rnd.randint(0, 14 if depth < 3 else 3)
+
+        if kind == 0:
+            return f.const(8, rnd.choice([
+                0, 1, 7, 0xff, 0x8000000000000000, 0xffffffffffffffff,
+                rnd.getrandbits(64)
+            ]))
+        if kind == 1:
+            return f.reg(8, rnd.choice(REGISTERS))
+        if kind == 2:
+            return f.reg(4, 'eax')
+        if kind == 3:
+            return f.reg(8, rnd.choice(TEMPS))
+        if kind == 4:
+            return f.load(rnd.choice([1, 4, 8]), address(depth + 1))
+        if kind == 5:
+            return f.op('ZX', 8, expression(depth + 1))
+        if kind == 6:
+            return f.op('SX', 8, f.op(
+                'AND', 4, expression(depth + 1), f.const(4, 0xffffffff)
+            ))
+        if kind == 7:
+            return f.flag(rnd.choice('czs'))
+        if kind == 8:
+            return f.flag_condition(rnd.choice(CONDITIONS))
+
+        name = rnd.choice(BINARY)
+        flags = None
+        if not name.startswith('CMP'):
+            flags = rnd.choice([None, None, '*', 'czs'])
+        size = rnd.choice([4, 8])
+
+        if name in ('LSL', 'LSR', 'ASR'):
+            return f.op(name, size, expression(depth + 1),
+                        f.const(1, rnd.randint(0, 40)), flags=flags)
+        if name == 'ADC':
+            return f.op(name, size, expression(depth + 1),
+                        expression(depth + 1), f.flag('c'), flags=flags)
+        return f.op(name, size, expression(depth + 1),
+                    expression(depth + 1), flags=flags)
+
+    def statement():
+        kind = rnd.randint(0, 9)
+
+        if kind <= 2:
+            return f.set_reg(8, rnd.choice(TEMPS), expression(0))
+        if kind <= 5:
+            return f.set_reg(rnd.choice([8, 8, 4]),
+                             rnd.choice(REGISTERS + ['eax', 'ecx']),
+                             expression(0))
+        if kind == 6:
+            return f.op('SUB', 8, expression(1), expression(1),
+                        flags=rnd.choice(['*', 'czs']))
+        if kind == 7:
+            return f.set_flag(rnd.choice('czs'), expression(1))
+        if kind == 8:
+            return f.store(rnd.choice([1, 8]), address(1), expression(1))
+        return f.set_reg(8, 'rdi', f.reg(8, rnd.choice(TEMPS)))
+
+    f.append(f.set_reg(8, 'rbp', f.const(8, rnd.randint(1, 4))))
+    f.extend(statement() for _ in range(rnd.randint(0, 6)))
+
+    head = len(f)
+    f.extend(statement() for _ in range(rnd.randint(1, 10)))
+    f.append(f.set_reg(8, 'rbp', f.op(
+        'SUB', 8, f.reg(8, 'rbp'), f.const(8, 1), flags='*'
+    )))
+    f.append(f.if_expr(
+        f.flag_condition(LowLevelILFlagCondition.LLFC_NE), head, len(f) + 1
+    ))
+
+    f.extend(statement() for _ in range(rnd.randint(0, 6)))
+
+    return llil.load(f)
+
+
+def _run(function, seed, optimize, defined):
+    # Everything an optimized run has to end with too, or the error
+    e = emilator.Emilator(function)
+    if optimize:
+        e.set_optimizer(optimizer.Optimizer())
+
+    rnd = random.Random(seed)
+    data = bytes(bytearray(rnd.getrandbits(8) for _ in range(0x1000)))
+    e.map_memory(DATA, 0x1000, data=data)
+
+    for name in REGISTERS + ['rdi']:
+        e.set_register_value(name, rnd.getrandbits(64))
+    for register in TEMPS:
+        value = rnd.getrandbits(64)
+        if defined or rnd.random() < 0.3:
+            e.set_register_value(register, value)
+
+    try:
+        result = e.run_until(10000)
+    except Exception as error:
+        return type(error).__name__
+
+    return result, llil.state(e, [(DATA, 0x1000)])
+
+
+@pytest.mark.parametrize('first', range(0, PROGRAMS, CHUNK))
+def test_random_programs(first):
+    for seed in range(first, first + CHUNK):
+        function = _program(random.Random(seed))
+
+        expected = _run(function, seed, False, True)
+        assert not isinstance(expected, str), seed
+        assert _run(function, seed, True, True) == expected, seed
+
+        # Reading an undefined temp may fail elsewhere, or not at all
+        expected = _run(function, seed, False, False)
+        if not isinstance(expected, str):
+            assert _run(function, seed, True, False) == expected, seed
+
+
+def _sequence():
+    f = Function()
+    f.append(f.set_reg(8, temp(0), f.op(
+        'ADD', 8, f.reg(8, 'rsp'),
+        f.op('ADD', 8, f.const(8, 8), f.const(8, 8))
+    )))
+    f.append(f.set_reg(8, temp(1), f.op(
+        'ZX', 8, f.load(4, f.reg(8, temp(0)))
+    )))
+    f.append(f.op('SUB', 8, f.reg(8, 'rax'), f.const(8, 1), flags='*'))
+    f.append(f.set_reg(8, 'rax', f.op(
+        'ADD', 8, f.reg(8, temp(1)), f.reg(8, 'rbx'), flags='*'
+    )))
+    f.append(f.set_reg(8, temp(2), f.const(8, 5)))
+    f.append(f.if_expr(f.op('CMP_E', 8, f.const(8, 1), f.const(8, 1)),
+                       6, 6))
+    f.append(f.set_reg(8, 'rcx', f.const(8, 1)))
+    return llil.load(f)
+
+
+def _sequence_emulator(function):
+    e = emilator.Emilator(function)
+    e.set_optimizer(optimizer.Optimizer())
+    e.map_memory(0x20000, 0x1000)
+    e.write_memory(0x20010, 0x11223344, 4)
+    e.set_register_value('rsp', 0x20000)
+    e.set_register_value('rax', 3)
+    e.set_register_value('rbx', 4)
+    return e
+
+
+def test_typical_sequence():
+    function = _sequence()
+    passes = optimizer.Optimizer()
+    optimized = passes.optimize(function)
+
+    assert passes.optimize(function) is optimized
+    assert len(optimized) == len(function)
+    assert [instruction.operation.name for instruction in optimized] == [
+        'LLIL_NOP', 'LLIL_SET_REG', 'LLIL_NOP', 'LLIL_SET_REG',
+        'LLIL_NOP', 'LLIL_GOTO', 'LLIL_SET_REG'
+    ]
+
+    e = _sequence_emulator(function)
+    assert e.run_until() == (emilator.STOP_END, 7)
+    assert e.get_register_value('rax') == 0x11223348
+
+    # The temps only the optimized code leaves unwritten
+    assert e._temps[0] is None
+    assert e._temps[2:] == []
+
+
+@pytest.mark.parametrize('hook', ['instruction', 'code', 'read', 'write'])
+def test_hooks_turn_it_off(hook):
+    e = _sequence_emulator(_sequence())
+
+    if hook == 'instruction':
+        e.register_instruction_hook(
+            Operation('LLIL_CONST'), lambda emulator, expression: None
+        )
+    elif hook == 'code':
+        e.register_code_hook(0, 1 << 64, lambda emulator, address: None)
+    elif hook == 'read':
+        e.register_memory_read_hook(
+            0, 1 << 64, lambda emulator, address, length: None
+        )
+    else:
+        e.register_memory_write_hook(
+            0, 1 << 64, lambda emulator, address, length, data: None
+        )
+
+    e.run_until()
+    assert e.get_register_value('rax') == 0x11223348
+    assert e._temps == [0x20010, 0x11223344, 5]
@@ -0,0 +1,95 @@
+import io
+import itertools
+import json
+
+import emilator
+import llil
+import profiler
+from llil import Function
+from profiler import COUNT, SELF, TOTAL
+
+
+def _ticks():
+    # A clock that moves one second every time it is read
+    return itertools.count().next
+
+
+def _emulator():
+    main = Function(0x1000)
+    main.append(main.set_reg(8, 'rcx', main.const(8, 3)))
+    main.append(main.call(main.const_pointer(8, 0x2000)))
+    main.append(main.set_reg(8, 'rcx', main.op(
+        'SUB', 8, main.reg(8, 'rcx'), main.const(8, 1)
+    )))
+    main.append(main.if_expr(main.op(
+        'CMP_E', 8, main.reg(8, 'rcx'), main.const(8, 0)
+    ), 4, 1))
+    main.append(main.nop())
+
+    callee = Function(0x2000)
+    callee.append(callee.set_reg(8, 'rax', callee.op(
+        'ADD', 8, callee.reg(8, 'rax'), callee.reg(8, 'rcx')
+    )))
+    callee.append(callee.ret(callee.pop(8)))
+
+    view = llil.image([main, callee])
+    e = emilator.Emilator(view.get_function_at(0x1000).low_level_il)
+    e.map_memory(0x7000, 0x1000)
+    e.set_register_value('rsp', 0x8000)
+    e.set_register_value('rax', 0)
+    return e
+
+
+def test_nested_operations():
+    p = profiler.Profiler(clock=_ticks())
+    inner = p.operation('LLIL_CONST', lambda: 1)
+    outer = p.operation('LLIL_ADD', lambda: inner() + 1)
+
+    assert outer() == 2
+    assert p.operations['LLIL_CONST'] == [1, 1.0, 1.0]
+    assert p.operations['LLIL_ADD'] == [1, 3.0, 2.0]
+
+
+def test_emulator_counts():
+    p = profiler.Profiler(clock=_ticks())
+    e = _emulator()
+    e.set_profiler(p)
+    e.run_until()
+
+    assert e.get_register_value('rax') == 6
+    assert p.operations['LLIL_CALL'][COUNT] == 3
+    assert p.operations['LLIL_ADD'][COUNT] == 3
+    assert p.operations['LLIL_CONST'][COUNT] == 7
+
+    assert dict(
+        (key, stats[COUNT]) for key, stats in p.blocks.items()
+    ) == {(0x1000, 0): 1, (0x1000, 1): 3, (0x1000, 4): 1, (0x2000, 0): 3}
+    assert p.functions[0x2000][COUNT] == 3
+    assert p.functions[0x2000][TOTAL] > 0
+
+    hottest = p.hot_spots(p.blocks)[0]
+    assert hottest[1][TOTAL] == max(
+        stats[TOTAL] for stats in p.blocks.values()
+    )
+
+    report = p.report()
+    assert 'LLIL_CALL' in report and '2000' in report
+
+    out = io.BytesIO()
+    p.dump(out)
+    dumped = json.loads(out.getvalue())
+    assert sorted(dumped) == ['blocks', 'functions', 'operations']
+    assert len(dumped['blocks']) == 4
+
+    p.clear()
+    assert all(stats == [0, 0.0, 0.0] for stats in p.operations.values())
+
+
+def test_no_profiler():
+    e = _emulator()
+    e.set_profiler(profiler.Profiler())
+    e.set_profiler(None)
+    e.run_until()
+
+    assert e.get_register_value('rax') == 6
+    assert e._profiler is None
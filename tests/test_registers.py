@@ -0,0 +1,76 @@
+import pytest
+
+import emilator
+import errors
+import llil
+import registers
+from llil import ARCH, Function, temp
+
+
+def _emulator():
+    f = Function()
+    f.append(f.nop())
+    return emilator.Emilator(llil.load(f))
+
+
+def test_layout():
+    layout = registers.get_layout(_emulator().function.arch)
+
+    assert layout is registers.get_layout(ARCH)
+    assert sorted(layout.names) == sorted(
+        set(info.full_width_reg for info in ARCH.regs.values())
+    )
+    assert layout['ah'].slot == layout['rax'].slot
+    assert layout['ah'].shift == 8
+    assert layout[ARCH.regs['eax'].index] is layout['eax']
+
+
+def test_partial_writes_merge():
+    e = _emulator()
+    e.set_register_value('rax', 0x1122334455667788)
+
+    e.set_register_value('ah', 0xaa)
+    assert e.get_register_value('rax') == 0x112233445566aa88
+    e.set_register_value('ax', 0xbbcc)
+    assert e.get_register_value('rax') == 0x112233445566bbcc
+    assert e.get_register_value('al') == 0xcc
+
+    # Writing a 32 bit register clears the upper half
+    e.set_register_value('eax', 0xffffffff)
+    assert e.get_register_value('rax') == 0xffffffff
+
+    assert e.registers == {'rax': 0xffffffff}
+
+
+def test_undefined_registers():
+    e = _emulator()
+
+    with pytest.raises(errors.UndefinedError):
+        e.get_register_value('rbx')
+    with pytest.raises(errors.UndefinedError):
+        e.set_register_value('bl', 1)
+    with pytest.raises(errors.UndefinedError):
+        e.get_register_value(temp(3))
+
+
+def test_temps():
+    e = _emulator()
+    e.set_register_value(temp(5), 1 << 70)
+
+    assert e.get_register_value(temp(5)) == 1 << 70
+    assert len(e._temps) == 6
+    assert e.registers == {}
+
+
+def test_registers_in_il():
+    f = Function()
+    f.append(f.set_reg(8, 'rax', f.const(8, 0x8877665544332211)))
+    f.append(f.set_reg(1, 'bh', f.reg(1, 'al')))
+    f.append(f.set_reg(4, 'ecx', f.reg(2, 'ax')))
+    f.append(f.set_reg(8, temp(0), f.reg(8, 'rbx')))
+    f.append(f.set_reg(8, 'rdx', f.reg(8, temp(0))))
+    e = llil.check(llil.load(f), {'rbx': 0, 'rcx': 0xffffffffffffffff})
+
+    assert e.get_register_value('rbx') == 0x1100
+    assert e.get_register_value('rcx') == 0x2211
+    assert e.get_register_value('rdx') == 0x1100
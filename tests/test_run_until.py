@@ -0,0 +1,124 @@
+import time
+
+import emilator
+import llil
+from emilator import (
+    STOP_BREAKPOINT, STOP_DEADLINE, STOP_END, STOP_LIMIT, STOP_PREDICATE,
+    STOP_RETURN
+)
+from llil import Function
+
+# 1 + 3 * 10 + 1 instructions
+TOTAL = 32
+
+
+def _emulator(end=None):
+    f = Function(0x1000)
+    f.append(f.set_reg(8, 'rax', f.const(8, 0)))
+    f.append(f.set_reg(8, 'rax', f.op(
+        'ADD', 8, f.reg(8, 'rax'), f.reg(8, 'rcx')
+    )))
+    f.append(f.set_reg(8, 'rcx', f.op(
+        'SUB', 8, f.reg(8, 'rcx'), f.const(8, 1)
+    )))
+    f.append(f.if_expr(f.op('CMP_E', 8, f.reg(8, 'rcx'), f.const(8, 0)),
+                       4, 1))
+    f.append(end or f.nop())
+
+    e = emilator.Emilator(llil.load(f))
+    e.set_register_value('rcx', 10)
+    return e
+
+
+def test_runs_to_the_end():
+    e = _emulator()
+    assert e.run_until() == (STOP_END, TOTAL)
+    assert e.get_register_value('rax') == 55
+
+    f = Function()
+    e = _emulator(f.ret(f.pop(8)))
+    e.map_memory(0x7000, 0x1000)
+    e.set_register_value('rsp', 0x7ff8)
+    assert e.run_until() == (STOP_RETURN, TOTAL)
+
+    # Checked runs count the same
+    e = _emulator()
+    assert e.run_until(predicate=lambda emulator: False) == (
+        STOP_END, TOTAL
+    )
+
+
+def test_limits_resume():
+    e = _emulator()
+    counts = []
+
+    while True:
+        result = e.run_until(max_instructions=5)
+        counts.append(result.count)
+        if result.reason != STOP_LIMIT:
+            break
+
+    assert result.reason == STOP_END
+    assert sum(counts) == TOTAL
+    assert counts[:-1] == [5] * (len(counts) - 1)
+    assert e.get_register_value('rax') == 55
+
+    e = _emulator()
+    assert e.run_until(max_instructions=0) == (STOP_LIMIT, 0)
+
+
+def test_breakpoints():
+    e = _emulator()
+
+    assert e.run_until(addresses=[0x1008]) == (STOP_BREAKPOINT, 2)
+    assert e.instr_index == 2
+    assert e.get_register_value('rcx') == 10
+
+    # Resuming from a breakpoint runs past it
+    assert e.run_until(addresses=[0x1008]) == (STOP_BREAKPOINT, 3)
+    assert e.get_register_value('rcx') == 9
+
+    assert e.run_until(indexes=[4]) == (STOP_BREAKPOINT, 26)
+    assert e.get_register_value('rcx') == 0
+
+
+def test_breakpoint_on_a_multi_il_instruction():
+    # The native instruction at 0x1004 lifts to three IL instructions
+    f = Function(0x1000)
+    f.append(f.set_reg(8, 'rax', f.const(8, 0)))
+    f.append(f.set_reg(8, 'rax', f.op(
+        'ADD', 8, f.reg(8, 'rax'), f.const(8, 1)
+    )), 0x1004)
+    f.append(f.set_reg(8, 'rbx', f.reg(8, 'rax')), 0x1004)
+    f.append(f.if_expr(f.op('CMP_E', 8, f.reg(8, 'rax'), f.const(8, 3)),
+                       4, 1), 0x1004)
+    f.append(f.nop())
+    e = emilator.Emilator(llil.load(f))
+
+    assert e.run_until(addresses=[0x1004]) == (STOP_BREAKPOINT, 1)
+    assert e.instr_index == 1
+
+    # Once per pass through the instruction, at its first IL instruction
+    assert e.run_until(addresses=[0x1004]) == (STOP_BREAKPOINT, 3)
+    assert e.instr_index == 1
+    assert e.get_register_value('rbx') == 1
+
+    assert e.run_until(addresses=[0x1004]) == (STOP_BREAKPOINT, 3)
+    assert e.run_until(addresses=[0x1004]) == (STOP_END, 4)
+    assert e.get_register_value('rbx') == 3
+
+
+def test_predicate_and_deadline():
+    e = _emulator()
+    result = e.run_until(
+        predicate=lambda emulator: emulator.get_register_value('rax') > 30
+    )
+    assert result == (STOP_PREDICATE, 11)
+    assert e.get_register_value('rax') == 34
+
+    # A deadline that has passed stops an endless loop
+    e = _emulator()
+    e.set_register_value('rcx', 0)
+    result = e.run_until(deadline=time.time())
+    assert result.reason == STOP_DEADLINE
+    assert result.count > 0
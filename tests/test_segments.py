@@ -0,0 +1,60 @@
+import emilator
+import llil
+from llil import Function
+from memory import PAGE_SIZE, READABLE
+
+DATA = bytes(bytearray(range(256))) * 48
+
+
+def _function():
+    f = Function(0x1000)
+    f.append(f.set_reg(8, 'rax', f.load(8, f.const(8, 0x400010))))
+    f.append(f.store(8, f.const(8, 0x401000), f.reg(8, 'rax')))
+    return llil.load(f, [
+        (0x400000, DATA[:PAGE_SIZE], READABLE),
+        (0x401000, DATA[PAGE_SIZE:], llil.READ_WRITE),
+    ])
+
+
+def test_pages_load_when_touched():
+    function = _function()
+    e = emilator.Emilator(function)
+    assert e._memory._pages == {}
+
+    e.run_until()
+
+    assert sorted(e._memory._pages) == [0x400, 0x401]
+    assert e.get_register_value('rax') == 0x1716151413121110
+    assert e.read_block(0x401000, 8).tobytes() == DATA[0x10:0x18]
+    assert e.read_block(0x401008, 8).tobytes() == (
+        DATA[PAGE_SIZE + 8:PAGE_SIZE + 16]
+    )
+
+
+def test_pages_are_copied_on_write():
+    function = _function()
+    first = emilator.Emilator(function)
+    second = emilator.Emilator(function)
+
+    first.read_memory(0x401000, 1)
+    page = first._memory._pages[0x401]
+    assert not page.private
+
+    first.run_until()
+    assert page.private
+
+    assert second.read_block(0x401000, 8).tobytes() == (
+        DATA[PAGE_SIZE:PAGE_SIZE + 8]
+    )
+
+
+def test_view_ranges():
+    e = emilator.Emilator(_function())
+    ranges = [(r.start, r.length, r.flags) for r in e._memory]
+
+    assert ranges == [
+        (0x400000, PAGE_SIZE, READABLE),
+        (0x401000, len(DATA) - PAGE_SIZE, llil.READ_WRITE),
+    ]
+    assert e.read_memory(0x402fff, 1) == ord(DATA[-1])
+    assert 0x403000 not in e._memory
@@ -0,0 +1,94 @@
+import warnings
+
+import emilator
+import llil
+from llil import Function
+
+DATA = (0x10000, 0x3000)
+
+
+def _emulator():
+    # rcx counts down, writing rcx to [0x10000 + rcx * 8] each round
+    f = Function()
+    f.append(f.store(8, f.op(
+        'ADD', 8, f.const(8, 0x10000),
+        f.op('LSL', 8, f.reg(8, 'rcx'), f.const(1, 3))
+    ), f.reg(8, 'rcx')))
+    f.append(f.set_reg(8, 'rcx', f.op(
+        'SUB', 8, f.reg(8, 'rcx'), f.const(8, 1), flags='*'
+    )))
+    f.append(f.if_expr(f.op('CMP_E', 8, f.reg(8, 'rcx'), f.const(8, 0)),
+                       3, 0))
+    f.append(f.set_reg(8, 'rax', f.const(8, 1)))
+
+    e = emilator.Emilator(llil.load(f))
+    e.map_memory(*DATA)
+    e.set_register_value('rcx', 1000)
+    return e
+
+
+def test_restore_resumes_identically():
+    e = _emulator()
+    e.run_until(1500)
+    snapshot = e.snapshot()
+
+    e.run_until()
+    finished = llil.state(e, [DATA])
+
+    e.restore(snapshot)
+    assert e.get_register_value('rcx') == 500
+    assert e.read_memory(0x10000 + 400 * 8, 8) == 0
+
+    e.run_until()
+    assert llil.state(e, [DATA]) == finished
+
+
+def test_snapshots_share_clean_pages():
+    e = _emulator()
+    e.run_until(3)
+    first = e.snapshot()
+    e.run_until(3)
+    second = e.snapshot()
+
+    unchanged = [
+        page for page in first.memory.pages
+        if first.memory.pages[page][0] is second.memory.pages[page][0]
+    ]
+    assert unchanged
+
+    # Restoring only copies back what was written since
+    e.restore(second)
+    assert e._memory._dirty == set()
+    e.run_until(3)
+    assert e._memory._dirty == set([0x11])
+
+
+def test_restore_an_older_snapshot():
+    e = _emulator()
+    start = e.snapshot()
+    e.run_until()
+
+    e.restore(start)
+    assert e.instr_index == 0
+    assert e.get_register_value('rcx') == 1000
+    assert e.read_block(*DATA).tobytes() == b'\x00' * DATA[1]
+
+
+def test_restore_keeps_compiled_code():
+    e = _emulator()
+    e.map_memory(0x1000, 0x1000, data=b'\x90' * 0x1000)
+    snapshot = e.snapshot()
+    e.map_memory(0x30000, 0x1000)
+
+    e.run_until(10)
+    code = e._code[e.function]
+
+    # Restoring memory whose code bytes are unchanged is not a write to
+    # the code
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        e.restore(snapshot)
+
+    assert e._code[e.function] is code
+    e.run_until()
+    assert e.get_register_value('rax') == 1
@@ -0,0 +1,79 @@
+import pytest
+
+import errors
+import memory
+from memory import PAGE_SIZE, READABLE, TLB_SIZE, WRITABLE
+
+RW = READABLE | WRITABLE
+
+
+def _memory(pages=2 * TLB_SIZE):
+    m = memory.Memory(8)
+    m.map(0x100000, pages * PAGE_SIZE, RW)
+    return m
+
+
+def test_colliding_pages():
+    # Pages TLB_SIZE apart share a slot, and keep evicting each other
+    m = _memory()
+    first = 0x100000
+    second = first + TLB_SIZE * PAGE_SIZE
+
+    for round in range(4):
+        m.write(first + round, b'a')
+        m.write(second + round, b'b')
+        assert m.read(first, round + 1) == b'a' * (round + 1)
+        assert m.read(second, round + 1) == b'b' * (round + 1)
+
+
+def test_writes_are_seen_by_reads():
+    m = _memory()
+    assert m.read(0x100010, 4) == b'\x00' * 4
+
+    m.write(0x100010, b'abcd')
+    assert m.read(0x100010, 4) == b'abcd'
+
+    # A snapshot shares the page again; the next write copies it
+    snapshot = m.snapshot()
+    m.write(0x100010, b'efgh')
+    assert m.read(0x100010, 4) == b'efgh'
+    assert bytes(snapshot.pages[0x100][0][0x10:0x14]) == b'abcd'
+
+    m.restore(snapshot)
+    assert m.read(0x100010, 4) == b'abcd'
+
+
+def test_mapping_changes_flush():
+    m = _memory()
+    m.write(0x100000, b'x')
+    assert m.read(0x100000, 1) == b'x'
+
+    m.unmap(0x100000, PAGE_SIZE)
+    with pytest.raises(errors.MemoryAccessError):
+        m.read(0x100000, 1)
+    with pytest.raises(errors.MemoryAccessError):
+        m.write(0x100000, b'y')
+
+    m.map(0x100000, PAGE_SIZE, READABLE)
+    assert m.read(0x100000, 1) == b'\x00'
+    with pytest.raises(errors.MemoryAccessError):
+        m.write(0x100000, b'y')
+
+
+def test_watching_a_cached_page():
+    m = _memory()
+    fired = []
+
+    watch = lambda address, length: fired.append(address)
+
+    m.write(0x100100, b'x')
+    m.watch(0x100100, 1, watch)
+    m.write(0x100100, b'y')
+
+    # Once it has fired, the page can be cached again, until watched
+    m.write(0x100100, b'y')
+    m.watch(0x100100, 1, watch)
+    m.write(0x100100, b'z')
+
+    assert fired == [0x100100, 0x100100]
+    assert m.read(0x100100, 1) == b'z'
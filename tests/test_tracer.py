@@ -0,0 +1,84 @@
+import pytest
+
+import emilator
+import llil
+import tracer
+from llil import Function, temp
+
+DATA = (0x3000, 0x1000)
+
+
+def _emulator():
+    f = Function(0x1000)
+    f.append(f.set_reg(8, temp(0), f.const(8, 7)))
+    f.append(f.set_reg(8, 'rax', f.op(
+        'ADD', 8, f.reg(8, temp(0)), f.reg(8, 'rax')
+    )))
+    f.append(f.store(16, f.const(8, 0x3000), f.reg(8, 'rax')))
+    f.append(f.set_reg(8, 'rcx', f.op(
+        'SUB', 8, f.reg(8, 'rcx'), f.const(8, 1)
+    )))
+    f.append(f.if_expr(f.op('CMP_E', 8, f.reg(8, 'rcx'), f.const(8, 0)),
+                       5, 1))
+    f.append(f.nop())
+
+    e = emilator.Emilator(llil.load(f))
+    e.map_memory(*DATA)
+    e.set_register_value('rax', 0)
+    e.set_register_value('rcx', 3)
+    return e
+
+
+def test_records(tmpdir):
+    path = str(tmpdir.join('trace'))
+    e = _emulator()
+    layout = e._layout
+
+    with tracer.TraceRecorder(path, capacity=4) as recorder:
+        e.set_tracer(recorder)
+        e.run_until()
+        e.set_tracer(None)
+        e.write_memory(0x3100, 1, 8)
+
+    assert recorder.count == 14
+
+    with tracer.TraceReader(path) as reader:
+        assert reader[0].kind == tracer.HEADER
+        assert reader[0].a == tracer.MAGIC
+
+        records = list(reader.records())
+        instructions = [r for r in records if r.kind == tracer.INSTRUCTION]
+        assert [r.count for r in instructions] == range(1, 15)
+        assert [r.index for r in instructions] == (
+            [0] + [1, 2, 3, 4] * 3 + [5]
+        )
+        assert instructions[2].b == 0x1008
+        assert all(r.a == 0x1000 for r in instructions)
+
+        # Temps are not traced
+        registers = [
+            (r.aux, r.a, r.b) for r in records if r.kind == tracer.REGISTER
+        ]
+        assert registers[:2] == [
+            (layout['rax'].slot, 7, 0), (layout['rcx'].slot, 2, 0)
+        ]
+
+        # Wide writes are split into 8 byte records
+        writes = [(r.aux, r.a, r.b) for r in records
+                  if r.kind == tracer.MEMORY]
+        assert writes[:2] == [(8, 0x3000, 7), (8, 0x3008, 0)]
+        assert len(writes) == 6
+
+        assert reader[reader.seek(3)].count == 3
+        assert [r.kind for r in reader.records(3, 4)] == [
+            tracer.INSTRUCTION, tracer.MEMORY, tracer.MEMORY
+        ]
+        assert list(reader.records(15)) == []
+
+
+def test_not_a_trace(tmpdir):
+    path = tmpdir.join('trace')
+    path.write(b'\x00' * tracer.RECORD_SIZE)
+
+    with pytest.raises(ValueError):
+        tracer.TraceReader(str(path))
@@ -0,0 +1,151 @@
+import warnings
+
+import pytest
+
+import emilator
+import errors
+import llil
+from llil import Function
+from offline import LowLevelILFlagCondition, Operation
+
+CODE = 0x1000
+
+
+def _loop():
+    # rax = sum(1..rcx), then a store to rbx
+    f = Function(CODE)
+    f.append(f.set_reg(8, 'rax', f.const(8, 0)))
+    f.append(f.set_reg(8, 'rax', f.op(
+        'ADD', 8, f.reg(8, 'rax'), f.reg(8, 'rcx')
+    )))
+    f.append(f.set_reg(8, 'rcx', f.op(
+        'SUB', 8, f.reg(8, 'rcx'), f.const(8, 1), flags='*'
+    )))
+    f.append(f.if_expr(
+        f.flag_condition(LowLevelILFlagCondition.LLFC_NE), 1, 4
+    ))
+    f.append(f.store(1, f.reg(8, 'rbx'), f.const(1, 0x90)))
+    f.append(f.set_reg(8, 'rdx', f.const(8, 1)))
+    return llil.load(f, [(CODE, b'\xcc' * 0x100, llil.READ_WRITE)])
+
+
+def _emulator(target=0x3000):
+    e = emilator.Emilator(_loop())
+    e.map_memory(0x3000, 0x1000)
+    e.set_register_value('rcx', 10)
+    e.set_register_value('rbx', target)
+    return e
+
+
+def test_blocks_match_instructions():
+    stepped = _emulator()
+    for _ in stepped.run():
+        pass
+
+    blocked = _emulator()
+    for _ in blocked.run_blocks():
+        pass
+
+    assert llil.state(blocked) == llil.state(stepped)
+    assert blocked.get_register_value('rax') == 55
+    assert len(blocked._translations) == 3
+
+
+def test_blocks_are_linked():
+    e = _emulator()
+    for _ in e.run_blocks():
+        pass
+
+    loop = e._translations.lookup(e.function, 1)
+    assert loop.links[1] is loop
+    assert loop.links[4].start == 4
+
+
+def test_writing_code_drops_it():
+    e = _emulator(CODE + 4 * 4)
+
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        e.run_until()
+
+    assert [warning.category for warning in caught] == [
+        errors.SelfModifyingCodeWarning
+    ]
+    assert e.function not in e._code
+    assert len(e._translations) == 0
+    assert e.get_register_value('rdx') == 1
+
+    # Code elsewhere in memory can be written without a warning
+    e = _emulator()
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        e.run_until()
+    assert e.function in e._code
+
+
+def test_unmapping_code_drops_it_quietly():
+    e = _emulator()
+    e.map_memory(CODE, 0x1000)
+    snapshot = e.snapshot()
+    e.write_memory(CODE, 0x90, 1)
+    e.run_until(5)
+    assert e.function in e._code
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        e.restore(snapshot)
+    assert e.function not in e._code
+
+    e.run_until(5)
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        e.unmap_memory(CODE, 0x1000)
+    assert e.function not in e._code
+    assert e._memory._watches == {}
+
+
+def _hooked_blocks(hook):
+    # Steps and runs blocks with hook on every ADD, collecting what
+    # each saw
+    results = []
+
+    for run in ('run', 'run_blocks'):
+        e = _emulator()
+        seen = []
+        e.register_instruction_hook(
+            Operation('LLIL_ADD'), lambda emulator, expr: hook(emulator, seen)
+        )
+        for _ in getattr(e, run)():
+            pass
+        results.append((seen, llil.state(e)))
+
+    return results
+
+
+def test_hooks_see_instr_index_inside_blocks():
+    def hook(emulator, seen):
+        seen.append(emulator.instr_index)
+
+    stepped, blocked = _hooked_blocks(hook)
+    assert blocked == stepped
+    assert stepped[0] == [2] * 10
+
+
+def test_hooks_can_redirect_inside_blocks():
+    def hook(emulator, seen):
+        seen.append(emulator.instr_index)
+        if len(seen) == 3:
+            emulator.instr_index = 5
+
+    stepped, blocked = _hooked_blocks(hook)
+    assert blocked == stepped
+    assert stepped[0] == [2] * 3
+    assert stepped[1][0]['rdx'] == 1
+
+
+def test_index_past_the_end():
+    e = _emulator()
+    e.run_until()
+
+    with pytest.raises(IndexError):
+        e._translations.translate(e.function, len(e.function))
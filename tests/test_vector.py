@@ -0,0 +1,206 @@
+import random
+
+import pytest
+
+import emilator
+import errors
+import lazyflags
+import llil
+from llil import FLAGS, Function
+
+numpy = pytest.importorskip('numpy')
+
+INPUTS = [0, 1, 5, 9, 10, 11, 0xff, 0x7fffffff, 0xffffffffffffffff,
+          0x8000000000000000]
+
+
+def _function():
+    # Straight-line code with one branch, and a store and load through
+    # a base memory page
+    f = Function()
+    f.append(f.set_reg(8, 'rax', f.op(
+        'XOR', 8, f.op('MUL', 8, f.reg(8, 'rdi'), f.const(8, 3)),
+        f.reg(8, 'rsi')
+    )))
+    f.append(f.if_expr(
+        f.op('CMP_UGT', 8, f.reg(8, 'rdi'), f.const(8, 9)), 2, 4
+    ))
+    f.append(f.set_reg(8, 'rbx', f.op(
+        'ROL', 8, f.reg(8, 'rax'), f.const(1, 13)
+    )))
+    f.append(f.goto(5))
+    f.append(f.set_reg(4, 'ebx', f.reg(4, 'edi')))
+    f.append(f.store(8, f.op(
+        'ADD', 8, f.const(8, 0x2000),
+        f.op('AND', 8, f.reg(8, 'rdi'), f.const(8, 0xf8))
+    ), f.reg(8, 'rbx')))
+    f.append(f.set_reg(8, 'rcx', f.op(
+        'ADD', 8, f.load(8, f.const(8, 0x2000)),
+        f.load(4, f.const(8, 0x2100))
+    )))
+    return llil.load(f)
+
+
+def _scalar(function, rdi):
+    e = emilator.Emilator(function)
+    e.map_memory(0x2000, 0x1000, data=b'\x11' * 0x1000)
+    e.set_register_value('rdi', rdi)
+    e.set_register_value('rsi', 0x5555)
+    return e
+
+
+def test_lanes_match_scalar_runs():
+    vector = pytest.importorskip('vector')
+    function = _function()
+
+    template = _scalar(function, 0)
+    lanes = vector.VectorEmilator(template, len(INPUTS))
+    lanes.set_register_value(
+        'rdi', numpy.array(INPUTS, dtype=numpy.uint64)
+    )
+    assert lanes.run() == [vector.STOP_END] * len(INPUTS)
+
+    results = lanes.registers
+    for lane, rdi in enumerate(INPUTS):
+        e = _scalar(function, rdi)
+        e.run_until()
+        for name in ('rax', 'rbx', 'rcx'):
+            assert int(results[name][lane]) == e.get_register_value(name)
+
+
+REGISTERS = {
+    8: ['rax', 'rbx', 'rcx', 'rdx'],
+    4: ['eax', 'ebx', 'ecx', 'edx'],
+    2: ['ax', 'bx', 'cx', 'dx'],
+    1: ['al', 'bl', 'cl', 'dl'],
+}
+FLAG_REGISTERS = ['rbp', 'r11', 'r12', 'r13', 'r14', 'r15']
+OPERATIONS = ['ADD', 'ADC', 'SUB', 'SBB', 'AND', 'OR', 'XOR', 'LSL', 'LSR',
+              'ASR', 'ROL', 'ROR', 'NEG', 'NOT']
+CONDITIONS = sorted(lazyflags.CONDITIONS)
+PROGRAMS = 150
+LANES = 16
+
+
+def _program(rnd):
+    # Random flag writing arithmetic, flag conditions (stored and
+    # branched on) and sign extensions, ending with every flag copied
+    # to a register
+    f = Function()
+    for flag in FLAGS:
+        f.append(f.set_flag(flag, f.const(1, 0)))
+    f.append(f.set_reg(8, 'rax', f.reg(8, 'rdi')))
+    f.append(f.set_reg(8, 'rbx', f.reg(8, 'rsi')))
+    f.append(f.set_reg(8, 'rcx', f.op(
+        'XOR', 8, f.reg(8, 'rdi'), f.reg(8, 'rsi')
+    )))
+    f.append(f.set_reg(8, 'rdx', f.op(
+        'ADD', 8, f.reg(8, 'rdi'), f.const(8, rnd.getrandbits(64))
+    )))
+
+    def operand(size):
+        if rnd.random() < 0.7:
+            return f.reg(size, rnd.choice(REGISTERS[size]))
+        return f.const(size, rnd.choice([
+            0, 1, 0x7f, 0x80, 0xff, rnd.getrandbits(size * 8)
+        ]) & ((1 << size * 8) - 1))
+
+    def condition():
+        return f.flag_condition(rnd.choice(CONDITIONS))
+
+    for _ in range(rnd.randint(1, 20)):
+        kind = rnd.randint(0, 9)
+
+        if kind <= 5:
+            name = rnd.choice(OPERATIONS)
+            size = rnd.choice([1, 2, 4, 8])
+            flags = rnd.choice(['*', '*', 'czs', None])
+
+            if name in ('NEG', 'NOT'):
+                operands = [operand(size)]
+            elif name in ('LSL', 'LSR', 'ASR', 'ROL', 'ROR'):
+                operands = [operand(size), f.const(1, rnd.randint(0, 70))]
+            elif name in ('ADC', 'SBB'):
+                operands = [operand(size), operand(size), f.flag('c')]
+            else:
+                operands = [operand(size), operand(size)]
+
+            f.append(f.set_reg(
+                size, rnd.choice(REGISTERS[size]),
+                f.op(name, size, *operands, flags=flags)
+            ))
+
+        elif kind <= 6:
+            f.append(f.set_reg(8, rnd.choice(['r8', 'r9']), condition()))
+
+        elif kind <= 7:
+            size = rnd.choice([1, 2, 4, 8])
+            f.append(f.set_reg(8, rnd.choice(REGISTERS[8]), f.op(
+                'SX', rnd.choice([2, 4, 8]), operand(size)
+            )))
+
+        else:
+            index = len(f)
+            f.append(f.if_expr(condition(), index + 1, index + 2))
+            f.append(f.set_reg(8, 'r10', f.const(8, index)))
+
+    for flag, register in zip(FLAGS, FLAG_REGISTERS):
+        f.append(f.set_reg(8, register, f.flag(flag)))
+
+    return llil.load(f)
+
+
+def _inputs(rnd):
+    return [
+        rnd.choice([0, 1, 0x80, 0xffffffff, 0x7fffffffffffffff,
+                    0xffffffffffffffff, rnd.getrandbits(64),
+                    rnd.getrandbits(8)])
+        for _ in range(LANES)
+    ]
+
+
+def _run_scalar(function, rdi, rsi):
+    e = emilator.Emilator(function)
+    e.set_register_value('rdi', rdi)
+    e.set_register_value('rsi', rsi)
+    e.run_until()
+    return e.registers
+
+
+def test_random_programs_match_scalar_runs():
+    vector = pytest.importorskip('vector')
+    rnd = random.Random(9)
+
+    for _ in range(PROGRAMS):
+        function = _program(rnd)
+        rdi = _inputs(rnd)
+        rsi = _inputs(rnd)
+
+        template = emilator.Emilator(function)
+        template.set_register_value('rdi', 0)
+        template.set_register_value('rsi', 0)
+        lanes = vector.VectorEmilator(template, LANES)
+        lanes.set_register_value('rdi', numpy.array(rdi, dtype=numpy.uint64))
+        lanes.set_register_value('rsi', numpy.array(rsi, dtype=numpy.uint64))
+        assert lanes.run() == [vector.STOP_END] * LANES
+
+        results = lanes.registers
+        assert set(FLAG_REGISTERS) <= set(results)
+
+        for lane in range(LANES):
+            scalar = _run_scalar(function, rdi[lane], rsi[lane])
+            for name, values in results.items():
+                assert int(values[lane]) == scalar[name], name
+
+
+def test_flag_writing_multiply_is_unimplemented():
+    vector = pytest.importorskip('vector')
+    f = Function()
+    f.append(f.set_reg(8, 'rax', f.op(
+        'MUL', 8, f.reg(8, 'rdi'), f.reg(8, 'rdi'), flags='*'
+    )))
+    template = _scalar(llil.load(f), 3)
+    lanes = vector.VectorEmilator(template, 2)
+
+    with pytest.raises(errors.UnimplementedError):
+        lanes.run()
@@ -0,0 +1,168 @@
+import bisect
+import mmap
+import os
+import struct
+from collections import namedtuple
+
+# kind, unused, aux, instr_index, instruction count, a, b
+RECORD = struct.Struct('<BBHIQQQ')
+RECORD_SIZE = RECORD.size
+
+HEADER = 0
+INSTRUCTION = 1
+REGISTER = 2
+MEMORY = 3
+
+MAGIC = struct.unpack('<Q', b'EMITRACE')[0]
+VERSION = 1
+
+MASK64 = (1 << 64) - 1
+
+# INSTRUCTION: a = function start, b = instruction address
+# REGISTER: aux = register slot, a/b = low/high 64 bits of the new value
+# MEMORY: aux = length (<= 8), a = address, b = bytes as a little endian int
+TraceRecord = namedtuple(
+    'TraceRecord', ['kind', 'aux', 'index', 'count', 'a', 'b']
+)
+
+
+class TraceRecorder(object):
+    # Encodes events as fixed size records into a preallocated buffer and
+    # flushes it, a chunk at a time, into a memory mapped file. Records
+    # carry the instruction count they belong to, so the file is sorted
+    # by it.
+    def __init__(self, path, capacity=65536):
+        chunk = capacity * RECORD_SIZE
+        granularity = mmap.ALLOCATIONGRANULARITY
+        chunk += -chunk % granularity
+
+        self.path = path
+        self.count = 0
+
+        self._file = open(path, 'w+b')
+        self._buffer = bytearray(chunk)
+        self._position = 0
+        self._offset = 0
+
+        self._record(HEADER, 0, 0, MAGIC, VERSION)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _record(self, kind, aux, index, a, b):
+        RECORD.pack_into(
+            self._buffer, self._position, kind, 0, aux, index, self.count,
+            a, b
+        )
+        self._position += RECORD_SIZE
+        if self._position == len(self._buffer):
+            self.flush()
+
+    def instruction(self, function_start, index, address):
+        self.count += 1
+        self._record(INSTRUCTION, 0, index, function_start, address)
+
+    def register(self, slot, value):
+        self._record(REGISTER, slot, 0, value & MASK64, (value >> 64) & MASK64)
+
+    def memory(self, address, data):
+        data = memoryview(data).tobytes()
+
+        for offset in range(0, len(data), 8):
+            chunk = data[offset:offset + 8]
+            value = struct.unpack('<Q', chunk.ljust(8, b'\x00'))[0]
+            self._record(MEMORY, len(chunk), 0, address + offset, value)
+
+    def flush(self):
+        if not self._position:
+            return
+
+        self._file.truncate(self._offset + self._position)
+
+        mapped = mmap.mmap(
+            self._file.fileno(), self._position, offset=self._offset
+        )
+        try:
+            mapped[:self._position] = bytes(self._buffer[:self._position])
+        finally:
+            mapped.close()
+
+        # A full chunk is done with; a partial one is rewritten, along with
+        # whatever follows it, on the next flush.
+        if self._position == len(self._buffer):
+            self._offset += self._position
+            self._position = 0
+
+    def close(self):
+        if self._file.closed:
+            return
+        self.flush()
+        self._file.close()
+
+
+class TraceReader(object):
+    # Random access to a trace without loading it; seek() finds an
+    # instruction count by binary search over the mapped records.
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        size = os.fstat(self._file.fileno()).st_size
+        self._mapped = mmap.mmap(
+            self._file.fileno(), size, access=mmap.ACCESS_READ
+        )
+        self._length = size // RECORD_SIZE
+
+        header = self[0] if self._length else None
+        if header is None or header.kind != HEADER or header.a != MAGIC:
+            self.close()
+            raise ValueError('{} is not an emilator trace'.format(path))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError('trace record out of range')
+
+        kind, _, aux, instr_index, count, a, b = RECORD.unpack_from(
+            self._mapped, index * RECORD_SIZE
+        )
+        return TraceRecord(kind, aux, instr_index, count, a, b)
+
+    def seek(self, count):
+        # Index of the first record belonging to instruction count
+        reader = self
+
+        class Counts(object):
+            def __len__(self):
+                return len(reader)
+
+            def __getitem__(self, index):
+                return reader[index].count
+
+        return bisect.bisect_left(Counts(), count, 1)
+
+    def records(self, start=0, end=None):
+        # Records for instruction counts in [start, end)
+        index = self.seek(start)
+        while index < self._length:
+            record = self[index]
+            if end is not None and record.count >= end:
+                break
+            yield record
+            index += 1
+
+    def close(self):
+        if not self._file.closed:
+            self._mapped.close()
+            self._file.close()
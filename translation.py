@@ -0,0 +1,141 @@
+BLOCK_EXITS = frozenset([
+    'LLIL_IF', 'LLIL_GOTO', 'LLIL_CALL', 'LLIL_RET', 'LLIL_JUMP',
+    'LLIL_JUMP_TO', 'LLIL_TAILCALL', 'LLIL_NORET', 'LLIL_SYSCALL',
+    'LLIL_BP', 'LLIL_TRAP', 'LLIL_UNDEF', 'LLIL_UNIMPL'
+])
+
+
+class Translation(object):
+    __slots__ = ('function', 'start', 'end', 'code', 'links', 'valid')
+
+    def __init__(self, function, start, end, code):
+        self.function = function
+        self.start = start
+        self.end = end
+        self.code = code
+        # successor instr_index -> Translation, filled in as blocks chain
+        self.links = {}
+        self.valid = True
+
+    def __repr__(self):
+        return '<Translation: [{}, {}), valid={}>'.format(
+            self.start, self.end, self.valid
+        )
+
+
+class TranslationCache(object):
+    def __init__(self, emulator):
+        self._emulator = emulator
+        self._blocks = {}
+
+    def __len__(self):
+        return sum(len(blocks) for blocks in self._blocks.values())
+
+    def lookup(self, function, index):
+        blocks = self._blocks.get(function)
+
+        if blocks is not None:
+            translation = blocks.get(index)
+            if translation is not None:
+                return translation
+
+        return self.translate(function, index)
+
+    def translate(self, function, index):
+        emulator = self._emulator
+
+        # Raises IndexError past the end of the function, like
+        # execute_instruction does.
+        instruction = function[index]
+
+        end = index
+        length = len(function)
+
+        while True:
+            end += 1
+
+            if (instruction.operation.name in BLOCK_EXITS or
+                    instruction.operation in emulator._hooks or
+                    end >= length):
+                break
+
+            instruction = function[end]
+
+        body = tuple(
+            emulator._compile_instruction(function, i)
+            for i in range(index, end - 1)
+        )
+        exit = emulator._compile_instruction(function, end - 1)
+
+        if emulator._hooked():
+            code = self._stepped_code(function, index, end, body, exit)
+        else:
+            code = self._block_code(index, end, body, exit)
+
+        translation = Translation(function, index, end, code)
+        # Writes to the function's code drop its blocks, through the
+        # watch the emulator keeps on code it has compiled
+        self._blocks.setdefault(function, {})[index] = translation
+
+        return translation
+
+    def _block_code(self, start, end, body, exit):
+        emulator = self._emulator
+
+        def code():
+            index = start
+            try:
+                for instruction in body:
+                    index += 1
+                    instruction()
+            except:
+                # Leave instr_index where execute_instruction would have
+                emulator.instr_index = index
+                raise
+
+            emulator.instr_index = end
+            exit()
+
+        return code
+
+    def _stepped_code(self, function, start, end, body, exit):
+        # Hooks see instr_index as execute_instruction would leave it,
+        # and may move it, which ends the block there
+        emulator = self._emulator
+
+        def code():
+            index = start
+            for instruction in body:
+                index += 1
+                emulator.instr_index = index
+                instruction()
+
+                if (emulator.instr_index != index or
+                        emulator._function is not function):
+                    return
+
+            emulator.instr_index = end
+            exit()
+
+        return code
+
+    def invalidate(self, translation):
+        translation.valid = False
+
+        blocks = self._blocks.get(translation.function)
+
+        if blocks is not None and blocks.get(translation.start) is translation:
+            del blocks[translation.start]
+
+    def invalidate_function(self, function):
+        for translation in list(self._blocks.get(function, {}).values()):
+            self.invalidate(translation)
+
+        self._blocks.pop(function, None)
+
+    def flush(self):
+        for blocks in list(self._blocks.values()):
+            for translation in list(blocks.values()):
+                self.invalidate(translation)
+
+        self._blocks = {}
@@ -0,0 +1,806 @@
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    from binaryninja import (LLIL_GET_TEMP_REG_INDEX, LLIL_REG_IS_TEMP,
+                             Endianness, LowLevelILFlagCondition)
+except ImportError:
+    from offline import (LLIL_GET_TEMP_REG_INDEX, LLIL_REG_IS_TEMP,
+                         Endianness, LowLevelILFlagCondition)
+
+import errors
+import lazyflags
+import llilvisitor
+import memory
+import registers
+
+STOP_RETURN = 'return'
+STOP_END = 'end'
+STOP_LIMIT = 'limit'
+
+
+class LaneState(object):
+    # A group of lanes that are all at the same instruction. Registers
+    # are uint64 arrays with one element per lane; pages are either a
+    # shared (PAGE_SIZE,) array or a private (lanes, PAGE_SIZE) one.
+    __slots__ = ('lanes', 'regs', 'temps', 'flags', 'pages', 'function',
+                 'instr_index', 'count', 'reason')
+
+    def __init__(self, lanes, regs, temps, flags, pages, function,
+                 instr_index, count=0):
+        self.lanes = lanes
+        self.regs = regs
+        self.temps = temps
+        self.flags = flags
+        self.pages = pages
+        self.function = function
+        self.instr_index = instr_index
+        self.count = count
+        self.reason = None
+
+    def split(self, mask):
+        # Moves the lanes selected by mask into a new LaneState
+        taken = self._select(mask)
+        remaining = self._select(~mask)
+
+        state = LaneState(
+            *taken, function=self.function, instr_index=self.instr_index,
+            count=self.count
+        )
+
+        (self.lanes, self.regs, self.temps, self.flags,
+         self.pages) = remaining
+
+        return state
+
+    def _select(self, mask):
+        def select(value):
+            if value is None or numpy.ndim(value) == 0:
+                return value
+            return value[mask]
+
+        pages = {}
+        for page_number, data in self.pages.items():
+            pages[page_number] = data if data.ndim == 1 else data[mask]
+
+        return (
+            self.lanes[mask],
+            [select(value) for value in self.regs],
+            dict((k, select(v)) for k, v in self.temps.items()),
+            dict((k, select(v)) for k, v in self.flags.items()),
+            pages
+        )
+
+
+class VectorEmilator(llilvisitor.LLILVisitor):
+    # Runs the same straight-line LLIL over many inputs at once. The
+    # scalar Emilator passed in provides the starting registers and the
+    # base memory image for every lane.
+    def __init__(self, emulator, lanes):
+        super(VectorEmilator, self).__init__()
+
+        if numpy is None:
+            raise ImportError('numpy is required for vectorized emulation')
+
+        self._function = emulator.function
+        self._arch = emulator.function.arch
+        self._layout = registers.get_layout(self._arch)
+        self._flag_roles = lazyflags.flag_roles(self._arch)
+        self._role_flags = dict(
+            (role, flag) for flag, role in self._flag_roles.items()
+        )
+        self._flags_written = {}
+        self._base = emulator._memory
+        self._little_endian = (
+            self._arch.endianness == Endianness.LittleEndian
+        )
+
+        self._lanes = lanes
+        self._state = None
+        self._state = LaneState(
+            numpy.arange(lanes),
+            [self._broadcast(value) if value is not None else None
+             for value in emulator._regs],
+            dict(
+                (index, self._broadcast(value))
+                for index, value in enumerate(emulator._temps)
+                if value is not None
+            ),
+            dict(
+                (flag, self._broadcast(bool(value), numpy.bool_))
+                for flag, value in emulator._flag_values().items()
+            ),
+            {},
+            emulator.function,
+            emulator.instr_index
+        )
+
+        self._finished = []
+
+    @property
+    def lanes(self):
+        return self._lanes
+
+    @property
+    def registers(self):
+        # name -> uint64 array over all lanes, for registers defined in
+        # every lane
+        result = {}
+
+        for slot, name in enumerate(self._layout.names):
+            values = numpy.zeros(self._lanes, dtype=numpy.uint64)
+            for state in self._finished or [self._state]:
+                value = state.regs[slot]
+                if value is None:
+                    break
+                values[state.lanes] = value
+            else:
+                result[name] = values
+
+        return result
+
+    @property
+    def stop_reasons(self):
+        reasons = [None] * self._lanes
+        for state in self._finished:
+            for lane in state.lanes:
+                reasons[lane] = state.reason
+        return reasons
+
+    @property
+    def instruction_counts(self):
+        counts = numpy.zeros(self._lanes, dtype=numpy.uint64)
+        for state in self._finished:
+            counts[state.lanes] = state.count
+        return counts
+
+    def _broadcast(self, value, dtype=None):
+        if dtype is None:
+            dtype = numpy.uint64
+        if self._state is None:
+            count = self._lanes
+        else:
+            count = len(self._state.lanes)
+
+        value = numpy.asarray(value)
+        if value.dtype != dtype:
+            value = value.astype(dtype)
+        return numpy.array(numpy.broadcast_to(value, (count,)), dtype=dtype)
+
+    def _value(self, value):
+        # Comparisons produce bool arrays; everything else is uint64
+        if getattr(value, 'dtype', None) == numpy.bool_:
+            return value.astype(numpy.uint64)
+        return value
+
+    def set_register_value(self, register, value):
+        state = self._state
+        value = self._broadcast(self._value(value))
+
+        index = getattr(register, 'index', register)
+        if isinstance(index, (int, long)) and LLIL_REG_IS_TEMP(index):
+            state.temps[LLIL_GET_TEMP_REG_INDEX(index)] = value
+            return value
+
+        info = self._layout[register]
+        mask = numpy.uint64(info.mask)
+
+        if info.full_width or info.extend == registers.ZERO_EXTEND:
+            value = value & mask
+
+        elif info.extend == registers.SIGN_EXTEND:
+            value = _sign_extend(value & mask, info.size) & numpy.uint64(
+                info.full_mask
+            )
+
+        else:
+            full_value = state.regs[info.slot]
+            if full_value is None:
+                raise errors.UndefinedError(
+                    'Register {} not defined'.format(
+                        self._layout.names[info.slot]
+                    )
+                )
+            value = (
+                (full_value & numpy.uint64(info.clear_mask)) |
+                ((value & mask) << numpy.uint64(info.shift))
+            )
+
+        state.regs[info.slot] = value
+        return value
+
+    def get_register_value(self, register):
+        state = self._state
+
+        index = getattr(register, 'index', register)
+        if isinstance(index, (int, long)) and LLIL_REG_IS_TEMP(index):
+            value = state.temps.get(LLIL_GET_TEMP_REG_INDEX(index))
+            if value is None:
+                raise errors.UndefinedError(
+                    'Register {} not defined'.format(
+                        LLIL_GET_TEMP_REG_INDEX(index)
+                    )
+                )
+            return value
+
+        info = self._layout[register]
+        value = state.regs[info.slot]
+
+        if value is None:
+            raise errors.UndefinedError(
+                'Register {} not defined'.format(info.name)
+            )
+
+        return (value >> numpy.uint64(info.shift)) & numpy.uint64(info.mask)
+
+    def write_lanes(self, address, data):
+        # Stores one byte string per lane (or a (lanes, length) uint8
+        # array) at address
+        data = numpy.asarray(
+            [numpy.frombuffer(bytes(d), dtype=numpy.uint8) for d in data]
+            if not isinstance(data, numpy.ndarray) else data,
+            dtype=numpy.uint8
+        )
+
+        lanes = self._state.lanes
+        rows = numpy.arange(len(lanes))
+
+        for position in range(data.shape[1]):
+            page_number, offset = divmod(address + position,
+                                         memory.PAGE_SIZE)
+            page = self._private_page(page_number)
+            page[rows, offset] = data[lanes, position]
+
+    def read_memory(self, addresses, length):
+        state = self._state
+        addresses = self._broadcast(addresses)
+        rows = numpy.arange(len(state.lanes))
+        value = numpy.zeros(len(state.lanes), dtype=numpy.uint64)
+
+        for position in range(length):
+            address = addresses + numpy.uint64(position)
+            page_numbers = address >> numpy.uint64(memory.PAGE_SHIFT)
+            offsets = (address & numpy.uint64(memory.PAGE_MASK)).astype(
+                numpy.intp
+            )
+            byte = numpy.empty(len(state.lanes), dtype=numpy.uint8)
+
+            for page_number in numpy.unique(page_numbers):
+                select = page_numbers == page_number
+                page = self._page(int(page_number), memory.READABLE)
+                if page.ndim == 1:
+                    byte[select] = page[offsets[select]]
+                else:
+                    byte[select] = page[rows[select], offsets[select]]
+
+            value |= byte.astype(numpy.uint64) << numpy.uint64(
+                self._byte_shift(position, length)
+            )
+
+        return value
+
+    def write_memory(self, addresses, value, length):
+        state = self._state
+        addresses = self._broadcast(addresses)
+        value = self._broadcast(self._value(value))
+        rows = numpy.arange(len(state.lanes))
+
+        for position in range(length):
+            address = addresses + numpy.uint64(position)
+            page_numbers = address >> numpy.uint64(memory.PAGE_SHIFT)
+            offsets = (address & numpy.uint64(memory.PAGE_MASK)).astype(
+                numpy.intp
+            )
+            byte = (
+                (value >> numpy.uint64(self._byte_shift(position, length))) &
+                numpy.uint64(0xff)
+            ).astype(numpy.uint8)
+
+            for page_number in numpy.unique(page_numbers):
+                select = page_numbers == page_number
+                page = self._private_page(int(page_number))
+                page[rows[select], offsets[select]] = byte[select]
+
+        return True
+
+    def _byte_shift(self, position, length):
+        if self._little_endian:
+            return position * 8
+        return (length - 1 - position) * 8
+
+    def _page(self, page_number, flag):
+        page = self._state.pages.get(page_number)
+
+        if page is None:
+            base_page = self._base._get_page(page_number)
+
+            if base_page is None or not base_page.flags & flag:
+                raise errors.MemoryAccessError(
+                    'Address {:x} is not valid.'.format(
+                        page_number << memory.PAGE_SHIFT
+                    ),
+                    address=page_number << memory.PAGE_SHIFT
+                )
+
+            page = numpy.frombuffer(
+                bytes(base_page.data[:]), dtype=numpy.uint8
+            )
+            self._state.pages[page_number] = page
+
+        return page
+
+    def _private_page(self, page_number):
+        page = self._page(page_number, memory.WRITABLE)
+
+        if page.ndim == 1:
+            base_page = self._base._get_page(page_number)
+            if not base_page.flags & memory.WRITABLE:
+                raise errors.MemoryAccessError(
+                    'Address {:x} is not writable.'.format(
+                        page_number << memory.PAGE_SHIFT
+                    ),
+                    address=page_number << memory.PAGE_SHIFT
+                )
+
+            page = numpy.tile(page, (len(self._state.lanes), 1))
+            self._state.pages[page_number] = page
+
+        return page
+
+    def run(self, max_instructions=None):
+        pending = [self._state]
+        self._finished = []
+
+        with numpy.errstate(over='ignore'):
+            while pending:
+                state = self._state = pending.pop()
+
+                while state.reason is None:
+                    if (max_instructions is not None and
+                            state.count >= max_instructions):
+                        state.reason = STOP_LIMIT
+                        break
+
+                    try:
+                        instruction = state.function[state.instr_index]
+                    except IndexError:
+                        if state.instr_index >= len(state.function):
+                            state.reason = STOP_END
+                            break
+                        raise
+
+                    state.instr_index += 1
+                    state.count += 1
+
+                    self._pending = pending
+                    self.visit(instruction)
+
+                self._finished.append(state)
+
+        return self.stop_reasons
+
+    def visit_LLIL_NOP(self, expr):
+        return True
+
+    def visit_LLIL_SET_REG(self, expr):
+        self.set_register_value(expr.dest, self.visit(expr.src))
+        return True
+
+    def visit_LLIL_REG(self, expr):
+        return self.get_register_value(expr.src)
+
+    def visit_LLIL_CONST(self, expr):
+        return numpy.uint64(expr.constant & 0xffffffffffffffff)
+
+    visit_LLIL_CONST_PTR = visit_LLIL_CONST
+
+    def visit_LLIL_LOAD(self, expr):
+        return self.read_memory(self.visit(expr.src), expr.size)
+
+    def visit_LLIL_STORE(self, expr):
+        addresses = self.visit(expr.dest)
+        value = self.visit(expr.src)
+        return self.write_memory(addresses, value, expr.size)
+
+    def visit_LLIL_PUSH(self, expr):
+        sp = self._arch.stack_pointer
+        value = self.visit(expr.src)
+        sp_value = self.get_register_value(sp) - numpy.uint64(expr.size)
+        self.write_memory(sp_value, value, expr.size)
+        return self.set_register_value(sp, sp_value)
+
+    def visit_LLIL_POP(self, expr):
+        sp = self._arch.stack_pointer
+        sp_value = self.get_register_value(sp)
+        value = self.read_memory(sp_value, expr.size)
+        self.set_register_value(sp, sp_value + numpy.uint64(expr.size))
+        return value
+
+    def visit_LLIL_SET_FLAG(self, expr):
+        value = self._broadcast(self.visit(expr.src), numpy.bool_)
+        self._state.flags[expr.dest.index] = value
+        return value
+
+    def visit_LLIL_FLAG(self, expr):
+        return self._get_flag_value(expr.src.index)
+
+    def visit_LLIL_FLAG_COND(self, expr):
+        condition = _CONDITIONS.get(expr.condition)
+
+        if condition is None:
+            return self.visit_unimplemented(expr)
+
+        return condition(self._get_flag_by_role)
+
+    def _get_flag_value(self, flag):
+        value = self._state.flags.get(flag)
+        if value is None:
+            # Assume that any previously unset flag is False
+            value = numpy.zeros(len(self._state.lanes), dtype=numpy.bool_)
+        return value
+
+    def _get_flag_by_role(self, role):
+        flag = self._role_flags.get(role)
+
+        if flag is not None:
+            return self._get_flag_value(flag)
+
+        if role == lazyflags.CARRY:
+            # Carry set on no borrow, as on ARM
+            flag = self._role_flags.get(lazyflags.INVERTED_CARRY)
+            if flag is not None:
+                return ~self._get_flag_value(flag)
+
+        raise errors.UnimplementedError(
+            '{} has no flag with role {}'.format(self._arch.name, role)
+        )
+
+    def _write_flags(self, expr, left, right, result, carry=0):
+        # Flags are worked out for every lane as they are written, from
+        # the same formulas as lazyflags.LazyFlags.compute()
+        written = self._flags_written.get(expr.flags)
+
+        if written is None:
+            written = self._flags_written[expr.flags] = (
+                lazyflags.flags_written(self._arch, expr.flags)
+            )
+
+        mask = _mask(expr.size)
+        operation = expr.operation.name
+        left = self._broadcast(left & mask)
+        right = self._broadcast(right & mask)
+        carry = self._broadcast(carry)
+        result = self._broadcast(result & mask)
+
+        for flag in written:
+            self._state.flags[flag] = self._broadcast(_compute_flag(
+                self._flag_roles.get(flag), operation, expr.size, left,
+                right, carry, result
+            ), numpy.bool_)
+
+    def visit_LLIL_GOTO(self, expr):
+        self._state.instr_index = expr.dest
+        return True
+
+    def visit_LLIL_IF(self, expr):
+        state = self._state
+        condition = self._broadcast(self.visit(expr.condition), numpy.bool_)
+
+        if condition.all():
+            state.instr_index = expr.true
+        elif not condition.any():
+            state.instr_index = expr.false
+        else:
+            # Lanes diverge: the taken lanes continue as their own group
+            taken = state.split(condition)
+            taken.instr_index = expr.true
+            state.instr_index = expr.false
+            self._pending.append(taken)
+
+        return True
+
+    def visit_LLIL_RET(self, expr):
+        self._state.reason = STOP_RETURN
+        return True
+
+    def visit_LLIL_ADD(self, expr):
+        left, right = self._operands(expr)
+        return self._arithmetic(expr, left, right, left + right)
+
+    def visit_LLIL_ADC(self, expr):
+        left, right = self._operands(expr)
+        carry = self._value(self.visit(expr.carry))
+        return self._arithmetic(expr, left, right, left + right + carry,
+                                carry)
+
+    def visit_LLIL_SUB(self, expr):
+        left, right = self._operands(expr)
+        return self._arithmetic(expr, left, right, left - right)
+
+    def visit_LLIL_SBB(self, expr):
+        left, right = self._operands(expr)
+        carry = self._value(self.visit(expr.carry))
+        return self._arithmetic(expr, left, right, left - right - carry,
+                                carry)
+
+    def visit_LLIL_MUL(self, expr):
+        if expr.flags:
+            # The carry and overflow of a 64 bit multiply need the whole
+            # 128 bit product
+            return self.visit_unimplemented(expr)
+
+        left, right = self._operands(expr)
+        return (left * right) & _mask(expr.size)
+
+    def visit_LLIL_AND(self, expr):
+        left, right = self._operands(expr)
+        if expr.flags:
+            return self._arithmetic(expr, left, right, left & right)
+        return left & right
+
+    def visit_LLIL_OR(self, expr):
+        left, right = self._operands(expr)
+        if expr.flags:
+            return self._arithmetic(expr, left, right, left | right)
+        return left | right
+
+    def visit_LLIL_XOR(self, expr):
+        left, right = self._operands(expr)
+        if expr.flags:
+            return self._arithmetic(expr, left, right, left ^ right)
+        return left ^ right
+
+    def visit_LLIL_LSL(self, expr):
+        left, right = self._operands(expr)
+        bits = expr.size * 8
+        return self._arithmetic(expr, left, right, numpy.where(
+            right >= bits, numpy.uint64(0),
+            (left << (right & numpy.uint64(63))) & _mask(expr.size)
+        ))
+
+    def visit_LLIL_LSR(self, expr):
+        left, right = self._operands(expr)
+        bits = expr.size * 8
+        return self._arithmetic(expr, left, right, numpy.where(
+            right >= bits, numpy.uint64(0),
+            (left & _mask(expr.size)) >> (right & numpy.uint64(63))
+        ))
+
+    def visit_LLIL_ASR(self, expr):
+        left, right = self._operands(expr)
+        shift = numpy.minimum(right, expr.size * 8 - 1).astype(numpy.int64)
+        value = _signed(left, expr.size) >> shift
+        return self._arithmetic(expr, left, right,
+                                value.astype(numpy.uint64))
+
+    def visit_LLIL_ROL(self, expr):
+        left, right = self._operands(expr)
+        bits = numpy.uint64(expr.size * 8)
+        count = right % bits
+        value = left & _mask(expr.size)
+        return self._arithmetic(expr, left, right, (value << count) | (
+            numpy.where(count == 0, numpy.uint64(0), value >> (bits - count))
+        ))
+
+    def visit_LLIL_ROR(self, expr):
+        left, right = self._operands(expr)
+        bits = numpy.uint64(expr.size * 8)
+        count = right % bits
+        value = left & _mask(expr.size)
+        return self._arithmetic(expr, left, right, (value >> count) | (
+            numpy.where(count == 0, numpy.uint64(0), value << (bits - count))
+        ))
+
+    def visit_LLIL_NEG(self, expr):
+        value = self._value(self.visit(expr.src))
+        return self._arithmetic(expr, value, numpy.uint64(0),
+                                numpy.uint64(0) - value)
+
+    def visit_LLIL_NOT(self, expr):
+        value = self._value(self.visit(expr.src))
+        return self._arithmetic(expr, value, numpy.uint64(0), ~value)
+
+    def _arithmetic(self, expr, left, right, result, carry=0):
+        # result masked to size, after writing any flags expr sets
+        result = result & _mask(expr.size)
+
+        if expr.flags:
+            self._write_flags(expr, left, right, result, carry)
+
+        return result
+
+    def visit_LLIL_SX(self, expr):
+        # As the scalar engines do it: from the sign bit of expr.size,
+        # which the register write then masks
+        value = self._value(self.visit(expr.src))
+        sign_bit = numpy.uint64(1 << (expr.size * 8 - 1))
+        return (value & (sign_bit - numpy.uint64(1))) - (value & sign_bit)
+
+    def visit_LLIL_ZX(self, expr):
+        return self._value(self.visit(expr.src))
+
+    def visit_LLIL_LOW_PART(self, expr):
+        return self._value(self.visit(expr.src)) & _mask(expr.size)
+
+    def visit_LLIL_BOOL_TO_INT(self, expr):
+        return self._value(self.visit(expr.src))
+
+    def visit_LLIL_CMP_E(self, expr):
+        left, right = self._operands(expr)
+        return left == right
+
+    def visit_LLIL_CMP_NE(self, expr):
+        left, right = self._operands(expr)
+        return left != right
+
+    def visit_LLIL_CMP_ULT(self, expr):
+        left, right = self._operands(expr)
+        return left < right
+
+    def visit_LLIL_CMP_ULE(self, expr):
+        left, right = self._operands(expr)
+        return left <= right
+
+    def visit_LLIL_CMP_UGT(self, expr):
+        left, right = self._operands(expr)
+        return left > right
+
+    def visit_LLIL_CMP_UGE(self, expr):
+        left, right = self._operands(expr)
+        return left >= right
+
+    def visit_LLIL_CMP_SLT(self, expr):
+        left, right = self._signed_operands(expr)
+        return left < right
+
+    def visit_LLIL_CMP_SLE(self, expr):
+        left, right = self._signed_operands(expr)
+        return left <= right
+
+    def visit_LLIL_CMP_SGT(self, expr):
+        left, right = self._signed_operands(expr)
+        return left > right
+
+    def visit_LLIL_CMP_SGE(self, expr):
+        left, right = self._signed_operands(expr)
+        return left >= right
+
+    def _operands(self, expr):
+        return (
+            self._value(self.visit(expr.left)),
+            self._value(self.visit(expr.right))
+        )
+
+    def _signed_operands(self, expr):
+        left, right = self._operands(expr)
+        return _signed(left, expr.size), _signed(right, expr.size)
+
+
+def _mask(size):
+    return numpy.uint64((1 << size * 8) - 1)
+
+
+def _signed(value, size):
+    value = numpy.asarray(value, dtype=numpy.uint64) & _mask(size)
+    if size == 8:
+        return value.view(numpy.int64)
+    sign_bit = 1 << (size * 8 - 1)
+    return (value.astype(numpy.int64) ^ sign_bit) - sign_bit
+
+
+def _sign_extend(value, size):
+    return _signed(value, size).view(numpy.uint64)
+
+
+def _compute_flag(role, operation, size, left, right, carry, result):
+    # lazyflags.LazyFlags.compute() over uint64 arrays of operands already
+    # masked to size, and the masked result
+    bits = size * 8
+    sign_bit = numpy.uint64(1 << (bits - 1))
+    one = numpy.uint64(1)
+
+    if role == lazyflags.ZERO:
+        return result == 0
+
+    if role == lazyflags.NEGATIVE:
+        return (result & sign_bit) != 0
+
+    if role == lazyflags.POSITIVE:
+        return (result & sign_bit) == 0
+
+    if role == lazyflags.CARRY or role == lazyflags.INVERTED_CARRY:
+        if operation in lazyflags.ADDITIONS:
+            # The sum wrapped, if it came out below left
+            return (result < left) | ((carry != 0) & (result == left))
+
+        if operation in lazyflags.SUBTRACTIONS:
+            if operation == 'LLIL_NEG':
+                borrow = left != 0
+            else:
+                borrow = (left < right) | ((carry != 0) & (left == right))
+            return borrow if role == lazyflags.CARRY else ~borrow
+
+        if operation == 'LLIL_LSL':
+            shifted = (right > 0) & (right <= bits)
+            shift = numpy.where(shifted, numpy.uint64(bits) - right, one)
+            return shifted & (((left >> shift) & one) != 0)
+
+        if operation == 'LLIL_LSR':
+            shift = numpy.minimum(right - one, numpy.uint64(63))
+            return ((right > 0) & (right <= 64) &
+                    (((left >> shift) & one) != 0))
+
+        if operation == 'LLIL_ASR':
+            shift = numpy.minimum(right - one, numpy.uint64(63)).astype(
+                numpy.int64
+            )
+            value = _signed(left, size) >> shift
+            return (right > 0) & ((value & 1) != 0)
+
+        if operation == 'LLIL_ROL':
+            return (result & one) != 0
+
+        if operation == 'LLIL_ROR':
+            return (result & sign_bit) != 0
+
+        return numpy.zeros(len(result), dtype=numpy.bool_)
+
+    if role == lazyflags.OVERFLOW:
+        if operation in lazyflags.ADDITIONS:
+            return ((left ^ result) & (right ^ result) & sign_bit) != 0
+
+        if operation in lazyflags.SUBTRACTIONS:
+            if operation == 'LLIL_NEG':
+                return left == sign_bit
+            return ((left ^ right) & (left ^ result) & sign_bit) != 0
+
+        return numpy.zeros(len(result), dtype=numpy.bool_)
+
+    if role == lazyflags.HALF_CARRY:
+        return ((left ^ right ^ result) & numpy.uint64(0x10)) != 0
+
+    if role == lazyflags.EVEN_PARITY or role == lazyflags.ODD_PARITY:
+        value = result & numpy.uint64(0xff)
+        for shift in (4, 2, 1):
+            value ^= value >> numpy.uint64(shift)
+        even = (value & one) == 0
+        return even if role == lazyflags.EVEN_PARITY else ~even
+
+    return numpy.zeros(len(result), dtype=numpy.bool_)
+
+
+# lazyflags.CONDITIONS, over bool arrays
+_CONDITIONS = {
+    LowLevelILFlagCondition.LLFC_E: lambda flag: flag(lazyflags.ZERO),
+    LowLevelILFlagCondition.LLFC_NE: lambda flag: ~flag(lazyflags.ZERO),
+    LowLevelILFlagCondition.LLFC_NEG: lambda flag: flag(lazyflags.NEGATIVE),
+    LowLevelILFlagCondition.LLFC_POS: lambda flag: ~flag(lazyflags.NEGATIVE),
+    LowLevelILFlagCondition.LLFC_O: lambda flag: flag(lazyflags.OVERFLOW),
+    LowLevelILFlagCondition.LLFC_NO: lambda flag: ~flag(lazyflags.OVERFLOW),
+    LowLevelILFlagCondition.LLFC_SLT: (
+        lambda flag: flag(lazyflags.NEGATIVE) != flag(lazyflags.OVERFLOW)
+    ),
+    LowLevelILFlagCondition.LLFC_SGE: (
+        lambda flag: flag(lazyflags.NEGATIVE) == flag(lazyflags.OVERFLOW)
+    ),
+    LowLevelILFlagCondition.LLFC_SLE: (
+        lambda flag: flag(lazyflags.ZERO) | (
+            flag(lazyflags.NEGATIVE) != flag(lazyflags.OVERFLOW)
+        )
+    ),
+    LowLevelILFlagCondition.LLFC_SGT: (
+        lambda flag: ~flag(lazyflags.ZERO) & (
+            flag(lazyflags.NEGATIVE) == flag(lazyflags.OVERFLOW)
+        )
+    ),
+    LowLevelILFlagCondition.LLFC_ULT: lambda flag: flag(lazyflags.CARRY),
+    LowLevelILFlagCondition.LLFC_UGE: lambda flag: ~flag(lazyflags.CARRY),
+    LowLevelILFlagCondition.LLFC_ULE: (
+        lambda flag: flag(lazyflags.CARRY) | flag(lazyflags.ZERO)
+    ),
+    LowLevelILFlagCondition.LLFC_UGT: (
+        lambda flag: ~flag(lazyflags.CARRY) & ~flag(lazyflags.ZERO)
+    ),
+}